@@ -1,14 +1,43 @@
+import abc
+import asyncio
+import collections
+import dataclasses
+import functools
 import os
-import openai
+import time
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from openai.openai_object import OpenAIObject
-from openai.error import OpenAIError
-from typing import List, Dict, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    List,
+    Dict,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from ofrak.model.component_model import ComponentConfig
-from ofrak_ai.exponential_backoff import retry_with_exponential_backoff
+from ofrak_ai.loop_local import LoopLocal
+from ofrak_ai.metrics import CallMetrics, has_metrics_hooks, record_call
+from ofrak_ai.retry import (
+    RetryPolicy,
+    call_hedged,
+    call_with_retries,
+    get_hedge_delay,
+    get_latency_tracker,
+    get_retry_after,
+)
+
+# openai and tiktoken are only imported once they are needed, so that importing (or discovering)
+# ofrak_ai does not pay for loading them
+if TYPE_CHECKING:
+    from aiohttp import ClientSession
+    from openai.openai_object import OpenAIObject
+    from tiktoken import Encoding
 
 
 class ModelType(str, Enum):
@@ -36,55 +65,599 @@ class ModelType(str, Enum):
     FOUR_32K_0314 = "gpt-4-32k-0314"
 
 
+# Default (requests per minute, tokens per minute) limits of each model for pay-as-you-go users.
+# See https://platform.openai.com/docs/guides/rate-limits/overview.
+DEFAULT_RATE_LIMITS: Dict[str, Tuple[int, int]] = {
+    ModelType.THREE_FIVE_TURBO: (3_500, 90_000),
+    ModelType.THREE_FIVE_TURBO_0301: (3_500, 90_000),
+    ModelType.FOUR: (200, 40_000),
+    ModelType.FOUR_0314: (200, 40_000),
+    ModelType.FOUR_32K: (200, 80_000),
+    ModelType.FOUR_32K_0314: (200, 80_000),
+}
+
+# (prompt, completion) prices of each model in US dollars per 1,000 tokens.
+# See https://openai.com/pricing.
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    ModelType.THREE_FIVE_TURBO: (0.0015, 0.002),
+    ModelType.THREE_FIVE_TURBO_0301: (0.0015, 0.002),
+    ModelType.FOUR: (0.03, 0.06),
+    ModelType.FOUR_0314: (0.03, 0.06),
+    ModelType.FOUR_32K: (0.06, 0.12),
+    ModelType.FOUR_32K_0314: (0.06, 0.12),
+}
+
+
+@dataclass
+class APICredentials:
+    """
+    :param api_key: an OpenAI API key
+    :param api_organization: the OpenAI API organization to use with the key
+    """
+
+    api_key: str
+    api_organization: Optional[str] = None
+
+
 @dataclass
 class ChatGPTConfig(ComponentConfig):
     """
     :param api_key: the OpenAI API key to use
     :param api_organization: the OpenAI API organization to use
+    :param api_key_pool: several keys to spread requests over instead of `api_key` and
+        `api_organization`, so that a job can use the rate limits of all of them; each request is
+        sent with the least busy key which is not cooling down after a rate limit error
+    :param key_cooldown: the number of seconds a key of `api_key_pool` is avoided after a rate
+        limit error which does not say how long to wait
     :param model: the OpenAI model to use
     :param system_message: a message which can be prepended to the conversation in API calls, which
         is used for providing additional information to ChatGPT for generating responses
     :param temperature: a measure of the randomness of ChatGPT's responses, between 0 (low) and
         2 (high)
+    :param num_choices: the number of alternative responses ChatGPT generates for each request
+    :param stream: if True, stream responses so that a response can be abandoned as soon as it is
+        clearly unusable instead of waiting for it to complete
+    :param requests_per_minute: the maximum number of requests per minute to send to `model`, or
+        None to use the model's default limit from `DEFAULT_RATE_LIMITS`
+    :param tokens_per_minute: the maximum number of prompt and completion tokens per minute to
+        send to `model`, or None to use the model's default limit from `DEFAULT_RATE_LIMITS`
+    :param backend: the [backend][ofrak_ai.chatgpt.ChatCompletionBackend] to send requests with,
+        or None to use the process-wide `DEFAULT_BACKEND`
+    :param retry_policy: how failed requests are retried, how long they may take, and whether slow
+        requests are hedged
     """
 
     api_key: Optional[str] = os.getenv("OPENAI_API_KEY")
     api_organization: Optional[str] = os.getenv("OPENAI_ORGANIZATION")
+    api_key_pool: List[APICredentials] = field(default_factory=list)
+    key_cooldown: float = 10.0
     model: str = ModelType.THREE_FIVE_TURBO
     system_message: Optional[str] = None
     temperature: float = 1.0
+    num_choices: int = 1
+    stream: bool = False
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    backend: Optional["ChatCompletionBackend"] = None
+    retry_policy: RetryPolicy = field(default_factory=RetryPolicy)
+
+
+class ChatCompletionBackend(abc.ABC):
+    """
+    Sends the chat completion requests of
+    [get_chatgpt_response][ofrak_ai.chatgpt.get_chatgpt_response]. A backend owns its HTTP
+    connections, so that they can be reused across requests instead of being set up for each one.
+    """
+
+    @abc.abstractmethod
+    async def create(self, config: ChatGPTConfig, **kwargs) -> Any:
+        """
+        :param config: the config the request is made with, e.g. for its credentials
+        :param kwargs: the parameters of the request, as taken by `openai.ChatCompletion.acreate`
+
+        :raises OpenAIError: if the request fails
+
+        :return: the response, or an async iterator of its chunks if the request is streamed
+        """
+
+    async def close(self):
+        """
+        Close the backend's connections, if it keeps any.
+        """
+
+
+class OpenAIBackend(ChatCompletionBackend):
+    """
+    Send requests with `openai.ChatCompletion.acreate` over a long-lived aiohttp session, whose
+    pool of keep-alive connections is shared by every request. Without it, openai opens a new
+    session, and pays for a new TCP and TLS handshake, for every request.
+
+    :param pool_size: the maximum number of simultaneous connections
+    :param keepalive_timeout: the number of seconds an idle connection is kept open for reuse
+    :param connect_timeout: the number of seconds to wait for a connection to be established
+    :param request_timeout: the number of seconds to wait for a whole request to complete
+    :param api_base: the base URL of the API, or None to use `openai.api_base`
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 100,
+        keepalive_timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        request_timeout: float = 600.0,
+        api_base: Optional[str] = None,
+    ):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.api_base = api_base
+        self._session: LoopLocal["ClientSession"] = LoopLocal(self._create_session)
+
+    async def create(self, config: ChatGPTConfig, **kwargs) -> Any:
+        import openai
+
+        # openai uses the session in this context variable instead of opening its own; streamed
+        # responses keep using it after the variable is reset
+        token = openai.aiosession.set(await self._get_session())
+        try:
+            return await openai.ChatCompletion.acreate(
+                api_key=self._get_api_key(config),
+                organization=config.api_organization,
+                api_base=self.api_base,
+                request_timeout=(self.connect_timeout, self.request_timeout),
+                **kwargs,
+            )
+        finally:
+            openai.aiosession.reset(token)
+
+    async def close(self):
+        session = self._session.value
+        if session is not None and self._session.is_current():
+            await session.close()
+        await self._discard_session()
+
+    def _get_api_key(self, config: ChatGPTConfig) -> Optional[str]:
+        return config.api_key
+
+    async def _get_session(self) -> "ClientSession":
+        session = self._session.value
+        if session is not None and (session.closed or not self._session.is_current()):
+            await self._discard_session()
+        return self._session.get()
+
+    def _create_session(self) -> "ClientSession":
+        import aiohttp
+
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.keepalive_timeout
+            )
+        )
+
+    async def _discard_session(self):
+        session = self._session.discard()
+        if session is None or session.closed:
+            return
+        connector = session.connector
+        session.detach()
+        try:
+            # Sessions of another event loop cannot be closed gracefully, but their connections
+            # can still be dropped
+            await connector.close()
+        except RuntimeError:
+            # The event loop of the connections is closed already
+            pass
+
+
+class OpenAICompatibleBackend(OpenAIBackend):
+    """
+    Send requests to any server implementing the OpenAI chat completions API, e.g. a local
+    inference server for bulk jobs. Such servers often do not check API keys, so a placeholder key
+    is sent if neither this backend nor the request's config has one.
+
+    :param api_base: the base URL of the API, e.g. `http://localhost:8000/v1`
+    :param api_key: the API key of the server, or None to use the key of each request's config
+    """
+
+    def __init__(self, api_base: str, api_key: Optional[str] = None, **kwargs):
+        super().__init__(api_base=api_base, **kwargs)
+        self.api_key = api_key
+
+    def _get_api_key(self, config: ChatGPTConfig) -> Optional[str]:
+        return self.api_key or config.api_key or "unused"
+
+
+DEFAULT_BACKEND: ChatCompletionBackend = OpenAIBackend()
+
+
+class TokenBucketRateLimiter:
+    """
+    Admits requests once there is enough capacity left in both a requests bucket and a tokens
+    bucket. Each bucket holds up to one minute's worth of capacity and refills continuously, so
+    that requests are spread out just under the quota instead of being rejected by the API.
+
+    Requests are admitted in the order they arrive, so a large request is not starved by a steady
+    stream of smaller ones.
+
+    :param requests_per_minute: the capacity and refill rate of the requests bucket
+    :param tokens_per_minute: the capacity and refill rate of the tokens bucket
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_update = time.monotonic()
+        self._lock = LoopLocal(asyncio.Lock)
+
+    async def acquire(self, num_tokens: int):
+        """
+        Wait until there is capacity for one request using `num_tokens` tokens, then consume it.
+
+        :param num_tokens: the estimated number of prompt and completion tokens of the request
+        """
+        # Requests larger than the whole bucket would never be admitted, so only wait for a full
+        # bucket in that case
+        num_tokens = min(num_tokens, self.tokens_per_minute)
+        async with self._lock.get():
+            while True:
+                self._refill()
+                missing_requests = 1 - self._available_requests
+                missing_tokens = num_tokens - self._available_tokens
+                if missing_requests <= 0 and missing_tokens <= 0:
+                    self._available_requests -= 1
+                    self._available_tokens -= num_tokens
+                    return
+                await asyncio.sleep(
+                    max(
+                        60 * missing_requests / self.requests_per_minute,
+                        60 * missing_tokens / self.tokens_per_minute,
+                    )
+                )
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        """
+        Return the difference between the estimated and actual number of tokens of a completed
+        request to the tokens bucket.
+
+        :param estimated_tokens: the number of tokens acquired for the request
+        :param used_tokens: the number of tokens the API reports the request used
+        """
+        self._refill()
+        self._available_tokens = min(
+            self._available_tokens + estimated_tokens - used_tokens,
+            float(self.tokens_per_minute),
+        )
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_update) / 60
+        self._last_update = now
+        self._available_requests = min(
+            self._available_requests + elapsed_minutes * self.requests_per_minute,
+            float(self.requests_per_minute),
+        )
+        self._available_tokens = min(
+            self._available_tokens + elapsed_minutes * self.tokens_per_minute,
+            float(self.tokens_per_minute),
+        )
+
+
+_RATE_LIMITERS: Dict[Tuple[str, Optional[str]], TokenBucketRateLimiter] = {}
+
+
+def get_rate_limiter(
+    config: ChatGPTConfig, api_key: Optional[str] = None
+) -> Optional[TokenBucketRateLimiter]:
+    """
+    Get the process-wide rate limiter for the configured model and API key, so that every
+    concurrent request to the same model with the same key shares the same quota.
+
+    :param api_key: the key of `config.api_key_pool` the request is sent with, or None for
+        `config.api_key`
+
+    :return: the rate limiter, or None if no limits are configured or known for the model
+    """
+    default_requests, default_tokens = DEFAULT_RATE_LIMITS.get(
+        config.model, (None, None)
+    )
+    requests_per_minute = config.requests_per_minute or default_requests
+    tokens_per_minute = config.tokens_per_minute or default_tokens
+    if requests_per_minute is None or tokens_per_minute is None:
+        return None
+
+    key = (config.model, api_key or config.api_key)
+    limiter = _RATE_LIMITERS.get(key)
+    if limiter is None:
+        limiter = TokenBucketRateLimiter(requests_per_minute, tokens_per_minute)
+        _RATE_LIMITERS[key] = limiter
+    else:
+        limiter.requests_per_minute = requests_per_minute
+        limiter.tokens_per_minute = tokens_per_minute
+    return limiter
+
+
+@dataclass
+class _KeyState:
+    """
+    :param in_flight: the number of requests being sent with the key, including those waiting for
+        its rate limiter
+    :param cooldown_until: the `time.monotonic()` time until which the key should not be used
+    """
+
+    in_flight: int = 0
+    cooldown_until: float = 0.0
+
+
+_KEY_STATES: Dict[str, _KeyState] = collections.defaultdict(_KeyState)
+
+
+def select_credentials(pool: Sequence[APICredentials]) -> APICredentials:
+    """
+    Pick the key of a pool to send a request with: the one with the fewest requests in flight
+    among those which are not cooling down after a rate limit error, or the one which is done
+    cooling down first if they all are.
+
+    :param pool: the keys to pick from
+    """
+    now = time.monotonic()
+    available = [
+        credentials
+        for credentials in pool
+        if _KEY_STATES[credentials.api_key].cooldown_until <= now
+    ]
+    if not available:
+        return min(
+            pool,
+            key=lambda credentials: _KEY_STATES[credentials.api_key].cooldown_until,
+        )
+    return min(
+        available, key=lambda credentials: _KEY_STATES[credentials.api_key].in_flight
+    )
+
+
+def cool_down_credentials(credentials: APICredentials, seconds: float):
+    """
+    Avoid a key for `seconds`, e.g. after it ran into its rate limit.
+    """
+    state = _KEY_STATES[credentials.api_key]
+    state.cooldown_until = max(state.cooldown_until, time.monotonic() + seconds)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    :return: the cost in US dollars of using the given number of tokens of `model`, or 0 if the
+        price of the model is unknown
+    """
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> "Encoding":
+    """
+    Get the tiktoken encoding used by a model. Encodings are only built (which may require
+    downloading their BPE tables) the first time they are requested, then cached for the lifetime
+    of the process.
+
+    :param model: the model to get the encoding for; unknown models fall back to the encoding of
+        the GPT-3.5 and GPT-4 models
+
+    :return: the model's encoding
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_prompt_tokens(history: List[Dict[str, str]], model: str) -> int:
+    """
+    Count the number of prompt tokens a message history will use.
+
+    Modified from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+    :param history: a history of messages conforming to the OpenAI API specification
+    :param model: the model the messages will be sent to
+    """
+    encoding = get_encoding(model)
+    # Every message is wrapped in <|start|>{role/name}\n{content}<|end|>\n, and every reply is
+    # primed with <|start|>assistant<|message|>
+    num_tokens = 3
+    for message in history:
+        num_tokens += 4
+        for value in message.values():
+            num_tokens += len(encoding.encode(value))
+    return num_tokens
 
 
 async def get_chatgpt_response(
     history: List[Dict[str, str]],
     max_tokens: int,
     config: ChatGPTConfig,
-) -> OpenAIObject:
+    is_viable: Optional[Callable[[str], bool]] = None,
+) -> "OpenAIObject":
     """
-    Calls the OpenAI API with the appropriate model and message history while performing
-    exponential backoff in case of rate limit errors.
+    Calls the OpenAI API with the appropriate model and message history while staying under the
+    model's rate limits, and retrying, bounding and hedging requests according to the config's
+    [RetryPolicy][ofrak_ai.retry.RetryPolicy]. Requests are sent with the credentials of the
+    config, or spread over the keys of its `api_key_pool`, each with its own rate limits; a
+    request which runs into the rate limit of one key is sent again right away with another.
 
     :param history: a history of messages conforming to the OpenAI API specification
     :param max_tokens: a maximum number of tokens to include in the model's response before
         truncation occurs
     :param config: an instance of ChatGPTConfig with the desired model parameters to use
+    :param is_viable: if streaming, a check of a partial response which returns False once the
+        response can no longer become usable; the stream is abandoned as soon as no choice is
+        viable anymore
 
     :raises OpenAIError: if unable to make a valid request or receive a response from ChatGPT
 
     :return: a model response in the form of an OpenAIObject if the call succeeds
     """
 
-    @retry_with_exponential_backoff
-    async def retry_response(**kwargs) -> OpenAIObject:
-        try:
-            response = await openai.ChatCompletion.acreate(**kwargs)
-            return response
-        except OpenAIError as e:
-            raise e
+    from openai.error import OpenAIError, RateLimitError
+
+    backend = config.backend or DEFAULT_BACKEND
+    rate_limiter = get_rate_limiter(config)
+    measure = has_metrics_hooks()
+    if rate_limiter is not None or measure:
+        prompt_tokens = count_prompt_tokens(history, config.model)
+        estimated_tokens = prompt_tokens + max_tokens * config.num_choices
+    # Report models by name rather than as ModelType members
+    metrics = CallMetrics(getattr(config.model, "value", config.model))
 
-    return await retry_response(
+    model = metrics.model
+    hedge_after = get_hedge_delay(config.retry_policy, model)
+    kwargs = dict(
         model=config.model,
         temperature=config.temperature,
         max_tokens=max_tokens,
+        n=config.num_choices,
+        stream=config.stream,
         messages=[message for message in history],
     )
+
+    def on_backoff(delay: float):
+        metrics.backoff += delay
+        metrics.retries += 1
+
+    def on_hedge():
+        metrics.hedges += 1
+
+    async def send(
+        request_config: ChatGPTConfig, limiter: Optional[TokenBucketRateLimiter]
+    ) -> "OpenAIObject":
+        if limiter is not None:
+            start = time.monotonic()
+            await limiter.acquire(estimated_tokens)
+            metrics.queue_wait += time.monotonic() - start
+        start = time.monotonic()
+        try:
+            response = await backend.create(request_config, **kwargs)
+            if config.stream:
+                response = await _collect_stream(response, config, is_viable)
+        finally:
+            metrics.latency += time.monotonic() - start
+        get_latency_tracker(model).add(time.monotonic() - start)
+        if response and (limiter is not None or measure):
+            usage = _get_usage(response, prompt_tokens, config)
+            if usage is not None:
+                metrics.prompt_tokens, metrics.completion_tokens = usage
+                if limiter is not None:
+                    limiter.settle(estimated_tokens, sum(usage))
+        return response
+
+    async def attempt() -> "OpenAIObject":
+        if not config.api_key_pool:
+            return await send(config, rate_limiter)
+        while True:
+            credentials = select_credentials(config.api_key_pool)
+            state = _KEY_STATES[credentials.api_key]
+            state.in_flight += 1
+            try:
+                return await send(
+                    dataclasses.replace(
+                        config,
+                        api_key=credentials.api_key,
+                        api_organization=credentials.api_organization,
+                    ),
+                    get_rate_limiter(config, credentials.api_key),
+                )
+            except RateLimitError as e:
+                cool_down_credentials(
+                    credentials, get_retry_after(e) or config.key_cooldown
+                )
+                now = time.monotonic()
+                if all(
+                    _KEY_STATES[other.api_key].cooldown_until > now
+                    for other in config.api_key_pool
+                ):
+                    # Every key is cooling down, so back off as usual
+                    raise
+                # Another key can take the request right away
+                on_backoff(0.0)
+            finally:
+                state.in_flight -= 1
+
+    try:
+        return await call_with_retries(
+            lambda: call_hedged(attempt, hedge_after, on_hedge),
+            config.retry_policy,
+            on_backoff,
+        )
+    except OpenAIError as e:
+        metrics.error = type(e).__name__
+        raise e
+    finally:
+        if measure:
+            metrics.cost = estimate_cost(
+                config.model, metrics.prompt_tokens, metrics.completion_tokens
+            )
+            record_call(metrics)
+
+
+def _get_usage(
+    response: "OpenAIObject", prompt_tokens: int, config: ChatGPTConfig
+) -> Optional[Tuple[int, int]]:
+    """
+    :return: the (prompt, completion) tokens used by a response, or None if they are unknown
+    """
+    if "usage" in response:
+        return response.usage.prompt_tokens, response.usage.completion_tokens
+    if config.stream:
+        # Streamed responses do not report their usage, so count what was received
+        encoding = get_encoding(config.model)
+        return prompt_tokens, sum(
+            len(encoding.encode(choice.message.content)) for choice in response.choices
+        )
+    return None
+
+
+async def _collect_stream(
+    stream: AsyncIterator["OpenAIObject"],
+    config: ChatGPTConfig,
+    is_viable: Optional[Callable[[str], bool]],
+) -> "OpenAIObject":
+    """
+    Assemble streamed chunks into the same shape as a regular response, abandoning the stream once
+    no choice is viable anymore. The choices of an abandoned response have a `finish_reason` of
+    "abandoned" and hold the content received so far.
+    """
+    from openai.util import convert_to_openai_object
+
+    contents = [""] * config.num_choices
+    finish_reasons: List[Optional[str]] = [None] * config.num_choices
+    async for chunk in stream:
+        for choice in chunk.choices:
+            # Some servers send a null content, e.g. in the delta which only holds the role
+            contents[choice.index] += choice.delta.get("content") or ""
+            finish_reasons[choice.index] = choice.get("finish_reason")
+        if is_viable is not None and not any(
+            finish_reason is not None or is_viable(content)
+            for content, finish_reason in zip(contents, finish_reasons)
+        ):
+            finish_reasons = ["abandoned"] * config.num_choices
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+            break
+
+    return convert_to_openai_object(
+        {
+            "choices": [
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": finish_reason,
+                }
+                for index, (content, finish_reason) in enumerate(
+                    zip(contents, finish_reasons)
+                )
+            ]
+        }
+    )
@@ -1,22 +1,71 @@
+import asyncio
+import dataclasses
+import functools
+import hashlib
+import json
 import logging
-import openai
+import math
 import re
 import string
+import time
 
 from dataclasses import dataclass, field
 from enum import Enum
-from openai.error import OpenAIError
-from tiktoken import Encoding, encoding_for_model
-from typing import Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from ofrak import Resource
+from ofrak.core.binary import GenericBinary
 from ofrak.core.strings import AsciiString, StringPatchingConfig, StringPatchingModifier
 from ofrak.component.modifier import Modifier
-from ofrak_ai.chatgpt import ChatGPTConfig, get_chatgpt_response
+from ofrak_ai.chatgpt import (
+    ChatGPTConfig,
+    count_prompt_tokens,
+    estimate_cost,
+    get_chatgpt_response,
+    get_encoding,
+)
+from ofrak_ai.metrics import StringMetrics, record_string
+from ofrak_ai.model_router import ModelRouter
+from ofrak_ai.scheduler import RewriteBudget, RewriteJob, get_string_priority
+from ofrak_ai.string_cache import StringRewriteCache, get_string_rewrite_cache
+from ofrak_ai.string_journal import RewriteJournal, get_rewrite_journal
+from ofrak_ai.string_patching import (
+    BulkStringPatchingConfig,
+    BulkStringPatchingModifier,
+    get_string_patches,
+)
+from ofrak_ai.string_triage import (
+    REWRITABLE_CATEGORIES,
+    SPECIFIER_PATTERN,
+    StringCategory,
+    classify_string,
+    get_section_name,
+    triage_string_descendants,
+)
+
+if TYPE_CHECKING:
+    from openai.openai_object import OpenAIObject
+    from tiktoken import Encoding
 
 LOGGER = logging.getLogger(__name__)
 
-SPECIFIER_PATTERN = re.compile(r"(?<!%)(%%)*(%[^%]*?[diuoxXfFeEgGaAcCsSpn])")
+# Words ChatGPT likes to pad its replies with, which can be dropped without changing their meaning
+FILLER_PATTERN = re.compile(
+    r"\b(?:actually|basically|honestly|just|literally|really|seriously|simply|totally|very)\b"
+    r",?\s*",
+    re.IGNORECASE,
+)
 
 
 class StringType(Enum):
@@ -51,16 +100,36 @@ class VoiceType(Enum):
 class ChatGPTStringModifierConfig(ChatGPTConfig):
     """
     :param min_length: the minimum string length required for targeting strings
-    :param encoding: the tiktoken encoding to use for calculating the number of tokens in a string
+    :param encoding: the tiktoken encoding to use for counting the tokens a rewrite of a string may
+        use, or None to use the encoding of `model`; ignored with a `model_router`, in which case
+        the encoding of the model each string is routed to is used
     :param max_retries: the maximum number of attempts to ask ChatGPT to meet the prompt specs
         before forcefully truncating the response
     :param prompt_parts: adjustable prompt specifications to give to ChatGPT based on the string
         type
     :param voice: the type of voice to ask ChatGPT to rewrite strings in
+    :param local_repair: if True, try to fix replies that are too long or have misordered
+        specifiers locally before asking ChatGPT again
+    :param cache_path: the path of a SQLite database in which rewrites are cached across runs, or
+        None to always request new rewrites
+    :param cache_max_entries: the maximum number of rewrites to keep in the cache
+    :param cache_max_age: the maximum age in seconds of a cached rewrite, or None to never expire
+        rewrites
+    :param rewrite_categories: the [categories][ofrak_ai.string_triage.StringCategory] of strings
+        to rewrite; strings of any other category, such as symbols and paths, are left alone
+    :param journal_path: the path of a [journal][ofrak_ai.string_journal.RewriteJournal] in which
+        every accepted rewrite is recorded as soon as it completes, so that an interrupted run over
+        the same image can be resumed without requesting those strings again, or None to not keep
+        a journal
+    :param model_router: a [router][ofrak_ai.model_router.ModelRouter] which picks the model of
+        each string in place of `model`, or None to send every string to `model`
+    :param max_tokens_overshoot: the fraction by which a reply may exceed the length of its
+        original before it is cut off, which leaves room for replies that can still be repaired
+        locally
     """
 
     min_length: int = 50
-    encoding: Encoding = encoding_for_model(ChatGPTConfig.model)
+    encoding: Optional["Encoding"] = None
     max_retries: int = 3
     prompt_parts: Dict[StringType, str] = field(
         default_factory=lambda: {
@@ -70,6 +139,35 @@ class ChatGPTStringModifierConfig(ChatGPTConfig):
         }
     )
     voice: Voice = field(default_factory=lambda: VoiceType.SASSY.value)
+    local_repair: bool = True
+    cache_path: Optional[str] = None
+    cache_max_entries: int = 100_000
+    cache_max_age: Optional[float] = None
+    rewrite_categories: FrozenSet[StringCategory] = REWRITABLE_CATEGORIES
+    journal_path: Optional[str] = None
+    model_router: Optional[ModelRouter] = None
+    max_tokens_overshoot: float = 0.25
+
+
+@dataclass
+class ChatGPTBatchStringModifierConfig(ChatGPTStringModifierConfig):
+    """
+    :param batch_size: the maximum number of strings to pack into a single request
+    :param bulk_patch: if True, apply every rewrite in one
+        [BulkStringPatchingModifier][ofrak_ai.string_patching.BulkStringPatchingModifier] run on
+        the target resource instead of running a
+        [StringPatchingModifier][ofrak.core.strings.StringPatchingModifier] per string
+    :param budget: a [budget][ofrak_ai.scheduler.RewriteBudget] which limits the tokens, cost and
+        time spent on rewrites, in which case the strings most worth rewriting are sent first and
+        whatever completed within the budget is patched in, or None to rewrite every string
+    """
+
+    batch_size: int = 20
+    bulk_patch: bool = True
+    budget: Optional[RewriteBudget] = None
+
+
+ConfigT = TypeVar("ConfigT", bound=ChatGPTStringModifierConfig)
 
 
 class ChatGPTStringModifier(Modifier[ChatGPTStringModifierConfig]):
@@ -88,24 +186,34 @@ class ChatGPTStringModifier(Modifier[ChatGPTStringModifierConfig]):
         """
         :param resource: the string resource to modify
         """
-        # This is technically redundant at the moment since openai does the same thing, but a safe-
-        # guard in case openai changes
-        openai.api_key = config.api_key
-        openai.organization = config.api_organization
-
         string = await resource.view_as(AsciiString)
         text = string.Text
         text_length = len(text)
 
-        if text_length >= config.min_length:
-            # Assume strings without spaces must remain space-free
-            if " " not in text:
-                str_type = StringType.IDENTIFIER
-            else:
-                str_type = StringType.SENTENCE
-            result = await self._get_modified_string(
-                text, text_length, str_type, config
-            )
+        category = classify_string(
+            text, config.min_length, await get_section_name(resource)
+        )
+        if category in config.rewrite_categories:
+            journal = _get_journal(config)
+            result = None
+            if journal is not None:
+                offset = (await resource.get_data_range_within_root()).start
+                result = journal.get(offset, text)
+            if result is None:
+                routed_config = _route(text, config)
+                key = _get_cache_key(text, routed_config)
+                cache = _get_cache(config)
+                result = cache.get(key) if cache is not None else None
+                if result is None:
+                    result = await _get_rewrite_once(
+                        text,
+                        routed_config,
+                        functools.partial(
+                            self._get_cached_string, key, text, routed_config
+                        ),
+                    )
+                if result and journal is not None:
+                    journal.append(offset, text, result)
             if result:
                 LOGGER.debug(f"Original String: {text}\nSassified String: {result}")
                 string_patch_config = StringPatchingConfig(
@@ -113,6 +221,17 @@ class ChatGPTStringModifier(Modifier[ChatGPTStringModifierConfig]):
                 )
                 await resource.run(StringPatchingModifier, string_patch_config)
 
+    async def _get_cached_string(
+        self, key: str, text: str, config: ChatGPTStringModifierConfig
+    ) -> Optional[str]:
+        result = await self._get_modified_string(
+            text, len(text), get_string_type(text), config
+        )
+        cache = _get_cache(config)
+        if result and cache is not None:
+            cache.put(key, result)
+        return result
+
     async def _get_modified_string(
         self,
         text: str,
@@ -120,112 +239,824 @@ class ChatGPTStringModifier(Modifier[ChatGPTStringModifierConfig]):
         str_type: StringType,
         config: ChatGPTStringModifierConfig,
     ) -> Optional[str]:
-        # Use the number of tokens in the string as an early bounds for response length, under the
-        # assumption that we should allow ChatGPT more room for creative responses early in the
-        # process and then more forcefully restrict its length after the initial request
-        num_tokens = len(config.encoding.encode(text))
-
-        history = [
-            {
-                "role": "user",
-                "content": f"You are a {config.voice.value.voice_noun}.\
-                                I will send a message and you will respond by making the text of the message more {config.voice.value.voice_adjective}.\
-                                The text you generate must be shorter or equal to the length to the length of the original message.\
-                                It is EXTREMELY important that your version is shorter than the original and contains only ASCII characters.\
-                                {(str_type == StringType.IDENTIFIER) * config.prompt_parts.get(StringType.IDENTIFIER, '')} \
-                                {(str_type == StringType.SENTENCE) * config.prompt_parts.get(StringType.SENTENCE, '')} \
-                                If you understand, make the following message more {config.voice.value.voice_adjective}: \n{text}",
-            },
-        ]
+        from openai.error import OpenAIError
+
+        max_tokens = _get_max_tokens(text, config)
+
+        history = get_string_request(text, config)
 
+        string_metrics = StringMetrics(text_length)
         try:
-            response = await get_chatgpt_response(history, num_tokens * 2, config)
+            is_viable = functools.partial(_is_viable_result, text, str_type, config)
+            response = await get_chatgpt_response(
+                history, max_tokens, config, is_viable
+            )
 
             # Sometimes saw cases where ChatGPT sent no response, so validate there was a response
-            if response:
-                retries = 0
-                # Handle identifier and sentence lengths the same way
-                if str_type == StringType.IDENTIFIER:
-                    # Since ChatGPT likes to add commentary, assume the longest word in the response
-                    # is the sassified input
-                    result = max(response.choices[0].message.content.split(), key=len)
-                else:
-                    result = response.choices[0].message.content
-                valid_specifiers = self._verify_specifiers(text, result)
-                while (
-                    (len(result) > text_length or not valid_specifiers)
-                    and retries <= config.max_retries
-                    and response
-                ):
-                    retries += 1
-                    history.append(
-                        {
-                            "role": "assistant",
-                            "content": response.choices[0].message.content,
-                        }
-                    )
-                    if not valid_specifiers:
-                        history.append(
-                            {
-                                "role": "user",
-                                "content": "Use the same format specifiers in the same order as the original.",
-                            }
-                        )
-                    else:
-                        history.append(
-                            {
-                                "role": "user",
-                                "content": "Make it shorter.",
-                            }
-                        )
-                    try:
-                        # max_tokens will truncate the generated response before sending it back to
-                        # us, so give it a bit more leeway by setting max_tokens = text_length * 2
-                        response = await get_chatgpt_response(
-                            history, text_length * 2, config
-                        )
-
-                        if str_type == StringType.IDENTIFIER and response:
-                            result = max(
-                                response.choices[0].message.content.split(), key=len
-                            )
-                        elif response:
-                            result = response.choices[0].message.content
-
-                        valid_specifiers = self._verify_specifiers(text, result)
-
-                    except OpenAIError as e:
-                        raise e
-
-            # No response with valid specifiers after all retries
-            if not self._verify_specifiers(text, result):
-                LOGGER.warning(f"Unable to request valid specifiers for {text}")
+            if not response or not response.choices:
+                string_metrics.failures.append("no_response")
                 return None
-            # ChatGPT will sometimes add non-ASCII characters like emojis even when asked not to
-            result = self._remove_unicode(result)
-            # Forcefully truncate response if it's still over the length req after all retries
-            return result[: text_length - 1]
+            string_metrics.failures.extend(
+                _get_failure_reasons(text, response, str_type)
+            )
+            best = _select_result(text, response, str_type, config, string_metrics)
+            violation = _describe_violation(text, best)
+            # As before, the first retry is not counted against config.max_retries
+            while violation and string_metrics.retries <= config.max_retries:
+                string_metrics.retries += 1
+                # Rather than resending the growing conversation, every retry is a fresh prompt
+                # with only the original, the best attempt so far and what is wrong with it, so
+                # each retry costs about as much as the first request
+                history = [
+                    {"role": "system", "content": _get_system_prompt(str_type, config)},
+                    {
+                        "role": "user",
+                        "content": _get_retry_prompt(text, best, violation),
+                    },
+                ]
+                response = await get_chatgpt_response(
+                    history, max_tokens, config, is_viable
+                )
+                if response and response.choices:
+                    string_metrics.failures.extend(
+                        _get_failure_reasons(text, response, str_type)
+                    )
+                    result = _select_result(
+                        text, response, str_type, config, string_metrics
+                    )
+                    if _is_better_result(text, result, best):
+                        best = result
+                else:
+                    string_metrics.failures.append("no_response")
+                violation = _describe_violation(text, best)
+
+            finalized = _finalize_result(text, best)
+            string_metrics.rewritten = bool(finalized)
+            return finalized
 
         except OpenAIError as e:
+            string_metrics.failures.append("api_error")
             # openai's error messages are rather unhelpful. Log traceback for additional details
             LOGGER.exception(f'Exception occurred, skipped "{text}"')
 
+        finally:
+            record_string(string_metrics)
+            if config.model_router is not None:
+                config.model_router.record(text, config.model, string_metrics.retries)
+
         return None
 
-    def _remove_unicode(self, text: str) -> str:
-        printable = set(string.printable)
-        return "".join(filter(lambda x: x in printable, text))
 
-    def _verify_specifiers(self, input_text: str, output_text: str) -> bool:
-        # Assumes original string has valid specifiers
-        input_specifiers = self._extract_specifiers(input_text)
-        output_specifiers = self._extract_specifiers(output_text)
+class ChatGPTBatchStringModifier(Modifier[ChatGPTBatchStringModifierConfig]):
+    """
+    Targets all [AsciiString][ofrak.core.strings.AsciiString] descendants of a resource over a
+    specified length, packs them into batched ChatGPT requests, and patches the rewritten strings
+    back into the binary. Only the strings which fail validation are sent again on retries.
+    """
+
+    targets = (GenericBinary,)
+
+    async def modify(
+        self,
+        resource: Resource,
+        config: ChatGPTBatchStringModifierConfig = ChatGPTBatchStringModifierConfig(),
+    ):
+        """
+        :param resource: the resource whose (already unpacked) string descendants should be
+            modified
+        """
+        # Firmware often holds the same string many times, so only request each text once and
+        # patch its rewrite into every copy
+        strings: Dict[str, List[AsciiString]] = {}
+        rewrites: List[Tuple[AsciiString, str]] = []
+        journal = _get_journal(config)
+        offsets: Dict[str, List[int]] = {}
+        triage = await triage_string_descendants(
+            resource,
+            config.min_length,
+            config.rewrite_categories,
+        )
+        LOGGER.info(f"Triaged strings: {triage}")
+        for string in triage.rewrite:
+            if journal is not None:
+                offset = (await string.resource.get_data_range_within_root()).start
+                result = journal.get(offset, string.Text)
+                if result is not None:
+                    rewrites.append((string, result))
+                    continue
+                offsets.setdefault(string.Text, []).append(offset)
+            if string.Text in strings:
+                strings[string.Text].append(string)
+            else:
+                strings[string.Text] = [string]
+        if journal is not None:
+            LOGGER.info(f"Replayed {len(rewrites)} rewrites from {journal.path}")
+
+        def on_rewrite(text: str, result: str):
+            if journal is not None:
+                for offset in offsets[text]:
+                    journal.append(offset, text, result)
+
+        texts = list(strings)
+        results = await rewrite_texts(texts, config, on_rewrite)
+        for text, result in zip(texts, results):
+            if result:
+                rewrites.extend((string, result) for string in strings[text])
+            for _ in strings[text][1:]:
+                record_string(
+                    StringMetrics(len(text), rewritten=bool(result), coalesced=True)
+                )
+
+        await self._patch_strings(resource, rewrites, config)
+
+    async def _patch_strings(
+        self,
+        resource: Resource,
+        rewrites: List[Tuple[AsciiString, str]],
+        config: ChatGPTBatchStringModifierConfig,
+    ):
+        start = time.perf_counter()
+        for string, result in rewrites:
+            LOGGER.debug(f"Original String: {string.Text}\nSassified String: {result}")
+        if config.bulk_patch:
+            patches = await get_string_patches(resource, rewrites)
+            await resource.run(
+                BulkStringPatchingModifier, BulkStringPatchingConfig(patches)
+            )
+        else:
+            for string, result in rewrites:
+                string_patch_config = StringPatchingConfig(
+                    offset=0, string=result, null_terminate=True
+                )
+                await string.resource.run(StringPatchingModifier, string_patch_config)
+        LOGGER.info(
+            f"Patched {len(rewrites)} strings in {time.perf_counter() - start:.3f}s "
+            f"({'bulk' if config.bulk_patch else 'per string'})"
+        )
+
+
+async def rewrite_texts(
+    texts: List[str],
+    config: ChatGPTBatchStringModifierConfig,
+    on_rewrite: Optional[Callable[[str, str], None]] = None,
+) -> List[Optional[str]]:
+    """
+    Rewrite distinct texts in batched requests, without patching them anywhere. Cached rewrites
+    are reused, and new ones are added to the cache.
+
+    :param texts: the texts to rewrite
+    :param config: the config of the requests
+    :param on_rewrite: called with each text and its rewrite as soon as the rewrite is accepted,
+        e.g. to journal it before the other batches complete
+
+    :return: the rewrite of each text, or None where no valid rewrite was found
+    """
+    cache = _get_cache(config)
+    configs = [_route(text, config) for text in texts]
+    results: List[Optional[str]] = [
+        cache.get(_get_cache_key(text, text_config)) if cache is not None else None
+        for text, text_config in zip(texts, configs)
+    ]
+    if on_rewrite is not None:
+        for text, result in zip(texts, results):
+            if result is not None:
+                on_rewrite(text, result)
+    # Strings routed to different models cannot share a request. The strings most worth rewriting
+    # are sent first, so that they are done if the run is cut short
+    pending: Dict[str, List[int]] = {}
+    for index in sorted(
+        range(len(texts)), key=lambda index: get_string_priority(texts[index])
+    ):
+        if results[index] is None:
+            pending.setdefault(configs[index].model, []).append(index)
+    batches = sorted(
+        (
+            indices[i : i + config.batch_size]
+            for indices in pending.values()
+            for i in range(0, len(indices), config.batch_size)
+        ),
+        key=lambda batch: get_string_priority(texts[batch[0]]),
+    )
+
+    async def rewrite_batch(batch: List[int]):
+        batch_config = configs[batch[0]]
+        batch_results = await _get_modified_strings(
+            [texts[index] for index in batch], batch_config
+        )
+        for index, result in zip(batch, batch_results):
+            results[index] = result
+            if result:
+                if cache is not None:
+                    cache.put(_get_cache_key(texts[index], batch_config), result)
+                if on_rewrite is not None:
+                    on_rewrite(texts[index], result)
+
+    if config.budget is None:
+        await asyncio.gather(*(rewrite_batch(batch) for batch in batches))
+        return results
+
+    jobs = []
+    for batch in batches:
+        batch_texts = [texts[index] for index in batch]
+        tokens, cost = _estimate_batch_usage(batch_texts, configs[batch[0]])
+        jobs.append(
+            RewriteJob(
+                batch_texts, tokens, cost, functools.partial(rewrite_batch, batch)
+            )
+        )
+    await config.budget.run(jobs)
+    LOGGER.info(config.budget)
+    return results
+
+
+async def _get_modified_strings(
+    texts: List[str],
+    config: ChatGPTBatchStringModifierConfig,
+) -> List[Optional[str]]:
+    """
+    Rewrite a batch of strings with as few requests as possible. Every string is sent in the
+    first request, then only the strings whose rewrite is too long or has mismatched
+    specifiers are sent again, up to `config.max_retries` times.
+    """
+    from openai.error import OpenAIError
+
+    candidates: List[Optional[str]] = [None] * len(texts)
+    string_metrics = [StringMetrics(len(text)) for text in texts]
+    pending = list(range(len(texts)))
+    retries = 0
+    while pending and retries <= config.max_retries:
+        history, max_tokens = _get_batch_request(texts, pending, candidates, config)
+        try:
+            response = await get_chatgpt_response(history, max_tokens, config)
+        except OpenAIError:
+            LOGGER.exception(
+                f"Exception occurred, skipped a batch of {len(pending)} strings"
+            )
+            for index in pending:
+                string_metrics[index].failures.append("api_error")
+            break
+        if retries > 0:
+            for index in pending:
+                string_metrics[index].retries += 1
+        retries += 1
+        if not response:
+            for index in pending:
+                string_metrics[index].failures.append("no_response")
+            continue
+
+        choice_replies = [
+            _parse_batch_content(choice.message.content) for choice in response.choices
+        ]
+        still_pending = []
+        for index in pending:
+            for replies in choice_replies:
+                reply = replies.get(str(index))
+                if not isinstance(reply, str):
+                    string_metrics[index].failures.append("no_response")
+                    continue
+                reason = _get_failure_reason(
+                    texts[index],
+                    _parse_content(reply, get_string_type(texts[index])),
+                )
+                if reason is not None:
+                    string_metrics[index].failures.append(reason)
+                result = _parse_result(
+                    texts[index],
+                    reply,
+                    get_string_type(texts[index]),
+                    config,
+                    string_metrics[index],
+                )
+                previous = candidates[index]
+                if previous is None or _is_better_result(
+                    texts[index], result, previous
+                ):
+                    candidates[index] = result
+            candidate = candidates[index]
+            if candidate is None or _describe_violation(texts[index], candidate):
+                still_pending.append(index)
+        pending = still_pending
+
+    results: List[Optional[str]] = []
+    for text, candidate, metrics in zip(texts, candidates, string_metrics):
+        if candidate is None:
+            LOGGER.warning(f"No response received for {text}")
+            results.append(None)
+        else:
+            results.append(_finalize_result(text, candidate))
+        metrics.rewritten = bool(results[-1])
+        record_string(metrics)
+        if config.model_router is not None:
+            config.model_router.record(text, config.model, metrics.retries)
+    return results
+
+
+# Rewrites currently being requested, by their string and the full config they are requested with
+_IN_FLIGHT_REWRITES: Dict[Tuple[str, str], "asyncio.Future[Optional[str]]"] = {}
+
+
+async def _get_rewrite_once(
+    text: str,
+    config: ChatGPTStringModifierConfig,
+    get_rewrite: Callable[[], Awaitable[Optional[str]]],
+) -> Optional[str]:
+    """
+    Request a rewrite unless an identical rewrite is already being requested, in which case wait for
+    that one instead. Identical strings in different resources, which are modified concurrently
+    with the same config, then share one rewrite.
+    """
+    # Unlike the cache key, which only covers what ChatGPT is asked to do, every field of the config
+    # counts, since e.g. `num_choices` or `max_retries` change the result. Fields without a
+    # meaningful repr, like a backend, are compared by identity
+    key = (text, repr(config))
+    while key in _IN_FLIGHT_REWRITES:
+        future = _IN_FLIGHT_REWRITES[key]
+        try:
+            # Shielded so that cancelling one waiter does not cancel the rewrite for the others
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # The request was cancelled rather than this waiter, so request it again
+                continue
+            raise
+        record_string(StringMetrics(len(text), rewritten=bool(result), coalesced=True))
+        return result
+
+    future = asyncio.get_running_loop().create_future()
+    _IN_FLIGHT_REWRITES[key] = future
+    try:
+        result = await get_rewrite()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved, since there may be no waiters to retrieve it
+        future.exception()
+        raise
+    finally:
+        del _IN_FLIGHT_REWRITES[key]
+    future.set_result(result)
+    return result
+
+
+def _get_encoding(config: ChatGPTStringModifierConfig) -> "Encoding":
+    # An encoding configured for `model` may not be the encoding of the model a router picked
+    if config.encoding is not None and config.model_router is None:
+        return config.encoding
+    return get_encoding(config.model)
+
+
+def _get_max_tokens(text: str, config: ChatGPTStringModifierConfig) -> int:
+    """
+    Count the tokens of a reply which uses all of the characters it is allowed, plus the allowed
+    overshoot. A reply as long as its original tokenizes about as densely, so the budget is the
+    number of tokens of the original in the encoding of the model the string is sent to.
+    """
+    num_tokens = len(_get_encoding(config).encode(text))
+    return math.ceil(num_tokens * (1 + config.max_tokens_overshoot))
+
+
+def _get_batch_max_tokens(
+    index: int, text: str, config: ChatGPTStringModifierConfig
+) -> int:
+    """
+    Bound the tokens of the entry of a batch reply for a string: its rewrite as a JSON string,
+    whose escapes take extra characters, keyed by its id, whose tokens are counted in the encoding
+    of the model the batch is sent to.
+    """
+    key_tokens = len(_get_encoding(config).encode(json.dumps({str(index): ""})))
+    return _get_max_tokens(json.dumps(text)[1:-1], config) + key_tokens
+
+
+def _route(text: str, config: ConfigT) -> ConfigT:
+    if config.model_router is None:
+        return config
+    model = config.model_router.route(text)
+    if model == config.model:
+        return config
+    return dataclasses.replace(config, model=model)
+
+
+def _get_cache(config: ChatGPTStringModifierConfig) -> Optional[StringRewriteCache]:
+    if config.cache_path is None:
+        return None
+    return get_string_rewrite_cache(
+        config.cache_path, config.cache_max_entries, config.cache_max_age
+    )
+
+
+def _get_journal(config: ChatGPTStringModifierConfig) -> Optional[RewriteJournal]:
+    if config.journal_path is None:
+        return None
+    return get_rewrite_journal(config.journal_path)
+
+
+def _get_cache_key(text: str, config: ChatGPTStringModifierConfig) -> str:
+    # Address rewrites by everything that influences what ChatGPT is asked to do
+    key = {
+        "text": text,
+        "voice": [config.voice.voice_noun, config.voice.voice_adjective],
+        "model": config.model,
+        "temperature": config.temperature,
+        "prompt_parts": {
+            str_type.name: part for str_type, part in config.prompt_parts.items()
+        },
+        "min_length": config.min_length,
+        "system_message": config.system_message,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_string_type(text: str) -> StringType:
+    """
+    :return: the type of string `text` is rewritten as, which decides the instructions it is sent
+        with
+    """
+    # Assume strings without spaces must remain space-free
+    if " " not in text:
+        return StringType.IDENTIFIER
+    return StringType.SENTENCE
+
+
+def _get_batch_request(
+    texts: List[str],
+    pending: List[int],
+    candidates: List[Optional[str]],
+    config: ChatGPTStringModifierConfig,
+) -> Tuple[List[Dict[str, str]], int]:
+    """
+    :return: the history and max_tokens of a request for the `pending` strings of a batch
+    """
+    entries = [
+        _get_batch_entry(index, texts[index], candidates[index]) for index in pending
+    ]
+    max_tokens = sum(
+        _get_batch_max_tokens(index, texts[index], config) for index in pending
+    )
+    history = [
+        {"role": "system", "content": _get_batch_prompt(config)},
+        {"role": "user", "content": json.dumps(entries)},
+    ]
+    return history, max_tokens
+
+
+def _estimate_batch_usage(
+    texts: List[str], config: ChatGPTStringModifierConfig
+) -> Tuple[int, float]:
+    """
+    :return: the tokens and cost of the first request for a batch, assuming every reply uses all
+        of its max_tokens
+    """
+    history, max_tokens = _get_batch_request(
+        texts, list(range(len(texts))), [None] * len(texts), config
+    )
+    prompt_tokens = count_prompt_tokens(history, config.model)
+    completion_tokens = max_tokens * config.num_choices
+    return prompt_tokens + completion_tokens, estimate_cost(
+        config.model, prompt_tokens, completion_tokens
+    )
+
+
+def _get_batch_entry(
+    index: int, text: str, previous: Optional[str]
+) -> Dict[str, Union[int, str]]:
+    entry: Dict[str, Union[int, str]] = {
+        "id": index,
+        "type": get_string_type(text).name.lower(),
+        "max_length": len(text),
+        "text": text,
+    }
+    if previous is not None:
+        # Tell ChatGPT what was wrong with its last attempt rather than starting over
+        entry["previous"] = previous[: 2 * len(text)]
+        entry["problem"] = _describe_violation(text, previous) or ""
+    return entry
+
+
+def get_string_request(
+    text: str, config: ChatGPTStringModifierConfig
+) -> List[Dict[str, str]]:
+    """
+    :return: the messages of the first request
+        [ChatGPTStringModifier][ofrak_ai.chatgpt_string_modifier.ChatGPTStringModifier] sends to
+        rewrite `text`
+    """
+    # Only the string changes between requests, everything else is in the system message
+    return [
+        {
+            "role": "system",
+            "content": _get_system_prompt(get_string_type(text), config),
+        },
+        {"role": "user", "content": text},
+    ]
+
+
+def _get_system_prompt(
+    str_type: StringType, config: ChatGPTStringModifierConfig
+) -> str:
+    return _build_system_prompt(
+        config.voice.voice_noun,
+        config.voice.voice_adjective,
+        config.prompt_parts.get(str_type, ""),
+        config.system_message,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _build_system_prompt(
+    voice_noun: Optional[str],
+    voice_adjective: Optional[str],
+    prompt_part: str,
+    system_message: Optional[str],
+) -> str:
+    # The instructions only depend on the voice and string type, so every request for the same
+    # kind of string shares one system message, which is built once
+    prompt = (
+        f"You are a {voice_noun}. Make each message I send more {voice_adjective}. "
+        "It is EXTREMELY important that your version is no longer than the original and "
+        f"contains only ASCII characters. {_compact(prompt_part)}"
+        "Respond with your version only."
+    )
+    if system_message:
+        prompt += f"\n{system_message}"
+    return prompt
+
+
+def _get_batch_prompt(config: ChatGPTStringModifierConfig) -> str:
+    return _build_batch_prompt(
+        config.voice.voice_noun,
+        config.voice.voice_adjective,
+        config.prompt_parts.get(StringType.IDENTIFIER, ""),
+        config.prompt_parts.get(StringType.SENTENCE, ""),
+        config.system_message,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _build_batch_prompt(
+    voice_noun: Optional[str],
+    voice_adjective: Optional[str],
+    identifier_part: str,
+    sentence_part: str,
+    system_message: Optional[str],
+) -> str:
+    prompt = (
+        f"You are a {voice_noun}. "
+        "I will send a JSON list of messages, each with an id, a type, a max_length and a text. "
+        "You will respond with a single JSON object mapping each id to the text of its message "
+        f"made more {voice_adjective}. "
+        "It is EXTREMELY important that each of your versions is no longer than its max_length "
+        "and contains only ASCII characters. "
+        f"For messages of type identifier: {_compact(identifier_part)}"
+        f"For messages of type sentence: {_compact(sentence_part)}"
+        "Messages with a previous and a problem were already rewritten once; fix the problem. "
+        "Respond with the JSON object only."
+    )
+    if system_message:
+        prompt += f"\n{system_message}"
+    return prompt
+
+
+def _compact(prompt_part: str) -> str:
+    # Prompt parts may be written across several lines of source, so collapse their indentation
+    if not prompt_part.strip():
+        return ""
+    return " ".join(prompt_part.split()) + " "
+
+
+def _parse_batch_content(content: str) -> Dict[str, str]:
+    # ChatGPT sometimes wraps the JSON object in commentary or a code block, so only parse what is
+    # between the outermost braces
+    start = content.find("{")
+    end = content.rfind("}")
+    if start == -1 or end < start:
+        return {}
+    try:
+        replies = json.loads(content[start : end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(replies, dict):
+        return {}
+    return {str(key): value for key, value in replies.items()}
+
+
+def _parse_content(content: str, str_type: StringType) -> str:
+    # Handle identifier and sentence lengths the same way
+    if str_type == StringType.IDENTIFIER:
+        # Since ChatGPT likes to add commentary, assume the longest word in the response is the
+        # sassified input
+        return max(content.split(), key=len, default="")
+    return content
+
+
+def _parse_result(
+    text: str,
+    content: str,
+    str_type: StringType,
+    config: ChatGPTStringModifierConfig,
+    metrics: StringMetrics,
+) -> str:
+    result = _parse_content(content, str_type)
+    if config.local_repair and _describe_violation(text, result):
+        repaired = _repair_result(text, result, str_type)
+        if repaired is not None:
+            metrics.repairs += 1
+            return repaired
+    return result
+
+
+def _is_viable_result(
+    text: str, str_type: StringType, config: ChatGPTStringModifierConfig, content: str
+) -> bool:
+    """
+    Check whether a partial reply can still become valid once it is complete, so that a streamed
+    reply can be abandoned early.
+    """
+    result = _parse_content(content, str_type)
+    specifiers = _extract_specifiers(text)
+    result_specifiers = _extract_specifiers(result)
+    if config.local_repair:
+        # Local repair can trim a reply to a boundary and restore the order of its specifiers, but
+        # it is not worth waiting for a reply more than twice as long as the original
+        return len(result) <= 2 * len(text) and len(result_specifiers) <= len(
+            specifiers
+        )
+    return (
+        len(result) <= len(text)
+        and result_specifiers == specifiers[: len(result_specifiers)]
+    )
+
+
+def _repair_result(text: str, result: str, str_type: StringType) -> Optional[str]:
+    """
+    Deterministically fix a reply which is too long or has misordered specifiers, by removing
+    non-ASCII characters, restoring the original specifiers, dropping filler words and trimming it
+    at a sentence or word boundary.
+
+    :return: the repaired reply, or None if it could not be repaired
+    """
+    max_length = len(text)
+    repaired = _reorder_specifiers(text, _remove_unicode(result))
+    if repaired is None:
+        return None
+    if str_type == StringType.SENTENCE:
+        while len(repaired) > max_length:
+            shorter = FILLER_PATTERN.sub("", repaired, count=1)
+            if shorter == repaired:
+                break
+            repaired = shorter
+    if len(repaired) > max_length:
+        trimmed = _trim_to_boundary(text, repaired, str_type)
+        if trimmed is None:
+            return None
+        repaired = trimmed
+    if _describe_violation(text, repaired):
+        return None
+    return repaired
+
+
+def _reorder_specifiers(text: str, result: str) -> Optional[str]:
+    # Put the original specifiers back in their original order, as long as the reply has as many
+    # specifiers as the original
+    specifiers = _extract_specifiers(text)
+    matches = list(SPECIFIER_PATTERN.finditer(result))
+    if len(matches) != len(specifiers):
+        return None
+    parts = []
+    end = 0
+    for match, specifier in zip(matches, specifiers):
+        parts.append(result[end : match.start(2)])
+        parts.append(specifier)
+        end = match.end(2)
+    parts.append(result[end:])
+    return "".join(parts)
+
+
+def _trim_to_boundary(text: str, result: str, str_type: StringType) -> Optional[str]:
+    max_length = len(text)
+    if str_type == StringType.SENTENCE:
+        sentence_ends = [i + 1 for i, c in enumerate(result[:max_length]) if c in ".!?"]
+        # Only cut whole sentences if that does not throw away most of the reply
+        for end in reversed(sentence_ends):
+            if end >= max_length // 2 and _verify_specifiers(text, result[:end]):
+                return result[:end]
+        word_ends = [i for i, c in enumerate(result) if c == " "]
+        strip = " ,;:-"
+    else:
+        # Identifiers have no spaces, so cut them between camel case or snake case words instead
+        word_ends = [i for i, c in enumerate(result) if c.isupper() or c == "_"]
+        strip = "_"
+    for end in reversed(word_ends):
+        trimmed = result[:end].rstrip(strip)
+        if trimmed and len(trimmed) <= max_length and _verify_specifiers(text, trimmed):
+            return trimmed
+    return None
+
+
+def _describe_violation(text: str, result: str) -> Optional[str]:
+    reason = _get_failure_reason(text, result)
+    if reason == "specifiers":
+        return "Use the same format specifiers in the same order as the original."
+    if reason == "length":
+        return f"Make it shorter, it is {len(result) - len(text)} characters too long."
+    return None
+
+
+def _get_failure_reason(text: str, result: str) -> Optional[str]:
+    if not _verify_specifiers(text, result):
+        return "specifiers"
+    if len(result) > len(text):
+        return "length"
+    return None
+
+
+def _get_failure_reasons(
+    text: str, response: "OpenAIObject", str_type: StringType
+) -> List[str]:
+    # Why each reply failed validation as it was received, i.e. before any local repair
+    reasons = (
+        _get_failure_reason(text, _parse_content(choice.message.content, str_type))
+        for choice in response.choices
+    )
+    return [reason for reason in reasons if reason is not None]
+
+
+def _select_result(
+    text: str,
+    response: "OpenAIObject",
+    str_type: StringType,
+    config: ChatGPTStringModifierConfig,
+    metrics: StringMetrics,
+) -> str:
+    # With config.num_choices > 1, pick the best of several replies to one request instead of
+    # asking again for each invalid reply
+    results = [
+        _parse_result(text, choice.message.content, str_type, config, metrics)
+        for choice in response.choices
+    ]
+    return max(results, key=lambda result: _score_result(text, result))
+
+
+def _is_better_result(text: str, result: str, best: str) -> bool:
+    return _score_result(text, result) > _score_result(text, best)
+
+
+def _score_result(text: str, result: str) -> Tuple[bool, bool, int, int]:
+    # Prefer results with valid specifiers, then ASCII-only results, then the results closest to
+    # fitting, then the longest of the results that fit, which keep the most of their content
+    overflow = len(result) - len(text)
+    return (
+        _verify_specifiers(text, result),
+        result.isascii(),
+        -max(overflow, 0),
+        len(result) if overflow <= 0 else 0,
+    )
+
+
+def _get_retry_prompt(text: str, best: str, violation: str) -> str:
+    # A rambling attempt only needs to be shown up to about the length of the original to show
+    # ChatGPT what to fix, so cap it to keep the prompt size bounded by the original's size
+    best = best[: 2 * len(text)]
+    # The system message only explains how to rewrite a message, so say how to read this one
+    return (
+        "Fix the problem with your previous version of the original message. Respond with your "
+        f"new version only, in at most {len(text)} characters.\n"
+        f"Original message: {text}\n"
+        f"Your previous version: {best}\n"
+        f"Problem with your previous version: {violation}"
+    )
+
+
+def _finalize_result(text: str, result: str) -> Optional[str]:
+    # ChatGPT will sometimes add non-ASCII characters like emojis even when asked not to
+    result = _remove_unicode(result)
+    # Forcefully truncate response if it's still over the length req after all retries. The data
+    # range of the string already holds its null terminator, so the whole length is available
+    result = result[: len(text)]
+    # No response with valid specifiers after all retries, or truncating cut a specifier off
+    if not _verify_specifiers(text, result):
+        LOGGER.warning(f"Unable to request valid specifiers for {text}")
+        return None
+    return result
+
+
+def _remove_unicode(text: str) -> str:
+    printable = set(string.printable)
+    return "".join(filter(lambda x: x in printable, text))
+
+
+def _verify_specifiers(input_text: str, output_text: str) -> bool:
+    # Assumes original string has valid specifiers
+    input_specifiers = _extract_specifiers(input_text)
+    output_specifiers = _extract_specifiers(output_text)
+
+    return input_specifiers == output_specifiers
 
-        return input_specifiers == output_specifiers
 
-    def _extract_specifiers(self, text: str) -> List[str]:
-        # Capture odd number of occurrences of % (unescaped % signs) and all text non-greedily
-        # until a valid format specifier is found
-        matches = SPECIFIER_PATTERN.findall(text)
+def _extract_specifiers(text: str) -> List[str]:
+    # Capture odd number of occurrences of % (unescaped % signs) and all text non-greedily until a
+    # valid format specifier is found
+    matches = SPECIFIER_PATTERN.findall(text)
 
-        return [match[1] for match in matches]
+    return [match[1] for match in matches]
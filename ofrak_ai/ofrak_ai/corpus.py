@@ -0,0 +1,408 @@
+"""
+Rewrite the strings of every firmware image in a directory.
+
+OFRAK unpacking and packing is CPU-bound, so images are unpacked, patched and packed in a pool of
+worker processes. Their strings are all sent to ChatGPT through one
+[RewriteQueue][ofrak_ai.corpus.RewriteQueue] in the main process, which batches strings across
+images, requests each distinct string once, and shares the API quota between every image.
+
+Run `python -m ofrak_ai.corpus --help` for the available options.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from dataclasses import asdict, dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import ofrak_ai
+from ofrak import OFRAK, OFRAKContext, Resource
+from ofrak.core.strings import AsciiString
+from ofrak_ai.chatgpt_string_modifier import (
+    ChatGPTBatchStringModifierConfig,
+    VoiceType,
+    rewrite_texts,
+)
+from ofrak_ai.string_patching import (
+    BulkStringPatchingConfig,
+    BulkStringPatchingModifier,
+    get_string_patches,
+)
+from ofrak_ai.string_triage import StringCategory, triage_string_descendants
+
+if TYPE_CHECKING:
+    from multiprocessing.queues import Queue
+
+LOGGER = logging.getLogger(__name__)
+
+ImageLoader = Callable[[OFRAKContext, str], Awaitable[Resource]]
+
+
+@dataclass
+class ImageResult:
+    """
+    :param path: the path of the image
+    :param output_path: the path the rewritten image was written to, or None if it failed
+    :param strings: the number of strings worth rewriting found in the image
+    :param rewritten: the number of strings patched
+    :param unpack_seconds: the time spent unpacking the image and triaging its strings
+    :param rewrite_seconds: the time spent waiting for the image's rewrites
+    :param pack_seconds: the time spent patching, packing and writing the image
+    :param seconds: the total time spent on the image, including waiting for a worker
+    :param error: a description of the error the image failed with, or None if it succeeded
+    """
+
+    path: str
+    output_path: Optional[str] = None
+    strings: int = 0
+    rewritten: int = 0
+    unpack_seconds: float = 0.0
+    rewrite_seconds: float = 0.0
+    pack_seconds: float = 0.0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            return f"{self.path}: failed after {self.seconds:.2f}s: {self.error}"
+        return (
+            f"{self.path} -> {self.output_path}: {self.rewritten}/{self.strings} strings "
+            f"rewritten, unpack {self.unpack_seconds:.2f}s, rewrite "
+            f"{self.rewrite_seconds:.2f}s, pack {self.pack_seconds:.2f}s, total "
+            f"{self.seconds:.2f}s"
+        )
+
+
+class RewriteQueue:
+    """
+    Rewrite the strings of many images through one pipeline. Strings are packed into batches of
+    `config.batch_size` regardless of the image they came from, at most `concurrency` batches are
+    in flight at once, and a string found in several images is only requested once.
+
+    :param config: the config of the requests
+    :param concurrency: the maximum number of batches to request at once
+    """
+
+    def __init__(self, config: ChatGPTBatchStringModifierConfig, concurrency: int = 16):
+        self.config = config
+        self.concurrency = concurrency
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._rewrites: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+        self._workers: List["asyncio.Task[None]"] = []
+
+    async def rewrite(self, texts: Sequence[str]) -> Dict[str, Optional[str]]:
+        """
+        :param texts: the texts to rewrite
+
+        :return: the rewrite of each distinct text, or None where no valid rewrite was found
+        """
+        if not self._workers:
+            self._workers = [
+                asyncio.ensure_future(self._run()) for _ in range(self.concurrency)
+            ]
+        loop = asyncio.get_running_loop()
+        for text in texts:
+            if text not in self._rewrites:
+                self._rewrites[text] = loop.create_future()
+                self._queue.put_nowait(text)
+        return {text: await self._rewrites[text] for text in texts}
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.config.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                results = await rewrite_texts(batch, self.config)
+            except Exception:
+                LOGGER.exception(f"Exception occurred, skipped {len(batch)} strings")
+                results = [None] * len(batch)
+            for text, result in zip(batch, results):
+                self._rewrites[text].set_result(result)
+
+
+async def load_image(ofrak_context: OFRAKContext, path: str) -> Resource:
+    """
+    The default way images are loaded: identified and unpacked recursively.
+    """
+    resource = await ofrak_context.create_root_resource_from_file(path)
+    await resource.unpack_recursively()
+    return resource
+
+
+@dataclass
+class _ImageJob:
+    path: str
+    output_path: str
+    min_length: int
+    rewrite_categories: FrozenSet[StringCategory]
+    load: ImageLoader = field(default=load_image)
+
+
+@dataclass
+class _Worker:
+    """
+    The state of a worker process, which is kept for the lifetime of the process so that OFRAK
+    components are only discovered once.
+
+    :param loop: the event loop images are processed on
+    :param ofrak_context: the OFRAK context images are processed in
+    :param requests: the queue of (worker slot, texts) requests to the main process
+    :param replies: the queue of rewrites from the main process to this worker
+    :param slot: the index of this worker's reply queue
+    """
+
+    loop: asyncio.AbstractEventLoop
+    ofrak_context: OFRAKContext
+    requests: "Queue[Optional[Tuple[int, List[str]]]]"
+    replies: "Queue[Dict[str, Optional[str]]]"
+    slot: int
+
+
+_WORKER: Optional[_Worker] = None
+
+
+def _init_worker(
+    logging_level: int,
+    requests: "Queue[Optional[Tuple[int, List[str]]]]",
+    replies: "List[Queue[Dict[str, Optional[str]]]]",
+    slots: "Queue[int]",
+):
+    global _WORKER
+
+    ofrak = OFRAK(logging_level)
+    ofrak.discover(ofrak_ai)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ofrak_context = loop.run_until_complete(ofrak.create_ofrak_context())
+    slot = slots.get()
+    _WORKER = _Worker(loop, ofrak_context, requests, replies[slot], slot)
+
+
+def _process_image(job: _ImageJob) -> ImageResult:
+    assert _WORKER is not None
+    return _WORKER.loop.run_until_complete(_process_image_async(_WORKER, job))
+
+
+async def _process_image_async(worker: _Worker, job: _ImageJob) -> ImageResult:
+    result = ImageResult(job.path)
+    start = time.perf_counter()
+    resource = await job.load(worker.ofrak_context, job.path)
+    triage = await triage_string_descendants(
+        resource,
+        job.min_length,
+        job.rewrite_categories,
+    )
+    result.strings = len(triage.rewrite)
+    unpacked = time.perf_counter()
+    result.unpack_seconds = unpacked - start
+
+    # Blocking on the queues is fine, since nothing else runs on this worker's event loop
+    texts = list(dict.fromkeys(string.Text for string in triage.rewrite))
+    worker.requests.put((worker.slot, texts))
+    rewrites = worker.replies.get()
+    received = time.perf_counter()
+    result.rewrite_seconds = received - unpacked
+
+    patches: List[Tuple[AsciiString, str]] = []
+    for string in triage.rewrite:
+        rewrite = rewrites.get(string.Text)
+        if rewrite:
+            patches.append((string, rewrite))
+    await resource.run(
+        BulkStringPatchingModifier,
+        BulkStringPatchingConfig(await get_string_patches(resource, patches)),
+    )
+    await resource.pack_recursively()
+    await resource.flush_to_disk(job.output_path)
+    result.rewritten = len(patches)
+    result.output_path = job.output_path
+    result.pack_seconds = time.perf_counter() - received
+    # Free the image's resources before the worker moves on to the next one
+    await resource.delete()
+    await resource.save()
+    return result
+
+
+async def process_corpus(
+    paths: Sequence[str],
+    output_dir: str,
+    config: ChatGPTBatchStringModifierConfig,
+    workers: Optional[int] = None,
+    concurrency: int = 16,
+    load: ImageLoader = load_image,
+    logging_level: int = logging.WARNING,
+) -> List[ImageResult]:
+    """
+    Rewrite the strings of many images and write the results to `output_dir` under the same
+    file names.
+
+    :param paths: the paths of the images
+    :param output_dir: the directory to write the rewritten images to
+    :param config: the config of the string rewrites
+    :param workers: the number of worker processes, or None for one per CPU
+    :param concurrency: the maximum number of batches of strings to request at once
+    :param load: a module-level function which creates and unpacks the resource of an image
+    :param logging_level: the logging level of the worker processes
+
+    :return: the result of each image, in the order of `paths`
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    queue = RewriteQueue(config, concurrency)
+    start = time.perf_counter()
+    # Forking would copy this process's event loop and threads into the workers
+    context = multiprocessing.get_context("spawn")
+    workers = workers or os.cpu_count() or 1
+    # Every worker has its own reply queue, which it claims a slot for when it starts
+    requests: "Queue[Optional[Tuple[int, List[str]]]]" = context.Queue()
+    replies: "List[Queue[Dict[str, Optional[str]]]]" = [
+        context.Queue() for _ in range(workers)
+    ]
+    slots: "Queue[int]" = context.Queue()
+    for slot in range(workers):
+        slots.put(slot)
+
+    async def reply(slot: int, texts: List[str]):
+        replies[slot].put(await queue.rewrite(texts))
+
+    async def serve_requests():
+        tasks = []
+        while True:
+            request = await loop.run_in_executor(None, requests.get)
+            if request is None:
+                break
+            tasks.append(asyncio.ensure_future(reply(*request)))
+        await asyncio.gather(*tasks)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        workers,
+        context,
+        initializer=_init_worker,
+        initargs=(logging_level, requests, replies, slots),
+    ) as executor:
+
+        async def run_job(job: _ImageJob) -> ImageResult:
+            try:
+                result = await asyncio.wrap_future(executor.submit(_process_image, job))
+            except Exception as e:
+                LOGGER.exception(f"Exception occurred, skipped {job.path}")
+                result = ImageResult(job.path, error=f"{type(e).__name__}: {e}")
+            result.seconds = time.perf_counter() - start
+            return result
+
+        server = asyncio.ensure_future(serve_requests())
+        try:
+            results = await asyncio.gather(
+                *(
+                    run_job(
+                        _ImageJob(
+                            path,
+                            os.path.join(output_dir, os.path.basename(path)),
+                            config.min_length,
+                            config.rewrite_categories,
+                            load,
+                        )
+                    )
+                    for path in paths
+                )
+            )
+        finally:
+            requests.put(None)
+            await server
+            await queue.close()
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """
+    :return: the exit status, which is 1 if any image failed
+    """
+    parser = argparse.ArgumentParser(
+        description="Rewrite the strings of every firmware image in a directory with ChatGPT"
+    )
+    parser.add_argument("input_dir", help="the directory of the images to rewrite")
+    parser.add_argument(
+        "output_dir", help="the directory to write the rewritten images to"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="the number of worker processes unpacking and packing images, one per CPU by "
+        "default",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="the maximum number of batches of strings requested at once",
+    )
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--min-length", type=int, default=50)
+    parser.add_argument("--model", default=ChatGPTBatchStringModifierConfig.model)
+    parser.add_argument(
+        "--voice",
+        choices=[voice.name.lower() for voice in VoiceType],
+        default=VoiceType.SASSY.name.lower(),
+    )
+    parser.add_argument(
+        "--cache-path", help="a SQLite database to cache rewrites in across runs"
+    )
+    parser.add_argument(
+        "--report", help="a path to write the result of every image to as JSON"
+    )
+    args = parser.parse_args(argv)
+
+    paths = sorted(
+        os.path.join(args.input_dir, name)
+        for name in os.listdir(args.input_dir)
+        if os.path.isfile(os.path.join(args.input_dir, name))
+    )
+    config = ChatGPTBatchStringModifierConfig(
+        model=args.model,
+        batch_size=args.batch_size,
+        min_length=args.min_length,
+        voice=VoiceType[args.voice.upper()].value,
+        cache_path=args.cache_path,
+    )
+    start = time.perf_counter()
+    results = asyncio.run(
+        process_corpus(paths, args.output_dir, config, args.workers, args.concurrency)
+    )
+    for result in results:
+        print(result)
+    failed = sum(result.error is not None for result in results)
+    print(
+        f"Processed {len(results)} images ({failed} failed) in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
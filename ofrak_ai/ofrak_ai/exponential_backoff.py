@@ -1,79 +0,0 @@
-"""
-MIT License
-
-Copyright (c) 2023 OpenAI
-
-Permission is hereby granted, free of charge, to any person obtaining a copy
-of this software and associated documentation files (the "Software"), to deal
-in the Software without restriction, including without limitation the rights
-to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-copies of the Software, and to permit persons to whom the Software is
-furnished to do so, subject to the following conditions:
-
-The above copyright notice and this permission notice shall be included in all
-copies or substantial portions of the Software.
-
-THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-SOFTWARE.
-"""
-
-import asyncio
-import functools
-import random
-
-from openai.error import RateLimitError, OpenAIError
-
-# Modified from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_handle_rate_limits.ipynb
-def retry_with_exponential_backoff(
-    func,
-    initial_delay: float = 1,
-    exponential_base: float = 2,
-    jitter: bool = True,
-    max_retries: int = 10,
-    errors: tuple = (RateLimitError,),
-):
-    """
-    Retry a function with exponential backoff.
-
-    AuthenticationError is NOT raised when the OPENAI_ORGANIZATION value is incorrect or missing.
-    Instead, the OpenAI API treats it as a RateLimitError.
-
-    :raises OpenAIError: if unable to make a valid request or receive a response from ChatGPT
-    """
-
-    @functools.wraps(func)
-    async def wrapper(*args, **kwargs):
-        if exponential_base < 1:
-            raise Exception(
-                f"Backoff must exponentially increase, {exponential_base} must be greater than or equal to 1."
-            )
-        num_retries = 0
-        delay = initial_delay
-
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while num_retries < max_retries:
-            try:
-                return await func(*args, **kwargs)
-
-            # Retry on specified errors
-            except errors as e:
-                num_retries += 1
-
-                if num_retries >= max_retries:
-                    raise OpenAIError(
-                        message=f"Maximum number of retries ({max_retries}) exceeded."
-                    )
-
-                delay *= exponential_base * (1 + jitter * random.random())
-                await asyncio.sleep(delay)
-
-            # Raise exceptions for any errors not specified
-            except OpenAIError as e:
-                raise e
-
-    return wrapper
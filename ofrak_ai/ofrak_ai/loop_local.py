@@ -0,0 +1,56 @@
+import asyncio
+
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class LoopLocal(Generic[T]):
+    """
+    A value bound to the event loop it was created in, which is created again by `factory` when it
+    is used from another event loop. Locks, semaphores, events and aiohttp sessions can only be used
+    from the event loop they were created in, but the limiters, backends and budgets holding them
+    outlive event loops (e.g. one per test, or one per image in a corpus worker).
+
+    :param factory: creates the value for the running event loop
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self.factory = factory
+        self._value: Optional[T] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def value(self) -> Optional[T]:
+        """
+        The current value, whichever event loop it was created in, or None if there is none.
+        """
+        return self._value
+
+    def get(self) -> T:
+        """
+        :return: the value of the running event loop, which is created if there is none yet
+        """
+        loop = asyncio.get_running_loop()
+        if self._value is None or self._loop is not loop:
+            self._value = self.factory()
+            self._loop = loop
+        return self._value
+
+    def is_current(self) -> bool:
+        """
+        :return: True if there is a value and it was created in the running event loop
+        """
+        return self._value is not None and self._loop is asyncio.get_running_loop()
+
+    def discard(self) -> Optional[T]:
+        """
+        Forget the current value, so that the next [get][ofrak_ai.loop_local.LoopLocal.get] creates
+        a new one.
+
+        :return: the discarded value, e.g. to close it, or None if there was none
+        """
+        value = self._value
+        self._value = None
+        self._loop = None
+        return value
@@ -0,0 +1,402 @@
+import collections
+import math
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class CallMetrics:
+    """
+    Measurements of one call to the OpenAI API, including every attempt made after retryable
+    errors and every hedged attempt.
+
+    :param model: the model the call was sent to
+    :param queue_wait: the number of seconds spent waiting for the client-side rate limiter
+    :param latency: the number of seconds spent waiting for the API to respond
+    :param backoff: the number of seconds slept between attempts after retryable errors
+    :param retries: the number of attempts made after the first one failed
+    :param hedges: the number of duplicate attempts made because an attempt was unusually slow
+    :param prompt_tokens: the number of prompt tokens used
+    :param completion_tokens: the number of completion tokens used
+    :param cost: the estimated cost of the call in US dollars
+    :param error: the name of the error the call failed with, or None if it succeeded
+    """
+
+    model: str
+    queue_wait: float = 0.0
+    latency: float = 0.0
+    backoff: float = 0.0
+    retries: int = 0
+    hedges: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class StringMetrics:
+    """
+    Measurements of the rewrite of one string.
+
+    :param length: the length of the original string
+    :param retries: the number of times the string was sent again because its rewrite was invalid
+    :param failures: the reason each rewrite of the string failed validation, e.g. "length" or
+        "specifiers"
+    :param rewritten: True if a rewrite was patched in
+    :param repairs: the number of invalid rewrites of the string which were fixed locally instead of
+        sent again
+    :param coalesced: True if the string shared the rewrite of an identical string instead of being
+        requested on its own
+    """
+
+    length: int
+    retries: int = 0
+    failures: List[str] = field(default_factory=list)
+    rewritten: bool = False
+    repairs: int = 0
+    coalesced: bool = False
+
+
+class MetricsHook:
+    """
+    Receives the measurements of every API call, string rewrite and rewrite cache lookup once it is
+    registered with [add_metrics_hook][ofrak_ai.metrics.add_metrics_hook]. Subclasses override the
+    methods for the measurements they are interested in.
+    """
+
+    def record_call(self, metrics: CallMetrics):
+        pass
+
+    def record_string(self, metrics: StringMetrics):
+        pass
+
+    def record_cache_lookup(self, hit: bool):
+        """
+        :param hit: True if the rewrite cache held a rewrite of the string
+        """
+        pass
+
+
+class MetricsRecorder(MetricsHook):
+    """
+    Aggregate measurements into a run summary, which can be printed with
+    [summary][ofrak_ai.metrics.MetricsRecorder.summary] or exported in the Prometheus text format
+    with [to_prometheus][ofrak_ai.metrics.MetricsRecorder.to_prometheus].
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = collections.Counter()
+        self.errors: Dict[Tuple[str, str], int] = collections.Counter()
+        self.prompt_tokens: Dict[str, int] = collections.Counter()
+        self.completion_tokens: Dict[str, int] = collections.Counter()
+        self.cost: Dict[str, float] = collections.defaultdict(float)
+        self.latencies: List[float] = []
+        self.queue_waits: List[float] = []
+        self.backoff = 0.0
+        self.call_retries = 0
+        self.hedges = 0
+        self.strings = 0
+        self.rewritten = 0
+        self.string_retries: Dict[int, int] = collections.Counter()
+        self.repairs = 0
+        self.coalesced = 0
+        self.failures: Dict[str, int] = collections.Counter()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record_call(self, metrics: CallMetrics):
+        self.calls[metrics.model] += 1
+        if metrics.error is not None:
+            self.errors[(metrics.model, metrics.error)] += 1
+        self.prompt_tokens[metrics.model] += metrics.prompt_tokens
+        self.completion_tokens[metrics.model] += metrics.completion_tokens
+        self.cost[metrics.model] += metrics.cost
+        self.latencies.append(metrics.latency)
+        self.queue_waits.append(metrics.queue_wait)
+        self.backoff += metrics.backoff
+        self.call_retries += metrics.retries
+        self.hedges += metrics.hedges
+
+    def record_string(self, metrics: StringMetrics):
+        self.strings += 1
+        self.rewritten += metrics.rewritten
+        self.string_retries[metrics.retries] += 1
+        self.repairs += metrics.repairs
+        self.coalesced += metrics.coalesced
+        for failure in metrics.failures:
+            self.failures[failure] += 1
+
+    def record_cache_lookup(self, hit: bool):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def summary(self) -> str:
+        """
+        :return: a human-readable report of the recorded measurements
+        """
+        num_calls = sum(self.calls.values())
+        lines = [
+            f"API calls: {num_calls} ({sum(self.errors.values())} failed, "
+            f"{self.call_retries} retries, {self.hedges} hedged)",
+            f"Queue wait: {sum(self.queue_waits):.2f}s total, "
+            f"p90 {get_quantile(self.queue_waits, 0.9):.3f}s",
+            f"Latency: p50 {get_quantile(self.latencies, 0.5):.3f}s, "
+            f"p90 {get_quantile(self.latencies, 0.9):.3f}s, "
+            f"p99 {get_quantile(self.latencies, 0.99):.3f}s",
+            f"Backoff: {self.backoff:.2f}s total",
+        ]
+        for model in sorted(self.calls):
+            lines.append(
+                f"{model}: {self.calls[model]} calls, {self.prompt_tokens[model]} prompt tokens, "
+                f"{self.completion_tokens[model]} completion tokens, ${self.cost[model]:.4f}"
+            )
+        lines.append(
+            f"Strings: {self.strings} ({self.rewritten} rewritten, {self.coalesced} coalesced), "
+            f"{sum(retries * count for retries, count in self.string_retries.items())} retries, "
+            f"{self.repairs} repairs"
+        )
+        if self.cache_hits or self.cache_misses:
+            lines.append(
+                f"Rewrite cache: {self.cache_hits} hits, {self.cache_misses} misses"
+            )
+        if self.failures:
+            lines.append(
+                "Validation failures: "
+                + ", ".join(
+                    f"{reason} {count}"
+                    for reason, count in sorted(self.failures.items())
+                )
+            )
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix: str = "ofrak_ai") -> str:
+        """
+        :param prefix: the prefix of every metric name
+
+        :return: the recorded measurements in the Prometheus text exposition format
+        """
+        metrics = _PrometheusWriter(prefix)
+        metrics.add(
+            "requests_total",
+            "counter",
+            "Calls to the OpenAI API.",
+            [({"model": model}, count) for model, count in sorted(self.calls.items())],
+        )
+        metrics.add(
+            "request_errors_total",
+            "counter",
+            "Calls to the OpenAI API which failed.",
+            [
+                ({"model": model, "error": error}, count)
+                for (model, error), count in sorted(self.errors.items())
+            ],
+        )
+        metrics.add(
+            "tokens_total",
+            "counter",
+            "Tokens used by calls to the OpenAI API.",
+            [
+                ({"model": model, "type": "prompt"}, self.prompt_tokens[model])
+                for model in sorted(self.calls)
+            ]
+            + [
+                ({"model": model, "type": "completion"}, self.completion_tokens[model])
+                for model in sorted(self.calls)
+            ],
+        )
+        metrics.add(
+            "cost_dollars_total",
+            "counter",
+            "Estimated cost of calls to the OpenAI API.",
+            [({"model": model}, self.cost[model]) for model in sorted(self.calls)],
+        )
+        metrics.add_summary(
+            "request_latency_seconds",
+            "Time spent waiting for the OpenAI API to respond.",
+            self.latencies,
+        )
+        metrics.add_summary(
+            "queue_wait_seconds",
+            "Time spent waiting for the client-side rate limiter.",
+            self.queue_waits,
+        )
+        metrics.add(
+            "backoff_seconds_total",
+            "counter",
+            "Time slept between attempts after retryable errors.",
+            [({}, self.backoff)],
+        )
+        metrics.add(
+            "request_retries_total",
+            "counter",
+            "Attempts made after retryable errors.",
+            [({}, self.call_retries)],
+        )
+        metrics.add(
+            "request_hedges_total",
+            "counter",
+            "Duplicate attempts made because an attempt was unusually slow.",
+            [({}, self.hedges)],
+        )
+        metrics.add(
+            "strings_total",
+            "counter",
+            "Strings to be rewritten.",
+            [({}, self.strings)],
+        )
+        metrics.add(
+            "strings_rewritten_total",
+            "counter",
+            "Strings whose rewrite was patched in.",
+            [({}, self.rewritten)],
+        )
+        metrics.add(
+            "string_retries_total",
+            "counter",
+            "Strings sent again because their rewrite was invalid.",
+            [
+                (
+                    {},
+                    sum(
+                        retries * count
+                        for retries, count in self.string_retries.items()
+                    ),
+                )
+            ],
+        )
+        metrics.add(
+            "string_repairs_total",
+            "counter",
+            "Invalid rewrites which were fixed locally instead of sent again.",
+            [({}, self.repairs)],
+        )
+        metrics.add(
+            "strings_coalesced_total",
+            "counter",
+            "Strings which shared the rewrite of an identical string.",
+            [({}, self.coalesced)],
+        )
+        metrics.add(
+            "string_cache_lookups_total",
+            "counter",
+            "Lookups of strings in the rewrite cache.",
+            [
+                ({"result": "hit"}, self.cache_hits),
+                ({"result": "miss"}, self.cache_misses),
+            ],
+        )
+        metrics.add(
+            "validation_failures_total",
+            "counter",
+            "Rewrites which failed validation.",
+            [
+                ({"reason": reason}, count)
+                for reason, count in sorted(self.failures.items())
+            ],
+        )
+        return metrics.getvalue()
+
+    def write_prometheus(self, path: str, prefix: str = "ofrak_ai"):
+        """
+        Write the recorded measurements to a file, e.g. for the textfile collector of the
+        Prometheus node exporter.
+        """
+        with open(path, "w") as f:
+            f.write(self.to_prometheus(prefix))
+
+
+class _PrometheusWriter:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.lines: List[str] = []
+
+    def add(
+        self,
+        name: str,
+        metric_type: str,
+        description: str,
+        samples: Sequence[Tuple[Dict[str, str], float]],
+    ):
+        name = f"{self.prefix}_{name}"
+        self.lines.append(f"# HELP {name} {description}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    def add_summary(self, name: str, description: str, values: List[float]):
+        name = f"{self.prefix}_{name}"
+        self.lines.append(f"# HELP {name} {description}")
+        self.lines.append(f"# TYPE {name} summary")
+        for quantile in MetricsRecorder.QUANTILES:
+            self.lines.append(
+                f'{name}{{quantile="{quantile}"}} {get_quantile(values, quantile)}'
+            )
+        self.lines.append(f"{name}_sum {sum(values)}")
+        self.lines.append(f"{name}_count {len(values)}")
+
+    def getvalue(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def get_quantile(values: Iterable[float], quantile: float) -> float:
+    """
+    :return: the value under which `quantile` of `values` fall, or NaN if there are no values
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return math.nan
+    return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+
+_METRICS_HOOKS: List[MetricsHook] = []
+
+
+def add_metrics_hook(hook: MetricsHook):
+    """
+    Start sending the measurements of every API call, string rewrite and rewrite cache lookup in the
+    process to `hook`.
+    """
+    _METRICS_HOOKS.append(hook)
+
+
+def remove_metrics_hook(hook: MetricsHook):
+    _METRICS_HOOKS.remove(hook)
+
+
+def has_metrics_hooks() -> bool:
+    """
+    :return: True if any hook is registered, so that measurements which are expensive to take can
+        be skipped otherwise
+    """
+    return bool(_METRICS_HOOKS)
+
+
+def record_call(metrics: CallMetrics):
+    for hook in _METRICS_HOOKS:
+        hook.record_call(metrics)
+
+
+def record_string(metrics: StringMetrics):
+    for hook in _METRICS_HOOKS:
+        hook.record_string(metrics)
+
+
+def record_cache_lookup(hit: bool):
+    for hook in _METRICS_HOOKS:
+        hook.record_cache_lookup(hit)
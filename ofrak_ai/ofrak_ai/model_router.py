@@ -0,0 +1,83 @@
+import collections
+
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from ofrak_ai.chatgpt import ModelType
+from ofrak_ai.string_triage import SPECIFIER_PATTERN, StringCategory, classify_string
+
+
+@dataclass
+class RoutingPolicy:
+    """
+    :param fast_model: the model for strings which are easy to rewrite
+    :param strong_model: the model for strings which are hard to rewrite, i.e. long or format-heavy
+        sentences, and for every string of a category which keeps failing on `fast_model`
+    :param long_length: sentences at least this long go to `strong_model`
+    :param min_specifiers: sentences with at least this many format specifiers go to
+        `strong_model`
+    :param max_retry_rate: once more than this fraction of the strings of a category needed to be
+        sent again to `fast_model`, the category goes to `strong_model` instead
+    :param min_samples: the number of strings of a category to observe on `fast_model` before its
+        retry rate is trusted
+    """
+
+    fast_model: str = ModelType.THREE_FIVE_TURBO
+    strong_model: str = ModelType.FOUR
+    long_length: int = 120
+    min_specifiers: int = 2
+    max_retry_rate: float = 0.5
+    min_samples: int = 20
+
+
+class ModelRouter:
+    """
+    Pick the model each string is sent to, so that only the strings the cheaper and faster model
+    is likely to get wrong are sent to the stronger one. A router keeps the retry rate of every
+    (category, model) pair it has seen, so the same router should be used for a whole run.
+
+    :param policy: how strings are routed
+    """
+
+    def __init__(self, policy: Optional[RoutingPolicy] = None):
+        self.policy = policy or RoutingPolicy()
+        self.strings: Dict[Tuple[StringCategory, str], int] = collections.Counter()
+        self.retried: Dict[Tuple[StringCategory, str], int] = collections.Counter()
+
+    def route(self, text: str) -> str:
+        """
+        :param text: the string to rewrite
+
+        :return: the model to rewrite `text` with
+        """
+        category = classify_string(text)
+        if category == StringCategory.SENTENCE and (
+            len(text) >= self.policy.long_length
+            or len(SPECIFIER_PATTERN.findall(text)) >= self.policy.min_specifiers
+        ):
+            return self.policy.strong_model
+        if self.get_retry_rate(category, self.policy.fast_model) > (
+            self.policy.max_retry_rate
+        ):
+            return self.policy.strong_model
+        return self.policy.fast_model
+
+    def record(self, text: str, model: str, retries: int):
+        """
+        :param text: the string which was rewritten
+        :param model: the model it was rewritten with
+        :param retries: the number of times it had to be sent again
+        """
+        key = (classify_string(text), model)
+        self.strings[key] += 1
+        self.retried[key] += retries > 0
+
+    def get_retry_rate(self, category: StringCategory, model: str) -> float:
+        """
+        :return: the fraction of the strings of `category` which had to be sent to `model` again,
+            or 0 if too few strings were seen to tell
+        """
+        key = (category, model)
+        if self.strings[key] < self.policy.min_samples:
+            return 0.0
+        return self.retried[key] / self.strings[key]
@@ -0,0 +1,163 @@
+"""
+Report how many prompt tokens the string modifiers spend per string.
+
+Run `python -m ofrak_ai.prompt_report <binary>` to unpack a binary and compare, over all of its
+strings worth rewriting, the first request of
+[ChatGPTStringModifier][ofrak_ai.chatgpt_string_modifier.ChatGPTStringModifier] with the prompt it
+used to send, which inlined the voice instructions into every user message.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+import ofrak_ai
+from ofrak import OFRAK
+from ofrak_ai.chatgpt import count_prompt_tokens
+from ofrak_ai.chatgpt_string_modifier import (
+    ChatGPTStringModifierConfig,
+    StringType,
+    VoiceType,
+    get_string_request,
+    get_string_type,
+)
+from ofrak_ai.string_triage import triage_string_descendants
+
+# The line continuations of the inlined prompt kept the indentation of its source
+_INLINE_PROMPT_INDENT = " " * 32
+
+
+@dataclass
+class PromptTokenReport:
+    """
+    :param strings: the number of strings compared
+    :param inline_tokens: the prompt tokens of the first request of every string with the voice
+        instructions inlined into the user message
+    :param prompt_tokens: the prompt tokens of the first request of every string with the voice
+        instructions in the shared system message
+    :param system_messages: the number of distinct system messages used
+    """
+
+    strings: int = 0
+    inline_tokens: int = 0
+    prompt_tokens: int = 0
+    system_messages: int = 0
+
+    def __str__(self) -> str:
+        strings = max(self.strings, 1)
+        saved = self.inline_tokens - self.prompt_tokens
+        return "\n".join(
+            [
+                f"Strings: {self.strings} ({self.system_messages} distinct system messages)",
+                f"Inline prompts: {self.inline_tokens} tokens "
+                f"({self.inline_tokens / strings:.1f} per string)",
+                f"System message prompts: {self.prompt_tokens} tokens "
+                f"({self.prompt_tokens / strings:.1f} per string)",
+                f"Reduction: {saved} tokens ({saved / strings:.1f} per string, "
+                f"{100 * saved / max(self.inline_tokens, 1):.1f}%)",
+            ]
+        )
+
+
+def get_prompt_token_report(
+    texts: Iterable[str], config: ChatGPTStringModifierConfig
+) -> PromptTokenReport:
+    """
+    :param texts: the strings to rewrite
+    :param config: the config the strings would be rewritten with
+    """
+    report = PromptTokenReport()
+    system_prompts = set()
+    for text in texts:
+        history = get_string_request(text, config)
+        system_prompts.add(history[0]["content"])
+        report.strings += 1
+        report.prompt_tokens += count_prompt_tokens(history, config.model)
+        report.inline_tokens += count_prompt_tokens(
+            [
+                {
+                    "role": "user",
+                    "content": _get_inline_prompt(text, get_string_type(text), config),
+                }
+            ],
+            config.model,
+        )
+    report.system_messages = len(system_prompts)
+    return report
+
+
+def _get_inline_prompt(
+    text: str, str_type: StringType, config: ChatGPTStringModifierConfig
+) -> str:
+    identifier_part = (str_type == StringType.IDENTIFIER) * config.prompt_parts.get(
+        StringType.IDENTIFIER, ""
+    )
+    sentence_part = (str_type == StringType.SENTENCE) * config.prompt_parts.get(
+        StringType.SENTENCE, ""
+    )
+    lines = [
+        f"You are a {config.voice.voice_noun}.",
+        "I will send a message and you will respond by making the text of the message more "
+        f"{config.voice.voice_adjective}.",
+        "The text you generate must be shorter or equal to the length to the length of the "
+        "original message.",
+        "It is EXTREMELY important that your version is shorter than the original and contains "
+        "only ASCII characters.",
+        f"{identifier_part} ",
+        f"{sentence_part} ",
+        "If you understand, make the following message more "
+        f"{config.voice.voice_adjective}: \n{text}",
+    ]
+    return _INLINE_PROMPT_INDENT.join(lines)
+
+
+async def _report_binary(
+    path: str, config: ChatGPTStringModifierConfig
+) -> PromptTokenReport:
+    ofrak = OFRAK(logging.WARNING)
+    ofrak.discover(ofrak_ai)
+    ofrak_context = await ofrak.create_ofrak_context()
+    try:
+        resource = await ofrak_context.create_root_resource_from_file(path)
+        await resource.unpack_recursively()
+        triage = await triage_string_descendants(
+            resource,
+            config.min_length,
+            config.rewrite_categories,
+        )
+    finally:
+        await ofrak_context.shutdown_context()
+    return get_prompt_token_report((string.Text for string in triage.rewrite), config)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """
+    :return: the exit status
+    """
+    parser = argparse.ArgumentParser(
+        description="Report the prompt tokens spent per string of a binary"
+    )
+    parser.add_argument("binary", help="the binary to unpack")
+    parser.add_argument("--min-length", type=int, default=50)
+    parser.add_argument("--model", default=ChatGPTStringModifierConfig.model)
+    parser.add_argument(
+        "--voice",
+        choices=[voice.name.lower() for voice in VoiceType],
+        default=VoiceType.SASSY.name.lower(),
+    )
+    args = parser.parse_args(argv)
+
+    config = ChatGPTStringModifierConfig(
+        model=args.model,
+        min_length=args.min_length,
+        voice=VoiceType[args.voice.upper()].value,
+    )
+    print(asyncio.run(_report_binary(args.binary, config)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import email.utils
+import random
+import time
+
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Mapping,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+from ofrak_ai.metrics import get_quantile
+
+if TYPE_CHECKING:
+    from openai.error import OpenAIError
+
+T = TypeVar("T")
+
+# Errors which are worth another attempt, by name so that openai is only imported once needed
+RETRYABLE_ERRORS = (
+    "RateLimitError",
+    "Timeout",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "TryAgain",
+)
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How requests to ChatGPT are retried, bounded in time, and hedged.
+
+    Failed attempts are retried after the delay the server asks for in its Retry-After header, or
+    otherwise after an exponentially increasing delay starting at `initial_delay`.
+
+    :param initial_delay: the delay in seconds before the first retry
+    :param exponential_base: the factor by which the delay grows with each retry
+    :param max_delay: the maximum delay in seconds before a retry
+    :param jitter: if True, randomly extend each delay by up to 100% so that concurrent requests
+        do not retry in lockstep
+    :param max_retries: the maximum number of retries of a request
+    :param retryable_errors: the names of the openai errors worth retrying
+    :param request_deadline: the maximum number of seconds a request may take, including its
+        retries, or None for no limit
+    :param run_deadline: a `time.time()` timestamp after which no more attempts are made, e.g. to
+        bound a whole run, or None for no limit
+    :param hedge_quantile: if set, send a duplicate of a request once it has been waiting for
+        longer than this quantile (e.g. 0.95) of the recent latencies of its model, and use
+        whichever response arrives first
+    :param min_hedge_samples: the number of latencies of a model to observe before hedging its
+        requests
+    """
+
+    initial_delay: float = 1.0
+    exponential_base: float = 2.0
+    max_delay: float = 60.0
+    jitter: bool = True
+    max_retries: int = 10
+    retryable_errors: Set[str] = field(default_factory=lambda: set(RETRYABLE_ERRORS))
+    request_deadline: Optional[float] = None
+    run_deadline: Optional[float] = None
+    hedge_quantile: Optional[float] = None
+    min_hedge_samples: int = 20
+
+    def is_retryable(self, error: "OpenAIError") -> bool:
+        return type(error).__name__ in self.retryable_errors
+
+    def get_deadline(self) -> Optional[float]:
+        """
+        :return: the `time.monotonic()` time by which a request starting now must be done, or None
+        """
+        deadlines = []
+        if self.request_deadline is not None:
+            deadlines.append(time.monotonic() + self.request_deadline)
+        if self.run_deadline is not None:
+            deadlines.append(time.monotonic() + self.run_deadline - time.time())
+        return min(deadlines, default=None)
+
+    def get_delay(self, num_retries: int) -> float:
+        """
+        :param num_retries: the number of retries made so far
+
+        :return: the delay in seconds before the next retry, without any Retry-After
+        """
+        delay = min(
+            self.initial_delay * self.exponential_base**num_retries, self.max_delay
+        )
+        if self.jitter:
+            delay *= 1 + random.random()
+        return delay
+
+
+async def call_with_retries(
+    attempt: Callable[[], Awaitable[T]],
+    policy: RetryPolicy,
+    on_backoff: Optional[Callable[[float], None]] = None,
+) -> T:
+    """
+    Make attempts until one succeeds, a non-retryable error is raised, the retries run out or the
+    deadline passes.
+
+    :param attempt: makes one attempt at the request
+    :param policy: the retry policy to follow
+    :param on_backoff: called with the number of seconds about to be slept before each retry
+
+    :raises Timeout: if the deadline passes before an attempt succeeds
+    :raises OpenAIError: the error of the last attempt, if it is not retried
+    """
+    from openai.error import OpenAIError, Timeout
+
+    deadline = policy.get_deadline()
+    num_retries = 0
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise Timeout(f"Deadline exceeded after {num_retries} retries")
+        try:
+            return await asyncio.wait_for(attempt(), remaining)
+        except asyncio.TimeoutError:
+            raise Timeout(f"Deadline exceeded after {num_retries} retries")
+        except OpenAIError as e:
+            if not policy.is_retryable(e) or num_retries >= policy.max_retries:
+                raise e
+            delay = get_retry_after(e)
+            if delay is None:
+                delay = policy.get_delay(num_retries)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                # Waiting would only end in a timeout, so fail with the actual error right away
+                raise e
+            num_retries += 1
+            if on_backoff is not None:
+                on_backoff(delay)
+            await asyncio.sleep(delay)
+
+
+def get_retry_after(error: "OpenAIError") -> Optional[float]:
+    """
+    :return: the number of seconds the server asked to wait before retrying, or None if it did not
+    """
+    headers: Mapping[str, str] = error.headers or {}
+    values = {name.lower(): value for name, value in headers.items()}
+    if "retry-after-ms" in values:
+        try:
+            return float(values["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in values:
+        value = values["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        # Retry-After may also be an HTTP date
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(date.timestamp() - time.time(), 0.0)
+    return None
+
+
+async def call_hedged(
+    attempt: Callable[[], Awaitable[T]],
+    hedge_after: Optional[float],
+    on_hedge: Optional[Callable[[], None]] = None,
+) -> T:
+    """
+    Make an attempt, and if it has not completed after `hedge_after` seconds, a second one. The
+    first attempt to succeed is used and the other one is cancelled.
+
+    :param attempt: makes one attempt at the request
+    :param hedge_after: the number of seconds to wait before hedging, or None to not hedge
+    :param on_hedge: called when the second attempt is made
+
+    :raises Exception: the error of the last attempt, if both attempts fail
+    """
+    if hedge_after is None:
+        return await attempt()
+
+    tasks = {asyncio.ensure_future(attempt())}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            tasks.add(asyncio.ensure_future(attempt()))
+        pending = tasks
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            if not pending:
+                return done.pop().result()
+    finally:
+        # Cancel the slower attempt, or both if the caller is cancelled
+        for task in tasks:
+            task.cancel()
+
+
+class LatencyTracker:
+    """
+    Keep the latencies of the most recent requests, to know what is an unusually slow request.
+
+    :param max_samples: the number of latencies to keep
+    """
+
+    def __init__(self, max_samples: int = 200):
+        self._latencies: Deque[float] = collections.deque(maxlen=max_samples)
+
+    def add(self, latency: float):
+        self._latencies.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        """
+        :return: the latency under which `quantile` of the recent requests completed, or None if
+            no requests completed yet
+        """
+        if not self._latencies:
+            return None
+        return get_quantile(self._latencies, quantile)
+
+
+_LATENCY_TRACKERS: Dict[str, LatencyTracker] = {}
+
+
+def get_latency_tracker(model: str) -> LatencyTracker:
+    """
+    Get the process-wide latency tracker of a model.
+    """
+    tracker = _LATENCY_TRACKERS.get(model)
+    if tracker is None:
+        tracker = LatencyTracker()
+        _LATENCY_TRACKERS[model] = tracker
+    return tracker
+
+
+def get_hedge_delay(policy: RetryPolicy, model: str) -> Optional[float]:
+    """
+    :return: how long to wait for a request to `model` before hedging it, or None to not hedge it
+    """
+    if policy.hedge_quantile is None:
+        return None
+    tracker = get_latency_tracker(model)
+    if len(tracker) < policy.min_hedge_samples:
+        return None
+    return tracker.quantile(policy.hedge_quantile)
@@ -0,0 +1,233 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import time
+
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from ofrak_ai.loop_local import LoopLocal
+from ofrak_ai.metrics import (
+    CallMetrics,
+    MetricsHook,
+    add_metrics_hook,
+    remove_metrics_hook,
+)
+from ofrak_ai.string_triage import StringCategory, classify_string
+
+
+def get_string_priority(text: str) -> Tuple[bool, int]:
+    """
+    :return: a key which sorts the strings most worth rewriting first: sentences, which are what
+        users get to read, before identifiers, and longer strings before shorter ones
+    """
+    return classify_string(text) != StringCategory.SENTENCE, -len(text)
+
+
+@dataclass
+class RewriteJob:
+    """
+    :param texts: the strings the job rewrites
+    :param tokens: the estimated number of prompt and completion tokens the job uses
+    :param cost: the estimated cost of the job in US dollars
+    :param run: rewrites the strings
+    """
+
+    texts: List[str]
+    tokens: int
+    cost: float
+    run: Callable[[], Awaitable[None]]
+
+
+# The budget whose jobs are running in the current task, which the calls they make are charged to
+_CURRENT_BUDGET: "contextvars.ContextVar[Optional[RewriteBudget]]" = (
+    contextvars.ContextVar("current_budget", default=None)
+)
+
+
+class RewriteBudget:
+    """
+    Limit the tokens, cost and time spent rewriting strings. Jobs are started in the order they
+    are given, so the strings most worth rewriting should come first. A job is only started if its
+    estimated usage fits in what is left of the budget once the jobs already running are accounted
+    for; once one does not, no more jobs are started and the strings of the remaining jobs are
+    skipped. Jobs still running when the time is up are cancelled and their strings skipped too.
+
+    A budget keeps what was spent and skipped across runs, so the same budget should be used for
+    a whole run, and can be printed afterwards to report it.
+
+    :param max_tokens: the maximum number of prompt and completion tokens to use, or None for no
+        limit
+    :param max_cost: the maximum estimated cost in US dollars, or None for no limit
+    :param max_seconds: the maximum number of seconds from the first job on, or None for no limit
+    :param max_in_flight: the maximum number of jobs to run at once, so that the jobs started
+        first are not held up by every later job competing for the rate limits
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        max_seconds: Optional[float] = None,
+        max_in_flight: int = 8,
+    ):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.max_seconds = max_seconds
+        self.max_in_flight = max_in_flight
+        self.tokens = 0
+        self.cost = 0.0
+        self.skipped: List[str] = []
+        self.exhausted: Optional[str] = None
+        self._reserved_tokens = 0
+        self._reserved_cost = 0.0
+        self._running = 0
+        self._start: Optional[float] = None
+        # Concurrent runs share one hook, so that each call is only charged once
+        self._hook = _BudgetHook(self)
+        self._runs = 0
+        self._semaphore = LoopLocal(lambda: asyncio.Semaphore(self.max_in_flight))
+        self._settled = LoopLocal(asyncio.Event)
+
+    async def run(self, jobs: Iterable[RewriteJob]):
+        """
+        Run jobs in order for as long as the budget allows. Concurrent runs share the budget,
+        including its `max_in_flight` jobs at once.
+
+        :param jobs: the jobs to run, the most valuable first
+        """
+        if self._start is None:
+            self._start = time.monotonic()
+        if self._runs == 0:
+            add_metrics_hook(self._hook)
+        self._runs += 1
+        pending: Deque[RewriteJob] = collections.deque(jobs)
+        in_flight: Dict["asyncio.Future[None]", RewriteJob] = {}
+        try:
+            while pending and self.exhausted is None:
+                if not await self._wait(self._semaphore.get().acquire()):
+                    self.exhausted = "time"
+                    break
+                exceeded = self._get_exceeded(pending[0])
+                if exceeded is None:
+                    job = pending.popleft()
+                    self._reserve(job, 1)
+                    started = asyncio.ensure_future(self._run_job(job))
+                    # A callback rather than a finally clause, since a task cancelled before it
+                    # started never runs its coroutine
+                    started.add_done_callback(functools.partial(self._settle, job))
+                    in_flight[started] = job
+                    continue
+                self._semaphore.get().release()
+                if not self._running:
+                    self.exhausted = exceeded
+                # Otherwise wait for a running job, of this run or another, to settle what it
+                # actually used
+                elif not await self._wait(self._settled.get().wait()):
+                    self.exhausted = "time"
+            for job in pending:
+                self.skipped.extend(job.texts)
+
+            if in_flight:
+                _, late = await asyncio.wait(
+                    in_flight, timeout=self._get_remaining_seconds()
+                )
+                if late:
+                    self.exhausted = "time"
+                    for task in late:
+                        task.cancel()
+                    await asyncio.gather(*late, return_exceptions=True)
+            for task, job in in_flight.items():
+                if task.cancelled():
+                    self.skipped.extend(job.texts)
+                else:
+                    task.result()
+        finally:
+            for task in in_flight:
+                task.cancel()
+            self._runs -= 1
+            if self._runs == 0:
+                remove_metrics_hook(self._hook)
+
+    def __str__(self) -> str:
+        seconds = 0.0 if self._start is None else time.monotonic() - self._start
+        line = (
+            f"Budget: {self.tokens}{_format_limit(self.max_tokens)} tokens, "
+            f"${self.cost:.4f}{_format_limit(self.max_cost)}, "
+            f"{seconds:.1f}{_format_limit(self.max_seconds)}s; "
+            f"{len(self.skipped)} strings skipped"
+        )
+        if self.exhausted is not None:
+            line += f" once the {self.exhausted} budget ran out"
+        return line
+
+    async def _run_job(self, job: RewriteJob):
+        # Tasks run in a copy of the context they were created in, so this only applies to the
+        # calls made by this job
+        _CURRENT_BUDGET.set(self)
+        await job.run()
+
+    def _settle(self, job: RewriteJob, task: "asyncio.Future[None]"):
+        self._reserve(job, -1)
+        self._semaphore.get().release()
+        # Wake up the runs waiting for what the job used to be charged
+        self._settled.get().set()
+        self._settled.discard()
+
+    async def _wait(self, awaitable: Awaitable) -> bool:
+        """
+        :return: False if the time ran out before `awaitable` completed
+        """
+        try:
+            await asyncio.wait_for(awaitable, self._get_remaining_seconds())
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _get_exceeded(self, job: RewriteJob) -> Optional[str]:
+        """
+        :return: the name of the limit starting `job` would exceed, or None if it fits
+        """
+        remaining_seconds = self._get_remaining_seconds()
+        if remaining_seconds is not None and remaining_seconds <= 0:
+            return "time"
+        if (
+            self.max_tokens is not None
+            and self.tokens + self._reserved_tokens + job.tokens > self.max_tokens
+        ):
+            return "token"
+        if (
+            self.max_cost is not None
+            and self.cost + self._reserved_cost + job.cost > self.max_cost
+        ):
+            return "cost"
+        return None
+
+    def _get_remaining_seconds(self) -> Optional[float]:
+        if self.max_seconds is None or self._start is None:
+            return None
+        return self._start + self.max_seconds - time.monotonic()
+
+    def _reserve(self, job: RewriteJob, sign: int):
+        self._reserved_tokens += sign * job.tokens
+        self._reserved_cost += sign * job.cost
+        self._running += sign
+
+
+class _BudgetHook(MetricsHook):
+    """
+    Charge the calls made by the jobs of a budget to it as they complete.
+    """
+
+    def __init__(self, budget: RewriteBudget):
+        self.budget = budget
+
+    def record_call(self, metrics: CallMetrics):
+        if _CURRENT_BUDGET.get() is self.budget:
+            self.budget.tokens += metrics.prompt_tokens + metrics.completion_tokens
+            self.budget.cost += metrics.cost
+
+
+def _format_limit(limit: Optional[float]) -> str:
+    return "" if limit is None else f"/{limit:g}"
@@ -0,0 +1,87 @@
+import asyncio
+import collections
+import logging
+
+from typing import AsyncIterator, Deque, Set
+
+from ofrak import Resource
+from ofrak.model.component_model import ComponentRunResult
+from ofrak.core.strings import AsciiString
+from ofrak_ai.chatgpt_string_modifier import (
+    ChatGPTStringModifier,
+    ChatGPTStringModifierConfig,
+)
+from ofrak_ai.string_triage import classify_string, get_section_name
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def iter_string_descendants(resource: Resource) -> AsyncIterator[AsciiString]:
+    """
+    Unpack `resource` breadth-first, and yield each of its
+    [AsciiString][ofrak.core.strings.AsciiString] descendants as soon as it is unpacked, rather
+    than after the whole tree is. Resources are only unpacked once the strings found so far have
+    been consumed, so a slow consumer holds back unpacking.
+
+    :param resource: the resource to unpack, which may already be (partly) unpacked
+    """
+    pending: Deque[Resource] = collections.deque([resource])
+    while pending:
+        descendant = pending.popleft()
+        if descendant.has_tag(AsciiString):
+            yield await descendant.view_as(AsciiString)
+            continue
+        await descendant.unpack()
+        pending.extend(await descendant.get_children())
+
+
+async def rewrite_strings_streaming(
+    resource: Resource,
+    config: ChatGPTStringModifierConfig = ChatGPTStringModifierConfig(),
+    max_in_flight: int = 32,
+) -> int:
+    """
+    Run a [ChatGPTStringModifier][ofrak_ai.chatgpt_string_modifier.ChatGPTStringModifier] on every
+    string worth rewriting in `resource` while it is being unpacked, so that waiting for ChatGPT
+    overlaps with unpacking. At most `max_in_flight` strings are rewritten at once; once that many
+    are in flight, unpacking waits for one of them to complete, which keeps the memory held by
+    pending requests bounded however many strings the resource has.
+
+    :param resource: the resource whose strings to rewrite
+    :param config: the config of the string rewrites
+    :param max_in_flight: the maximum number of strings to rewrite at once
+
+    :return: the number of strings sent to be rewritten
+    """
+    in_flight: Set["asyncio.Future[ComponentRunResult]"] = set()
+    num_strings = 0
+    try:
+        async for string in iter_string_descendants(resource):
+            if (
+                classify_string(
+                    string.Text,
+                    config.min_length,
+                    await get_section_name(string.resource),
+                )
+                not in config.rewrite_categories
+            ):
+                continue
+            while len(in_flight) >= max_in_flight:
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+            in_flight.add(
+                asyncio.ensure_future(
+                    string.resource.run(ChatGPTStringModifier, config)
+                )
+            )
+            num_strings += 1
+        await asyncio.gather(*in_flight)
+    finally:
+        # Do not leave rewrites running if unpacking or a rewrite failed
+        for task in in_flight:
+            task.cancel()
+    LOGGER.info(f"Sent {num_strings} strings to be rewritten while unpacking")
+    return num_strings
@@ -0,0 +1,144 @@
+import logging
+import os
+import sqlite3
+import time
+
+from typing import Dict, Optional
+
+from ofrak_ai.metrics import record_cache_lookup
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StringRewriteCache:
+    """
+    A persistent, content-addressed cache of string rewrites backed by SQLite, so that strings which
+    were already rewritten in a previous run are not sent to the API again.
+
+    Entries are evicted when they are older than `max_age` seconds, and the least recently used
+    entries are evicted once the cache holds more than `max_entries` rewrites. Eviction runs when
+    the cache is opened and then every `EVICTION_INTERVAL` insertions.
+
+    :param path: the path of the SQLite database file to use
+    :param max_entries: the maximum number of rewrites to keep
+    :param max_age: the maximum age of a rewrite in seconds, or None to keep rewrites forever
+    """
+
+    EVICTION_INTERVAL = 1000
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 100_000,
+        max_age: Optional[float] = None,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS rewrites ("
+            "key TEXT PRIMARY KEY, "
+            "result TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS rewrites_accessed ON rewrites (accessed)"
+        )
+        self.evict()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :param key: the content address of the rewrite
+
+        :return: the cached rewrite, or None if there is no (unexpired) rewrite for the key
+        """
+        now = time.time()
+        row = self._connection.execute(
+            "SELECT result, created FROM rewrites WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (self.max_age is not None and row[1] < now - self.max_age):
+            self.misses += 1
+            record_cache_lookup(False)
+            return None
+        with self._connection:
+            self._connection.execute(
+                "UPDATE rewrites SET accessed = ? WHERE key = ?", (now, key)
+            )
+        self.hits += 1
+        record_cache_lookup(True)
+        return row[0]
+
+    def put(self, key: str, result: str):
+        """
+        :param key: the content address of the rewrite
+        :param result: the rewritten string
+        """
+        now = time.time()
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO rewrites (key, result, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, result, now, now),
+            )
+        self._puts += 1
+        if self._puts % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired rewrites, then the least recently used rewrites over `max_entries`.
+        """
+        with self._connection:
+            if self.max_age is not None:
+                self._connection.execute(
+                    "DELETE FROM rewrites WHERE created < ?",
+                    (time.time() - self.max_age,),
+                )
+            self._connection.execute(
+                "DELETE FROM rewrites WHERE key IN ("
+                "SELECT key FROM rewrites ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM rewrites").fetchone()[0]
+
+    def close(self):
+        LOGGER.debug(
+            f"Closing string cache {self.path}: {self.hits} hits, {self.misses} misses"
+        )
+        self._connection.close()
+        if _CACHES.get(self.path) is self:
+            del _CACHES[self.path]
+
+
+_CACHES: Dict[str, StringRewriteCache] = {}
+
+
+def get_string_rewrite_cache(
+    path: str,
+    max_entries: int = 100_000,
+    max_age: Optional[float] = None,
+) -> StringRewriteCache:
+    """
+    Get the process-wide cache for the database at `path`, opening it if necessary, so that
+    concurrently running modifiers share one connection and one set of hit/miss counters.
+    """
+    path = os.path.abspath(path)
+    cache = _CACHES.get(path)
+    if cache is None:
+        cache = StringRewriteCache(path, max_entries, max_age)
+        _CACHES[path] = cache
+    else:
+        cache.max_entries = max_entries
+        cache.max_age = max_age
+    return cache
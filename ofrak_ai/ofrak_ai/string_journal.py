@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+
+from typing import Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RewriteJournal:
+    """
+    An append-only journal of the rewrites accepted during a run, so that a run which crashed or
+    was interrupted can be resumed without requesting the strings it already rewrote again.
+
+    Every rewrite is written as a line of JSON and flushed to disk as soon as it is accepted.
+    Rewrites are keyed by the offset of their string within the root resource and its original
+    text, which unlike resource IDs stay the same when the image is unpacked again in a new
+    process. A journal therefore belongs to a single image.
+
+    :param path: the path of the journal file, which is created if it does not exist
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._rewrites: Dict[Tuple[int, str], str] = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        complete = True
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    complete = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line is cut short if the run was killed while writing it
+                        LOGGER.warning(
+                            f"Skipped a corrupt line in rewrite journal {path}"
+                        )
+                        continue
+                    self._rewrites[(entry["offset"], entry["text"])] = entry["result"]
+        self._file = open(path, "a", encoding="utf-8")
+        if not complete:
+            self._file.write("\n")
+
+    def get(self, offset: int, text: str) -> Optional[str]:
+        """
+        :param offset: the offset of the string within the root resource
+        :param text: the original text of the string
+
+        :return: the journaled rewrite of the string, or None if it was not rewritten yet
+        """
+        return self._rewrites.get((offset, text))
+
+    def append(self, offset: int, text: str, result: str):
+        """
+        Record an accepted rewrite, and make sure it is on disk before returning.
+
+        :param offset: the offset of the string within the root resource
+        :param text: the original text of the string
+        :param result: the rewritten string
+        """
+        self._rewrites[(offset, text)] = result
+        self._file.write(
+            json.dumps({"offset": offset, "text": text, "result": result}) + "\n"
+        )
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __len__(self) -> int:
+        return len(self._rewrites)
+
+    def close(self):
+        self._file.close()
+        if _JOURNALS.get(self.path) is self:
+            del _JOURNALS[self.path]
+
+
+_JOURNALS: Dict[str, RewriteJournal] = {}
+
+
+def get_rewrite_journal(path: str) -> RewriteJournal:
+    """
+    Get the process-wide journal at `path`, opening it if necessary, so that the modifiers of every
+    string of an image append to one file.
+    """
+    path = os.path.abspath(path)
+    journal = _JOURNALS.get(path)
+    if journal is None:
+        journal = RewriteJournal(path)
+        _JOURNALS[path] = journal
+    return journal
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+from typing import Iterable, List, Tuple
+
+from ofrak import Resource
+from ofrak.component.modifier import Modifier, ModifierError
+from ofrak.core.strings import AsciiString
+from ofrak.model.component_model import ComponentConfig
+from ofrak_type import Range
+
+
+@dataclass
+class BulkStringPatchingConfig(ComponentConfig):
+    """
+    :param patches: (offset, string) pairs describing each string to patch in and the offset in
+        the resource at which to patch it
+    :param null_terminate: add a null terminator to each string if True
+    """
+
+    patches: List[Tuple[int, str]]
+    null_terminate: bool = True
+
+
+class BulkStringPatchingModifier(Modifier[BulkStringPatchingConfig]):
+    """
+    Patch many strings into a resource at once. Unlike running a
+    [StringPatchingModifier][ofrak.core.strings.StringPatchingModifier] per string, the strings are
+    patched into the target resource's data in memory and queued as one patch, so the data service
+    applies them in a single pass and the resource and its dependencies are only updated once.
+    Only the bytes of each string are patched, so the data between them is left alone.
+    """
+
+    targets = ()
+
+    async def modify(self, resource: Resource, config: BulkStringPatchingConfig):
+        """
+        :raises ModifierError: if a patch overflows the original size of the resource
+        """
+        if not config.patches:
+            return
+        data = await resource.get_data()
+        for offset, string in config.patches:
+            patch_bytes = string.encode("utf-8")
+            if config.null_terminate:
+                patch_bytes += b"\x00"
+            if offset < 0 or offset + len(patch_bytes) > len(data):
+                raise ModifierError(
+                    f"The string patch {string!r} at offset {offset} overflows the original size "
+                    f"of the resource {resource.get_id().hex()}."
+                )
+            # Every patch is queued within this one run, so they are all applied in one flush
+            resource.queue_patch(Range.from_size(offset, len(patch_bytes)), patch_bytes)
+
+
+async def get_string_patches(
+    resource: Resource,
+    rewrites: Iterable[Tuple[AsciiString, str]],
+) -> List[Tuple[int, str]]:
+    """
+    Translate rewrites of descendant strings into patches for a
+    [BulkStringPatchingModifier][ofrak_ai.string_patching.BulkStringPatchingModifier] run on
+    `resource`.
+
+    :param resource: the resource to patch, which must be an ancestor of every string
+    :param rewrites: (string, rewritten text) pairs
+    """
+    resource_start = (await resource.get_data_range_within_root()).start
+    patches = []
+    for string, result in rewrites:
+        string_range = await string.resource.get_data_range_within_root()
+        patches.append((string_range.start - resource_start, result))
+    return patches
@@ -0,0 +1,200 @@
+import collections
+import re
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Optional
+
+from ofrak import Resource, ResourceFilter
+from ofrak.core.program_section import NamedProgramSection
+from ofrak.core.strings import AsciiString
+from ofrak.service.resource_service_i import ResourceAttributeValuesFilter
+
+SPECIFIER_PATTERN = re.compile(r"(?<!%)(%%)*(%[^%]*?[diuoxXfFeEgGaAcCsSpn])")
+
+
+class StringCategory(Enum):
+    """
+    What a string found in a binary holds, which decides whether it is worth rewriting.
+    """
+
+    # Shorter than the minimum length to rewrite
+    SHORT = "short"
+    SENTENCE = "sentence"
+    IDENTIFIER = "identifier"
+    # Linker symbols and symbol versions, e.g. __libc_start_main or puts@@GLIBC_2.2.5, and every
+    # string in a symbol string table
+    SYMBOL = "symbol"
+    # Itanium or MSVC C++ mangled names, e.g. _ZNSt6vectorIiSaIiEE9push_backERKi
+    MANGLED_NAME = "mangled_name"
+    # File paths and library names, e.g. /lib64/ld-linux-x86-64.so.2
+    PATH = "path"
+    # Section names, e.g. .note.gnu.build-id
+    SECTION_NAME = "section_name"
+    # No words outside of format specifiers, e.g. "%s: %s (%d)\n" or "0x%08x 0x%08x"
+    FORMAT = "format"
+    # Mostly non-alphanumeric characters, usually data which happens to be printable
+    BINARY_DATA = "binary_data"
+
+
+# The categories which are sent to ChatGPT by default. Rewriting the others either achieves nothing
+# or breaks the binary, e.g. by renaming a symbol the dynamic linker has to resolve.
+REWRITABLE_CATEGORIES: FrozenSet[StringCategory] = frozenset(
+    {StringCategory.SENTENCE, StringCategory.IDENTIFIER}
+)
+
+# Sections holding the names of symbols, which the (dynamic) linker looks up by name however they
+# are shaped, e.g. an imported ConvertStringSecurityDescriptorToSecurityDescriptorW
+SYMBOL_SECTIONS: FrozenSet[str] = frozenset(
+    {".dynstr", ".dynsym", ".strtab", ".symtab"}
+)
+
+# Strings without spaces are matched against every pattern at once, in order of precedence
+TOKEN_PATTERN = re.compile(
+    r"(?P<mangled_name>_Z[A-Za-z0-9_.$]+|\?[A-Za-z0-9_@?$]+@[A-Za-z0-9_@?$]*)"
+    r"|(?P<symbol>_{1,2}[A-Za-z_][A-Za-z0-9_.$]*"
+    r"|[A-Za-z_][A-Za-z0-9_.$]*@@?[A-Za-z0-9_.]+"
+    r"|(?:GLIBC|GLIBCXX|CXXABI|GCC)_[0-9.]+)"
+    r"|(?P<section_name>\.[A-Za-z_][A-Za-z0-9_.\-]*)"
+    r"|(?P<path>(?:[A-Za-z]:)?[\\/]?(?:[\w.\-~+]+[\\/])+[\w.\-+]*"
+    r"|[\w.\-+]+\.(?:so(?:\.[0-9]+)*|dll|exe|sys|dylib|a|o|ko|bin|cfg|conf|ini|xml|json))"
+)
+WORD_PATTERN = re.compile(r"[A-Za-z]{2,}")
+
+# Strings in which less than this fraction of the characters are letters, digits or spaces are
+# treated as data rather than text
+MIN_TEXT_RATIO = 0.6
+
+
+def classify_string(
+    text: str, min_length: int = 0, section_name: Optional[str] = None
+) -> StringCategory:
+    """
+    Cheaply classify a string by its shape, and by the section it is in if that is known.
+
+    :param text: the string to classify
+    :param min_length: strings shorter than this are classified as
+        [SHORT][ofrak_ai.string_triage.StringCategory.SHORT]
+    :param section_name: the name of the section holding the string, e.g. from
+        [get_section_name][ofrak_ai.string_triage.get_section_name]. Strings in one of the
+        `SYMBOL_SECTIONS` are classified as [SYMBOL][ofrak_ai.string_triage.StringCategory.SYMBOL]
+    """
+    if len(text) < min_length:
+        return StringCategory.SHORT
+    if section_name in SYMBOL_SECTIONS:
+        return StringCategory.SYMBOL
+    if not WORD_PATTERN.search(SPECIFIER_PATTERN.sub("", text)):
+        return StringCategory.FORMAT
+    stripped = text.strip()
+    num_text_characters = sum(c.isalnum() or c == " " for c in stripped)
+    if num_text_characters < MIN_TEXT_RATIO * len(stripped):
+        return StringCategory.BINARY_DATA
+    if " " in stripped:
+        return StringCategory.SENTENCE
+    match = TOKEN_PATTERN.fullmatch(stripped)
+    if match is None:
+        return StringCategory.IDENTIFIER
+    return StringCategory(match.lastgroup)
+
+
+@dataclass
+class StringTriage:
+    """
+    :param rewrite: the strings worth rewriting
+    :param counts: the number of strings of each category
+    """
+
+    rewrite: List[AsciiString] = field(default_factory=list)
+    counts: Dict[StringCategory, int] = field(default_factory=collections.Counter)
+
+    def __str__(self) -> str:
+        return ", ".join(
+            f"{category.value} {self.counts[category]}"
+            for category in StringCategory
+            if self.counts[category]
+        )
+
+
+def triage_strings(
+    strings: Iterable[AsciiString],
+    min_length: int = 0,
+    categories: FrozenSet[StringCategory] = REWRITABLE_CATEGORIES,
+    section_names: Optional[Mapping[bytes, str]] = None,
+) -> StringTriage:
+    """
+    Classify strings in one pass and keep those worth rewriting.
+
+    :param strings: the strings to triage
+    :param min_length: the minimum length of a string worth rewriting
+    :param categories: the categories of strings worth rewriting
+    :param section_names: the name of the section holding each string, by the id of its resource
+    """
+    triage = StringTriage()
+    for string in strings:
+        section_name = (
+            section_names.get(string.resource.get_id())
+            if section_names is not None
+            else None
+        )
+        category = classify_string(string.Text, min_length, section_name)
+        triage.counts[category] += 1
+        if category in categories:
+            triage.rewrite.append(string)
+    return triage
+
+
+async def triage_string_descendants(
+    resource: Resource,
+    min_length: int = 0,
+    categories: FrozenSet[StringCategory] = REWRITABLE_CATEGORIES,
+) -> StringTriage:
+    """
+    Triage the (already unpacked) string descendants of `resource`, taking into account which of
+    them are in symbol sections.
+
+    :param resource: the resource whose strings to triage
+    :param min_length: the minimum length of a string worth rewriting
+    :param categories: the categories of strings worth rewriting
+    """
+    strings = await resource.get_descendants_as_view(
+        AsciiString, r_filter=ResourceFilter(tags=(AsciiString,))
+    )
+    section_names: Dict[bytes, str] = {}
+    section_name = await get_section_name(resource)
+    if section_name in SYMBOL_SECTIONS:
+        # Every string is in the same symbol section
+        section_names = {string.resource.get_id(): section_name for string in strings}
+    else:
+        # Only look up the few symbol sections rather than the section of every string
+        for section in await resource.get_descendants_as_view(
+            NamedProgramSection,
+            r_filter=ResourceFilter(
+                tags=(NamedProgramSection,),
+                attribute_filters=(
+                    ResourceAttributeValuesFilter(
+                        NamedProgramSection.SectionName, tuple(SYMBOL_SECTIONS)
+                    ),
+                ),
+            ),
+        ):
+            for string in await section.resource.get_descendants(
+                r_filter=ResourceFilter(tags=(AsciiString,))
+            ):
+                section_names[string.get_id()] = section.name
+    return triage_strings(strings, min_length, categories, section_names)
+
+
+async def get_section_name(resource: Resource) -> Optional[str]:
+    """
+    :return: the name of the innermost named section which is or holds `resource`, or None if
+        there is none
+    """
+    sections = list(
+        await resource.get_ancestors(
+            ResourceFilter(tags=(NamedProgramSection,), include_self=True)
+        )
+    )
+    if not sections:
+        return None
+    # Ancestors are listed from the innermost out
+    return (await sections[0].view_as(NamedProgramSection)).name
@@ -0,0 +1,377 @@
+"""
+Throughput benchmarks of the ChatGPT string modifiers against the
+[mock OpenAI server][ofrak_ai_test.mock_openai.MockOpenAIServer], so that performance regressions
+show up without an API key.
+
+Run `python -m ofrak_ai_test.benchmark --help` (or `make benchmark`) for the available options.
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import ofrak_ai
+from ofrak import OFRAK, OFRAKContext, Resource, ResourceFilter
+from ofrak.core.binary import GenericBinary
+from ofrak.core.strings import AsciiString
+from ofrak_type import Range
+from ofrak_ai.chatgpt import OpenAICompatibleBackend
+from ofrak_ai.chatgpt_string_modifier import (
+    ChatGPTBatchStringModifier,
+    ChatGPTBatchStringModifierConfig,
+    ChatGPTStringModifier,
+    ChatGPTStringModifierConfig,
+)
+from ofrak_ai.string_triage import triage_string_descendants
+from ofrak_ai.metrics import MetricsRecorder, add_metrics_hook, remove_metrics_hook
+from ofrak_ai_test.mock_openai import MockOpenAIConfig, MockOpenAIServer
+
+ASSETS_DIR = os.path.join(os.path.dirname(__file__), "assets")
+REGULAR_STRINGS_SOURCE = os.path.join(ASSETS_DIR, "regular_strings.c")
+
+WORDS = [
+    "activation",
+    "assembly",
+    "buffer",
+    "context",
+    "debugger",
+    "directory",
+    "exception",
+    "failed",
+    "handle",
+    "invalid",
+    "memory",
+    "parameter",
+    "process",
+    "recovery",
+    "section",
+    "security",
+    "status",
+    "while",
+]
+SPECIFIERS = ["%s", "%d", "0x%x", "%04x", "%lu", "%p"]
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    :param name: the name of the benchmark
+    :param strings: the number of strings worth rewriting
+    :param seconds: the wall-clock time taken to rewrite and patch the strings
+    :param requests: the number of ChatGPT requests made
+    :param retries: the number of strings sent again because their reply was invalid
+    :param repairs: the number of invalid replies fixed locally instead of retried
+    :param rate_limited: the number of requests the server rejected with a rate limit error
+    :param peak_memory: the peak number of bytes allocated by Python while rewriting
+    """
+
+    name: str
+    strings: int
+    seconds: float
+    requests: int
+    retries: int
+    repairs: int
+    rate_limited: int
+    peak_memory: int
+
+    @property
+    def strings_per_second(self) -> float:
+        return self.strings / self.seconds if self.seconds else 0.0
+
+    @property
+    def requests_per_string(self) -> float:
+        return self.requests / self.strings if self.strings else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name:<24} {self.strings:>7} {self.seconds:>9.2f} "
+            f"{self.strings_per_second:>11.1f} {self.requests_per_string:>12.2f} "
+            f"{self.retries:>8} {self.repairs:>8} {self.rate_limited:>8} "
+            f"{self.peak_memory / 2 ** 20:>10.1f}"
+        )
+
+
+RESULT_HEADER = (
+    f"{'benchmark':<24} {'strings':>7} {'seconds':>9} {'strings/s':>11} "
+    f"{'calls/string':>12} {'retries':>8} {'repairs':>8} {'429s':>8} {'peak MiB':>10}"
+)
+
+
+def generate_strings(count: int, seed: int = 0) -> List[str]:
+    """
+    Generate `count` distinct strings shaped like the log messages and identifiers found in
+    binaries, all long enough to be rewritten with the default `min_length`.
+    """
+    rng = random.Random(seed)
+    strings = []
+    for i in range(count):
+        if i % 4 == 0:
+            words = [rng.choice(WORDS).capitalize() for _ in range(10)]
+            strings.append("".join(words) + f"Ex{i}W")
+        else:
+            words = [rng.choice(WORDS) for _ in range(10)]
+            for _ in range(rng.randrange(3)):
+                words.insert(rng.randrange(len(words)), rng.choice(SPECIFIERS))
+            strings.append(f"ERR{i}: " + " ".join(words).capitalize() + ".")
+    return strings
+
+
+def write_strings_source(path: str, strings: Sequence[str]):
+    """
+    Write a C program whose read-only data holds every one of `strings`.
+    """
+    with open(path, "w") as f:
+        f.write("#include <stdio.h>\n\nconst char *strings[] = {\n")
+        for text in strings:
+            f.write(f'    "{text}",\n')
+        f.write("};\n\n")
+        f.write(
+            "int main(int argc, char **argv)\n{\n"
+            "    puts(strings[argc % (sizeof(strings) / sizeof(*strings))]);\n"
+            "    return 0;\n}\n"
+        )
+
+
+def compile_source(source_path: str, output_path: str) -> str:
+    subprocess.run(["gcc", "-o", output_path, source_path], check=True)
+    return output_path
+
+
+async def load_elf(path: str, ofrak_context: OFRAKContext) -> Resource:
+    resource = await ofrak_context.create_root_resource_from_file(path)
+    await resource.unpack_recursively()
+    return resource
+
+
+async def load_strings(strings: Sequence[str], ofrak_context: OFRAKContext) -> Resource:
+    """
+    Create a resource holding null-terminated `strings` back to back, with an
+    [AsciiString][ofrak.core.strings.AsciiString] child per string, which stands in for an
+    unpacked binary without depending on its unpackers.
+    """
+    data = b"".join(text.encode("ascii") + b"\x00" for text in strings)
+    resource = await ofrak_context.create_root_resource(
+        "strings", data, tags=(GenericBinary,)
+    )
+    offset = 0
+    for text in strings:
+        await resource.create_child_from_view(
+            AsciiString(text), data_range=Range.from_size(offset, len(text) + 1)
+        )
+        offset += len(text) + 1
+    return resource
+
+
+async def rewrite_strings(
+    resource: Resource,
+    config: ChatGPTStringModifierConfig,
+    concurrency: int,
+):
+    """
+    Run a [ChatGPTStringModifier][ofrak_ai.chatgpt_string_modifier.ChatGPTStringModifier] on every
+    string descendant of `resource`, at most `concurrency` at a time, or a
+    [ChatGPTBatchStringModifier][ofrak_ai.chatgpt_string_modifier.ChatGPTBatchStringModifier] on
+    `resource` if `config` is a batch config.
+    """
+    if isinstance(config, ChatGPTBatchStringModifierConfig):
+        await resource.run(ChatGPTBatchStringModifier, config)
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def rewrite_string(string: Resource):
+        async with semaphore:
+            await string.run(ChatGPTStringModifier, config)
+
+    await asyncio.gather(
+        *(
+            rewrite_string(string)
+            for string in await resource.get_descendants(
+                r_filter=ResourceFilter(tags=(AsciiString,))
+            )
+        )
+    )
+
+
+async def run_benchmark(
+    name: str,
+    resource: Resource,
+    config: ChatGPTStringModifierConfig,
+    server: MockOpenAIServer,
+    concurrency: int = 64,
+) -> BenchmarkResult:
+    """
+    Rewrite the strings of an unpacked `resource` and measure how long it takes and how much work
+    it needs.
+    """
+    triage = await triage_string_descendants(
+        resource,
+        config.min_length,
+        config.rewrite_categories,
+    )
+    recorder = MetricsRecorder()
+    rate_limited = server.statistics.rate_limited
+
+    add_metrics_hook(recorder)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        await rewrite_strings(resource, config, concurrency)
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        remove_metrics_hook(recorder)
+
+    return BenchmarkResult(
+        name=name,
+        strings=len(triage.rewrite),
+        seconds=seconds,
+        requests=sum(recorder.calls.values()),
+        retries=sum(
+            retries * count for retries, count in recorder.string_retries.items()
+        ),
+        repairs=recorder.repairs,
+        rate_limited=server.statistics.rate_limited - rate_limited,
+        peak_memory=peak_memory,
+    )
+
+
+async def run_benchmarks(args: argparse.Namespace) -> List[BenchmarkResult]:
+    server_config = MockOpenAIConfig(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        rate_limit_rate=args.rate_limit_rate,
+        overlength_rate=args.overlength_rate,
+        broken_specifier_rate=args.broken_specifier_rate,
+        seed=args.seed,
+    )
+    config_type = (
+        ChatGPTBatchStringModifierConfig if args.batch else ChatGPTStringModifierConfig
+    )
+    backend = OpenAICompatibleBackend("", pool_size=args.pool_size)
+    config = config_type(
+        backend=backend,
+        num_choices=args.num_choices,
+        stream=args.stream,
+        local_repair=not args.no_local_repair,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+    )
+
+    ofrak = OFRAK(logging.WARNING)
+    ofrak.discover(ofrak_ai)
+    ofrak_context = await ofrak.create_ofrak_context()
+    recorder = MetricsRecorder()
+    add_metrics_hook(recorder)
+    results = []
+    try:
+        async with MockOpenAIServer(server_config) as server:
+            backend.api_base = server.api_base
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                loaders = []
+                if not args.flat:
+                    elf_path = compile_source(
+                        REGULAR_STRINGS_SOURCE, os.path.join(tmp_dir, "regular_strings")
+                    )
+                    loaders.append(
+                        ("regular_strings", functools.partial(load_elf, elf_path))
+                    )
+                for count in args.strings:
+                    strings = generate_strings(count, args.seed)
+                    if args.flat:
+                        loaders.append(
+                            (f"flat_{count}", functools.partial(load_strings, strings))
+                        )
+                        continue
+                    source_path = os.path.join(tmp_dir, f"strings_{count}.c")
+                    write_strings_source(source_path, strings)
+                    elf_path = compile_source(
+                        source_path, os.path.join(tmp_dir, f"strings_{count}")
+                    )
+                    loaders.append(
+                        (f"elf_{count}", functools.partial(load_elf, elf_path))
+                    )
+
+                for name, load in loaders:
+                    resource = await load(ofrak_context)
+                    result = await run_benchmark(
+                        name, resource, config, server, args.concurrency
+                    )
+                    print(result, flush=True)
+                    results.append(result)
+    finally:
+        remove_metrics_hook(recorder)
+        await backend.close()
+        await ofrak_context.shutdown_context()
+    print(recorder.summary(), flush=True)
+    if args.prometheus:
+        recorder.write_prometheus(args.prometheus)
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None) -> List[BenchmarkResult]:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ChatGPT string modifiers against a mock OpenAI server"
+    )
+    parser.add_argument(
+        "--strings",
+        type=int,
+        nargs="*",
+        default=[1000, 5000],
+        help="the numbers of strings in the synthetic binaries",
+    )
+    parser.add_argument(
+        "--flat",
+        action="store_true",
+        help="rewrite synthetic strings resources instead of compiled and unpacked ELFs",
+    )
+    parser.add_argument(
+        "--batch", action="store_true", help="use ChatGPTBatchStringModifier"
+    )
+    parser.add_argument("--stream", action="store_true", help="stream replies")
+    parser.add_argument("--num-choices", type=int, default=1)
+    parser.add_argument("--no-local-repair", action="store_true")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=64,
+        help="the maximum number of strings rewritten at once",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=100,
+        help="the maximum number of connections to the mock server",
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency-jitter", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--overlength-rate", type=float, default=0.1)
+    parser.add_argument("--broken-specifier-rate", type=float, default=0.05)
+    # The mock server does not enforce a quota, so by default only the client-side limiter's
+    # overhead is measured rather than its waits
+    parser.add_argument("--requests-per-minute", type=int, default=1_000_000)
+    parser.add_argument("--tokens-per-minute", type=int, default=100_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--prometheus",
+        help="a path to write the metrics of every run to in the Prometheus text format",
+    )
+    args = parser.parse_args(argv)
+
+    print(RESULT_HEADER, flush=True)
+    return asyncio.run(run_benchmarks(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -34,3 +34,23 @@ async def ofrak_context(ofrak):
     context = await ofrak.create_ofrak_context()
     yield context
     await context.shutdown_context()
+
+
+@pytest.fixture
+async def mock_openai(monkeypatch):
+    import openai
+    from ofrak_ai_test.mock_openai import MockOpenAIServer
+
+    async with MockOpenAIServer() as server:
+        monkeypatch.setattr(openai, "api_base", server.api_base)
+        yield server
+
+
+@pytest.fixture
+def recorder():
+    from ofrak_ai.metrics import MetricsRecorder, add_metrics_hook, remove_metrics_hook
+
+    recorder = MetricsRecorder()
+    add_metrics_hook(recorder)
+    yield recorder
+    remove_metrics_hook(recorder)
@@ -0,0 +1,286 @@
+"""
+A local stand-in for the OpenAI ChatCompletion endpoint, so that the string modifiers can be tested
+and benchmarked without an API key or network access.
+
+The server rewrites every string it is asked about deterministically, and can be configured to be
+slow, to reject requests with rate limit errors, or to reply with rewrites which are too long or
+have broken format specifiers, in order to exercise the retry and repair paths.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+from ofrak_ai.chatgpt_string_modifier import SPECIFIER_PATTERN
+
+# The original string is the whole user message of the first request of ChatGPTStringModifier, and
+# is quoted in its retry requests
+RETRY_PATTERN = re.compile(
+    r"\nOriginal message: (.*?)\nYour previous version: ", re.DOTALL
+)
+
+
+@dataclass
+class MockOpenAIConfig:
+    """
+    :param latency: the number of seconds to wait before replying to a request
+    :param latency_jitter: the maximum fraction of `latency` randomly added to each request's
+        latency
+    :param slow_requests: the numbers of the requests, counting from 1, which take `slow_latency`
+        seconds instead of `latency`, e.g. to trigger hedging
+    :param slow_latency: the number of seconds to wait before replying to `slow_requests`
+    :param rate_limit_rate: the probability of rejecting a request with a rate limit error
+    :param overlength_rate: the probability of each rewrite being longer than the original
+    :param broken_specifier_rate: the probability of each rewrite not having the same format
+        specifiers as the original
+    :param retry_after: the number of seconds rate limit errors ask the client to wait before
+        retrying, sent in their Retry-After header, or None to not send the header
+    :param stream_chunk_size: the number of characters sent per chunk of streamed replies
+    :param null_content_deltas: whether the first and last chunks of streamed replies have a
+        `"content": null` delta, as some OpenAI-compatible servers send, instead of no content
+    :param seed: the seed of the random faults, so that runs are reproducible
+    """
+
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    slow_requests: FrozenSet[int] = frozenset()
+    slow_latency: float = 0.0
+    rate_limit_rate: float = 0.0
+    overlength_rate: float = 0.0
+    broken_specifier_rate: float = 0.0
+    retry_after: Optional[float] = None
+    stream_chunk_size: int = 8
+    null_content_deltas: bool = False
+    seed: int = 0
+
+
+@dataclass
+class MockOpenAIStatistics:
+    """
+    :param requests: the number of requests received, including rejected ones
+    :param rate_limited: the number of requests rejected with a rate limit error
+    :param overlength: the number of rewrites made too long
+    :param broken_specifiers: the number of rewrites with broken format specifiers
+    :param connections: the number of distinct client connections requests were received on
+    """
+
+    requests: int = 0
+    rate_limited: int = 0
+    overlength: int = 0
+    broken_specifiers: int = 0
+    connections: int = 0
+
+
+class MockOpenAIServer:
+    """
+    Serve `POST /v1/chat/completions` on a free local port. Point `openai.api_base` at
+    [api_base][ofrak_ai_test.mock_openai.MockOpenAIServer.api_base] once the server is started.
+    """
+
+    def __init__(self, config: Optional[MockOpenAIConfig] = None):
+        self.config = config or MockOpenAIConfig()
+        self.statistics = MockOpenAIStatistics()
+        self._random = random.Random(self.config.seed)
+        self._runner: Optional[web.AppRunner] = None
+        self._port: Optional[int] = None
+        self._peers: Set[Tuple[str, int]] = set()
+        self._delayed: Set[asyncio.Task] = set()
+
+    @property
+    def api_base(self) -> str:
+        if self._port is None:
+            raise RuntimeError("The mock OpenAI server is not running")
+        return f"http://127.0.0.1:{self._port}/v1"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_chat_completion)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self._port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        # Requests whose client went away are no longer waited for by the runner, so end any which
+        # are still being delayed rather than leaving them pending when the event loop closes
+        for task in self._delayed:
+            task.cancel()
+        await asyncio.gather(*self._delayed, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+        self._runner = None
+        self._port = None
+
+    async def __aenter__(self) -> "MockOpenAIServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def _handle_chat_completion(self, request: web.Request) -> web.StreamResponse:
+        self.statistics.requests += 1
+        if request.transport is not None:
+            self._peers.add(request.transport.get_extra_info("peername"))
+            self.statistics.connections = len(self._peers)
+        body = await request.json()
+        if self.statistics.requests in self.config.slow_requests:
+            await self._delay(self.config.slow_latency)
+        else:
+            await self._delay(
+                self.config.latency
+                * (1 + self.config.latency_jitter * self._random.random())
+            )
+        if self._random.random() < self.config.rate_limit_rate:
+            self.statistics.rate_limited += 1
+            headers = {}
+            if self.config.retry_after is not None:
+                headers["retry-after-ms"] = str(int(self.config.retry_after * 1000))
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Rate limit reached for requests",
+                        "type": "requests",
+                        "param": None,
+                        "code": None,
+                    }
+                },
+                status=429,
+                headers=headers,
+            )
+
+        messages = body["messages"]
+        contents = [self._get_reply(messages) for _ in range(body.get("n", 1))]
+        if body.get("stream"):
+            return await self._stream(request, body["model"], contents)
+
+        prompt_tokens = sum(_count_tokens(message["content"]) for message in messages)
+        completion_tokens = sum(_count_tokens(content) for content in contents)
+        return web.json_response(
+            {
+                "id": f"chatcmpl-mock{self.statistics.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": index,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                    for index, content in enumerate(contents)
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        )
+
+    async def _delay(self, seconds: float):
+        task = asyncio.current_task()
+        assert task is not None
+        self._delayed.add(task)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._delayed.discard(task)
+
+    async def _stream(
+        self, request: web.Request, model: str, contents: List[str]
+    ) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunk_size = self.config.stream_chunk_size
+        chunks = [
+            {
+                index: content[i : i + chunk_size]
+                for index, content in enumerate(contents)
+            }
+            for i in range(0, max(map(len, contents), default=0), chunk_size)
+        ]
+        empty: Dict[str, Optional[str]] = (
+            {"content": None} if self.config.null_content_deltas else {}
+        )
+        try:
+            await response.write(
+                _get_event(model, [{"role": "assistant", **empty} for _ in contents])
+            )
+            for pieces in chunks:
+                await response.write(
+                    _get_event(model, [{"content": piece} for piece in pieces.values()])
+                )
+            await response.write(_get_event(model, [empty for _ in contents], "stop"))
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # The client abandoned the stream
+            return response
+        await response.write_eof()
+        return response
+
+    def _get_reply(self, messages: List[Dict[str, str]]) -> str:
+        content = messages[-1]["content"]
+        try:
+            entries = json.loads(content)
+        except json.JSONDecodeError:
+            entries = None
+        if isinstance(entries, list):
+            # A batch of strings from ChatGPTBatchStringModifier
+            return json.dumps(
+                {entry["id"]: self._rewrite(entry["text"]) for entry in entries}
+            )
+        match = RETRY_PATTERN.search(content)
+        if match:
+            return self._rewrite(match.group(1))
+        return self._rewrite(content)
+
+    def _rewrite(self, text: str) -> str:
+        # Swap the case of everything but the format specifiers, which keeps the rewrite valid and
+        # exactly as long as the original
+        parts = []
+        end = 0
+        for match in SPECIFIER_PATTERN.finditer(text):
+            parts.append(text[end : match.start(2)].swapcase())
+            parts.append(match.group(2))
+            end = match.end(2)
+        parts.append(text[end:].swapcase())
+        result = "".join(parts)
+
+        if self._random.random() < self.config.broken_specifier_rate:
+            self.statistics.broken_specifiers += 1
+            stripped = SPECIFIER_PATTERN.sub(lambda match: match.group(1), result)
+            result = stripped if stripped != result else result[:-2] + "%n"
+        if self._random.random() < self.config.overlength_rate:
+            self.statistics.overlength += 1
+            result = ("Oh great, " if " " in text else "Obviously") + result
+        return result
+
+
+def _get_event(
+    model: str,
+    deltas: List[Dict[str, Optional[str]]],
+    finish_reason: Optional[str] = None,
+) -> bytes:
+    chunk = {
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {"index": index, "delta": delta, "finish_reason": finish_reason}
+            for index, delta in enumerate(deltas)
+        ],
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+def _count_tokens(text: str) -> int:
+    # About 4 characters per token is close enough for settling the client's rate limiter
+    return max(1, len(text) // 4)
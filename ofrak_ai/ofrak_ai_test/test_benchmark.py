@@ -0,0 +1,15 @@
+from ofrak_ai_test import benchmark
+
+
+def test_benchmark_reports_throughput():
+    results = benchmark.main(
+        ["--flat", "--strings", "40", "--latency", "0", "--overlength-rate", "0.5"]
+    )
+
+    assert len(results) == 1
+    result = results[0]
+    assert result.strings == 40
+    assert result.requests_per_string >= 1
+    assert result.retries + result.repairs > 0
+    assert result.strings_per_second > 0
+    assert result.peak_memory > 0
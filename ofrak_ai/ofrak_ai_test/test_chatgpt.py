@@ -0,0 +1,241 @@
+import asyncio
+import collections
+import openai
+import pytest
+import time
+
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+from openai.error import RateLimitError
+from ofrak_ai.chatgpt import (
+    DEFAULT_BACKEND,
+    APICredentials,
+    ChatCompletionBackend,
+    ChatGPTConfig,
+    OpenAIBackend,
+    OpenAICompatibleBackend,
+    ModelType,
+    TokenBucketRateLimiter,
+    count_prompt_tokens,
+    get_chatgpt_response,
+    get_encoding,
+    get_rate_limiter,
+)
+from ofrak_ai_test.mock_openai import MockOpenAIServer
+
+
+async def test_rate_limiter_admits_burst_then_waits_for_tokens():
+    limiter = TokenBucketRateLimiter(requests_per_minute=600, tokens_per_minute=6_000)
+    start = time.monotonic()
+    await limiter.acquire(6_000)
+    assert time.monotonic() - start < 0.1
+
+    # The bucket refills at 100 tokens per second
+    await limiter.acquire(50)
+    assert time.monotonic() - start >= 0.45
+
+
+async def test_rate_limiter_settles_unused_tokens():
+    limiter = TokenBucketRateLimiter(requests_per_minute=600, tokens_per_minute=6_000)
+    await limiter.acquire(6_000)
+    limiter.settle(6_000, 1_000)
+
+    start = time.monotonic()
+    await limiter.acquire(5_000)
+    assert time.monotonic() - start < 0.1
+
+
+def test_rate_limiter_is_shared_per_model():
+    config = ChatGPTConfig(model=ModelType.FOUR, requests_per_minute=10)
+    limiter = get_rate_limiter(config)
+    assert limiter is get_rate_limiter(ChatGPTConfig(model=ModelType.FOUR))
+    assert limiter is not get_rate_limiter(
+        ChatGPTConfig(model=ModelType.THREE_FIVE_TURBO)
+    )
+    assert get_rate_limiter(ChatGPTConfig(model="unknown-model")) is None
+
+
+def test_rate_limiter_is_shared_per_key():
+    config = ChatGPTConfig(model=ModelType.FOUR)
+    limiter = get_rate_limiter(config, "key-a")
+    assert limiter is get_rate_limiter(config, "key-a")
+    assert limiter is not get_rate_limiter(config, "key-b")
+    assert limiter is not get_rate_limiter(config)
+
+
+def test_count_prompt_tokens():
+    history = [{"role": "user", "content": "hello world"}]
+    # 3 priming tokens, 4 message tokens, 1 for the role and 2 for the content
+    assert count_prompt_tokens(history, ModelType.THREE_FIVE_TURBO) == 10
+
+
+def test_get_encoding_is_cached_per_model():
+    encoding = get_encoding(ModelType.FOUR_32K)
+    assert get_encoding(ModelType.FOUR_32K) is encoding
+    assert encoding.name == "cl100k_base"
+    assert get_encoding("unknown-model").name == "cl100k_base"
+
+
+def stream_chunk(index: int, content: str, finish_reason=None) -> OpenAIObject:
+    return convert_to_openai_object(
+        {
+            "choices": [
+                {
+                    "index": index,
+                    "delta": {"content": content},
+                    "finish_reason": finish_reason,
+                }
+            ]
+        }
+    )
+
+
+@pytest.fixture
+def streamed_chunks(monkeypatch):
+    received = []
+
+    async def acreate(**kwargs):
+        assert kwargs["stream"]
+
+        async def stream():
+            for content in ["Sure! ", "Here ", "is ", "a ", "very ", "long ", "reply"]:
+                received.append(content)
+                yield stream_chunk(0, content)
+            yield stream_chunk(0, "", "stop")
+
+        return stream()
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    return received
+
+
+async def test_streamed_response(streamed_chunks):
+    config = ChatGPTConfig(model="unknown-model", stream=True)
+    response = await get_chatgpt_response([], 100, config)
+
+    assert response.choices[0].message.content == "Sure! Here is a very long reply"
+    assert response.choices[0].finish_reason == "stop"
+
+
+async def test_streamed_response_is_abandoned(streamed_chunks):
+    config = ChatGPTConfig(model="unknown-model", stream=True)
+    response = await get_chatgpt_response(
+        [], 100, config, is_viable=lambda content: len(content) <= 12
+    )
+
+    assert response.choices[0].message.content == "Sure! Here is "
+    assert response.choices[0].finish_reason == "abandoned"
+    assert len(streamed_chunks) == 3
+
+
+HELLO = [
+    {"role": "system", "content": "You are a pirate. Make each message more piratey."},
+    {"role": "user", "content": "Hello"},
+]
+
+
+async def test_compatible_backend_reuses_connections(mock_openai: MockOpenAIServer):
+    backend = OpenAICompatibleBackend(mock_openai.api_base, pool_size=1)
+    config = ChatGPTConfig(model="local-model", api_key=None, backend=backend)
+    try:
+        responses = [await get_chatgpt_response(HELLO, 10, config) for _ in range(3)]
+    finally:
+        await backend.close()
+
+    assert [response.choices[0].message.content for response in responses] == [
+        "hELLO"
+    ] * 3
+    assert mock_openai.statistics.requests == 3
+    assert mock_openai.statistics.connections == 1
+
+
+async def test_streamed_response_with_null_content(mock_openai: MockOpenAIServer):
+    mock_openai.config.null_content_deltas = True
+    backend = OpenAICompatibleBackend(mock_openai.api_base)
+    config = ChatGPTConfig(model="local-model", backend=backend, stream=True)
+    response = await get_chatgpt_response(HELLO, 10, config)
+    await backend.close()
+
+    assert response.choices[0].message.content == "hELLO"
+    assert response.choices[0].finish_reason == "stop"
+
+
+async def test_custom_backend():
+    class EchoBackend(ChatCompletionBackend):
+        async def create(self, config: ChatGPTConfig, **kwargs):
+            content = kwargs["messages"][-1]["content"]
+            return convert_to_openai_object(
+                {"choices": [{"index": 0, "message": {"content": content}}]}
+            )
+
+    with pytest.raises(TypeError):
+        ChatCompletionBackend()  # type: ignore[abstract]
+    backend = EchoBackend()
+    config = ChatGPTConfig(model="local-model", backend=backend)
+    response = await get_chatgpt_response(HELLO, 10, config)
+    await backend.close()
+
+    assert response.choices[0].message.content == "Hello"
+
+
+async def test_default_backend_uses_openai_api_base(mock_openai: MockOpenAIServer):
+    config = ChatGPTConfig(model="local-model", api_key="mock")
+    response = await get_chatgpt_response(HELLO, 10, config)
+
+    assert isinstance(DEFAULT_BACKEND, OpenAIBackend)
+    assert response.choices[0].message.content == "hELLO"
+    assert mock_openai.statistics.requests == 1
+
+
+async def test_api_key_pool_balances_requests(monkeypatch):
+    keys = []
+
+    async def acreate(**kwargs):
+        keys.append((kwargs["api_key"], kwargs["organization"]))
+        await asyncio.sleep(0.01)
+        return convert_to_openai_object({"choices": []})
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    config = ChatGPTConfig(
+        model="unknown-model",
+        api_key_pool=[
+            APICredentials("balanced-a", "org-a"),
+            APICredentials("balanced-b", "org-b"),
+        ],
+    )
+    await asyncio.gather(*(get_chatgpt_response(HELLO, 10, config) for _ in range(4)))
+
+    assert collections.Counter(keys) == {
+        ("balanced-a", "org-a"): 2,
+        ("balanced-b", "org-b"): 2,
+    }
+
+
+async def test_rate_limited_key_cools_down(monkeypatch):
+    keys = []
+
+    async def acreate(**kwargs):
+        keys.append(kwargs["api_key"])
+        if kwargs["api_key"] == "limited-a":
+            raise RateLimitError("Rate limit reached for requests", headers={})
+        return convert_to_openai_object({"choices": []})
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    config = ChatGPTConfig(
+        model="unknown-model",
+        api_key_pool=[APICredentials("limited-a"), APICredentials("limited-b")],
+    )
+    start = time.monotonic()
+    for _ in range(3):
+        await get_chatgpt_response(HELLO, 10, config)
+
+    # The request is sent again with the other key without backing off, and the limited key is
+    # left alone while it cools down
+    assert time.monotonic() - start < config.retry_policy.initial_delay
+    assert keys == ["limited-a", "limited-b", "limited-b", "limited-b"]
+
+    # Once every key is limited, requests back off as usual
+    config.api_key_pool = [APICredentials("limited-a")]
+    config.retry_policy.max_retries = 0
+    with pytest.raises(RateLimitError):
+        await get_chatgpt_response(HELLO, 10, config)
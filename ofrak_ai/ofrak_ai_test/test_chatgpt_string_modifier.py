@@ -1,17 +1,44 @@
 import asyncio
+import json
 import os
 import pytest
 import subprocess
 
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+from ofrak.core.binary import GenericBinary
 from ofrak.ofrak_context import OFRAKContext
 from ofrak.resource import Resource
-from ofrak.service.resource_service_i import ResourceFilter
+from ofrak.service.resource_service_i import (
+    ResourceAttributeValueFilter,
+    ResourceFilter,
+)
 from ofrak.core.strings import AsciiString
+from ofrak_type import Range
+from ofrak_ai import chatgpt_string_modifier
+from ofrak_ai.chatgpt import ChatGPTConfig, ModelType, count_prompt_tokens, get_encoding
 from ofrak_ai.chatgpt_string_modifier import (
+    ChatGPTBatchStringModifier,
+    ChatGPTBatchStringModifierConfig,
     ChatGPTStringModifier,
     ChatGPTStringModifierConfig,
+    StringType,
     VoiceType,
+    _estimate_batch_usage,
+    _finalize_result,
+    _get_encoding,
+    _is_viable_result,
+    _repair_result,
+    _route,
 )
+from ofrak_ai.metrics import CallMetrics, record_call
+from ofrak_ai.model_router import ModelRouter
+from ofrak_ai.scheduler import RewriteBudget
+from ofrak_ai.string_journal import get_rewrite_journal
+from ofrak_ai_test.mock_openai import MockOpenAIServer
 
 SOURCE_DIR = os.path.join(os.path.dirname(__file__), "assets/")
 SOURCE_FILE = "regular_strings.c"
@@ -65,3 +92,575 @@ async def test_sassy_string_modifier(resource: Resource, elf_file):
     modified = subprocess.run(sassy_path, capture_output=True, text=True)
     assert modified.returncode == original.returncode
     assert original.stdout != modified.stdout
+
+
+LONG_SENTENCE = "SXS: %s() NtCreateSection() failed. Status = 0x%x.\n"
+LONG_IDENTIFIER = "ConvertStringSecurityDescriptorToSecurityDescriptorW"
+
+
+def chatgpt_response(*contents: str) -> OpenAIObject:
+    return convert_to_openai_object(
+        {
+            "choices": [
+                {"index": i, "message": {"role": "assistant", "content": content}}
+                for i, content in enumerate(contents)
+            ]
+        }
+    )
+
+
+@dataclass
+class FakeRequest:
+    history: List[Dict[str, str]]
+    max_tokens: int
+    config: ChatGPTConfig
+
+    @property
+    def entries(self) -> List[Dict[str, str]]:
+        return json.loads(self.history[-1]["content"])
+
+    @property
+    def texts(self) -> List[str]:
+        return [entry["text"] for entry in self.entries]
+
+
+def swap_case(entry: Dict[str, str]) -> str:
+    return entry["text"].swapcase()
+
+
+class FakeChatGPT:
+    """
+    Stands in for `get_chatgpt_response` and records every request. Each entry of a batch request is
+    answered with `rewrite(entry)`, and a single string request with `rewrite({"text": content})`.
+    `on_request` is awaited before answering, e.g. to delay or fail a request.
+    """
+
+    def __init__(self):
+        self.requests: List[FakeRequest] = []
+        self.rewrite: Callable[[Dict[str, str]], str] = swap_case
+        self.preamble = ""
+        self.on_request: Optional[Callable[[FakeRequest], Awaitable[None]]] = None
+
+    async def get_chatgpt_response(self, history, max_tokens, config, is_viable=None):
+        request = FakeRequest(history, max_tokens, config)
+        self.requests.append(request)
+        if self.on_request is not None:
+            await self.on_request(request)
+        if isinstance(config, ChatGPTBatchStringModifierConfig):
+            replies = {entry["id"]: self.rewrite(entry) for entry in request.entries}
+            return chatgpt_response(self.preamble + json.dumps(replies))
+        return chatgpt_response(self.rewrite({"text": history[-1]["content"]}))
+
+
+@pytest.fixture
+def fake_chatgpt(monkeypatch) -> FakeChatGPT:
+    fake = FakeChatGPT()
+    monkeypatch.setattr(
+        chatgpt_string_modifier, "get_chatgpt_response", fake.get_chatgpt_response
+    )
+    return fake
+
+
+@pytest.fixture
+def string_resource_data() -> bytes:
+    return b"\x00".join(
+        [b"short", LONG_SENTENCE.encode("ascii"), LONG_IDENTIFIER.encode("ascii"), b""]
+    )
+
+
+async def create_strings_resource(ofrak_context: OFRAKContext, data: bytes) -> Resource:
+    resource = await ofrak_context.create_root_resource(
+        "strings", data, tags=(GenericBinary,)
+    )
+    offset = 0
+    for raw in data.split(b"\x00")[:-1]:
+        await resource.create_child_from_view(
+            AsciiString(raw.decode("ascii")),
+            data_range=Range(offset, offset + len(raw) + 1),
+        )
+        offset += len(raw) + 1
+    return resource
+
+
+@pytest.fixture
+async def strings_resource(
+    ofrak_context: OFRAKContext, string_resource_data
+) -> Resource:
+    return await create_strings_resource(ofrak_context, string_resource_data)
+
+
+@pytest.fixture
+async def sentence(strings_resource: Resource) -> Resource:
+    return await strings_resource.get_only_descendant(
+        r_filter=ResourceFilter(
+            tags=(AsciiString,),
+            attribute_filters=(
+                ResourceAttributeValueFilter(AsciiString.Text, LONG_SENTENCE),
+            ),
+        )
+    )
+
+
+@pytest.mark.parametrize("bulk_patch", [True, False])
+async def test_batch_string_modifier(
+    strings_resource: Resource, string_resource_data, bulk_patch, fake_chatgpt
+):
+    def rewrite(entry):
+        if entry["type"] == "identifier":
+            return "SassySecurityDescriptorW"
+        if "previous" in entry:
+            return "SXS: %s() flopped, obviously. Status = 0x%x."
+        # Too long, so only this string should be sent again
+        return "Oh great, " + entry["text"]
+
+    fake_chatgpt.rewrite = rewrite
+    fake_chatgpt.preamble = "Sure! Here you go:\n"
+    await strings_resource.run(
+        ChatGPTBatchStringModifier,
+        ChatGPTBatchStringModifierConfig(bulk_patch=bulk_patch, local_repair=False),
+    )
+
+    requests = [request.entries for request in fake_chatgpt.requests]
+    assert len(requests) == 2
+    assert sorted(entry["text"] for entry in requests[0]) == [
+        LONG_IDENTIFIER,
+        LONG_SENTENCE,
+    ]
+    assert [entry["text"] for entry in requests[1]] == [LONG_SENTENCE]
+    assert requests[1][0]["problem"] == (
+        "Make it shorter, it is 10 characters too long."
+    )
+
+    data = await strings_resource.get_data()
+    assert b"SXS: %s() flopped, obviously. Status = 0x%x.\x00" in data
+    assert b"SassySecurityDescriptorW\x00" in data
+    assert len(data) == len(string_resource_data)
+
+
+async def test_cached_rewrites_skip_api(
+    ofrak_context: OFRAKContext, string_resource_data, tmp_path, fake_chatgpt, recorder
+):
+    fake_chatgpt.rewrite = lambda entry: entry["text"].replace("e", "3")
+    config = ChatGPTBatchStringModifierConfig(cache_path=str(tmp_path / "cache.sqlite"))
+    outputs = []
+    for _ in range(2):
+        resource = await create_strings_resource(ofrak_context, string_resource_data)
+        await resource.run(ChatGPTBatchStringModifier, config)
+        outputs.append(await resource.get_data())
+
+    assert len(fake_chatgpt.requests) == 1
+    assert outputs[0] == outputs[1] != string_resource_data
+    # Every string missed the cache in the first run and hit it in the second
+    assert (
+        recorder.cache_hits
+        == recorder.cache_misses
+        == len(fake_chatgpt.requests[0].entries)
+    )
+
+
+@pytest.mark.parametrize(
+    "text,result,str_type,expected",
+    [
+        # Specifiers are put back in their original order
+        (
+            "Status %d returned for %s",
+            "For %s, status %d!",
+            StringType.SENTENCE,
+            "For %d, status %s!",
+        ),
+        # Filler words are dropped until the reply fits, before anything is cut
+        (
+            "Failed to open the configuration file",
+            "Really just failed to open the config file",
+            StringType.SENTENCE,
+            "just failed to open the config file",
+        ),
+        # Cut at a sentence boundary
+        (
+            "Failed to open the configuration file",
+            "Ugh, no config file for you. Try harder next time!",
+            StringType.SENTENCE,
+            "Ugh, no config file for you.",
+        ),
+        # Cut at a word boundary, keeping the specifiers
+        (
+            "SXS: %s() failed. Status = 0x%x.",
+            "SXS: %s() flopped, status = 0x%x, as if I care about it",
+            StringType.SENTENCE,
+            "SXS: %s() flopped, status = 0x%x",
+        ),
+        # Cut identifiers between camel case words and remove emojis
+        (
+            "ConvertStringSecurityDescriptorToSecurityDescriptorW",
+            "\U0001f485ObviouslyConvertTheStringSecurityDescriptorToSecurityDescriptorW",
+            StringType.IDENTIFIER,
+            "ObviouslyConvertTheStringSecurityDescriptorTo",
+        ),
+        # Specifiers cannot be recovered
+        ("Status %d returned for %s", "Status returned", StringType.SENTENCE, None),
+    ],
+)
+def test_repair_result(text, result, str_type, expected):
+    assert _repair_result(text, result, str_type) == expected
+
+
+@pytest.mark.parametrize(
+    "result,expected",
+    [
+        # The repair of a rambling reply, which is exactly the original length, is kept whole
+        ("SXS: %s() flopped, status = 0x%x", "SXS: %s() flopped, status = 0x%x"),
+        # Truncating to the original length would cut the final specifier in two
+        ("SXS: %s() flopped, status is 0x%x", None),
+    ],
+)
+def test_finalize_result_keeps_specifiers(result, expected):
+    assert _finalize_result("SXS: %s() failed. Status = 0x%x.", result) == expected
+
+
+async def test_local_repair_avoids_retry(
+    strings_resource: Resource, fake_chatgpt, recorder
+):
+    def rewrite(entry):
+        if entry["type"] == "identifier":
+            return "Obviously" + entry["text"]
+        return entry["text"].strip() + " Obviously."
+
+    fake_chatgpt.rewrite = rewrite
+    await strings_resource.run(
+        ChatGPTBatchStringModifier, ChatGPTBatchStringModifierConfig()
+    )
+
+    assert len(fake_chatgpt.requests) == 1
+    assert recorder.repairs == 2
+
+
+async def test_retries_use_compact_prompts(sentence: Resource, fake_chatgpt):
+    # Never shorter, and missing a specifier on the last attempt
+    fake_chatgpt.rewrite = lambda entry: (
+        "Oh great, " + LONG_SENTENCE
+        if len(fake_chatgpt.requests) < 3
+        else "Status = 0x%x"
+    )
+    await sentence.run(
+        ChatGPTStringModifier, ChatGPTStringModifierConfig(local_repair=False)
+    )
+
+    histories = [request.history for request in fake_chatgpt.requests]
+    assert len(histories) == 5
+    for history in histories[1:]:
+        assert history[0] == histories[0][0]
+        assert len(history) == 2
+        assert LONG_SENTENCE in history[1]["content"]
+        assert "Oh great, " + LONG_SENTENCE in history[1]["content"]
+        assert "10 characters too long" in history[1]["content"]
+        assert f"at most {len(LONG_SENTENCE)} characters" in history[1]["content"]
+    # The best attempt had the right specifiers, but truncating it would cut off the last one, so
+    # the original is kept
+    assert await sentence.get_data() == LONG_SENTENCE.encode("ascii") + b"\x00"
+
+
+async def test_best_of_multiple_choices(sentence: Resource, monkeypatch):
+    calls = []
+
+    async def get_chatgpt_response(history, max_tokens, config, is_viable=None):
+        calls.append(config.num_choices)
+        return chatgpt_response(
+            "Oh great, " + LONG_SENTENCE,
+            "SXS: %s() flopped \U0001f485. Status = 0x%x.",
+            "SXS: %s() flopped, shocking. Status = 0x%x.",
+            "SXS: %s() flopped, shocking. Status = 0x%x, obviously.",
+            "SXS: flopped. Status = 0x%x.",
+        )
+
+    monkeypatch.setattr(
+        chatgpt_string_modifier, "get_chatgpt_response", get_chatgpt_response
+    )
+    await sentence.run(
+        ChatGPTStringModifier,
+        ChatGPTStringModifierConfig(num_choices=5, local_repair=False),
+    )
+
+    assert calls == [5]
+    assert (await sentence.get_data()).startswith(
+        b"SXS: %s() flopped, shocking. Status = 0x%x.\x00"
+    )
+
+
+@pytest.mark.parametrize(
+    "content,local_repair,expected",
+    [
+        ("SXS: %s() flopped", False, True),
+        ("SXS: %x", False, False),
+        ("SXS: %x", True, True),
+        ("SXS: %s %x %d", True, False),
+        ("Oh great, " + LONG_SENTENCE, False, False),
+        ("Oh great, " + LONG_SENTENCE, True, True),
+    ],
+)
+def test_is_viable_result(content, local_repair, expected):
+    config = ChatGPTStringModifierConfig(local_repair=local_repair)
+    assert (
+        _is_viable_result(LONG_SENTENCE, StringType.SENTENCE, config, content)
+        == expected
+    )
+
+
+@pytest.mark.parametrize("stream", [False, True])
+async def test_mock_openai_rewrites_strings(
+    sentence: Resource, mock_openai: MockOpenAIServer, stream
+):
+    await sentence.run(
+        ChatGPTStringModifier,
+        ChatGPTStringModifierConfig(api_key="mock", stream=stream),
+    )
+
+    assert mock_openai.statistics.requests == 1
+    assert (await sentence.get_data()).startswith(
+        b"sxs: %s() nTcREATEsECTION() FAILED. sTATUS = 0X%x.\n\x00"
+    )
+
+
+async def test_mock_openai_faults_are_retried(
+    sentence: Resource, mock_openai: MockOpenAIServer
+):
+    mock_openai.config.overlength_rate = 1.0
+    config = ChatGPTStringModifierConfig(api_key="mock", local_repair=False)
+    await sentence.run(ChatGPTStringModifier, config)
+
+    assert mock_openai.statistics.requests == 2 + config.max_retries
+    assert mock_openai.statistics.overlength == 2 + config.max_retries
+
+
+async def test_metrics_are_recorded(
+    sentence: Resource, mock_openai: MockOpenAIServer, recorder
+):
+    mock_openai.config.overlength_rate = 1.0
+    await sentence.run(
+        ChatGPTStringModifier,
+        ChatGPTStringModifierConfig(api_key="mock", local_repair=False),
+    )
+
+    assert recorder.calls == {ModelType.THREE_FIVE_TURBO: 5}
+    assert len(recorder.latencies) == 5
+    assert recorder.prompt_tokens[ModelType.THREE_FIVE_TURBO] > 0
+    assert recorder.cost[ModelType.THREE_FIVE_TURBO] > 0
+    # Every reply was too long, and truncating the last one cuts off a specifier
+    assert recorder.strings == 1
+    assert recorder.rewritten == 0
+    assert recorder.string_retries == {4: 1}
+    assert recorder.failures == {"length": 5}
+
+
+async def test_triage_skips_strings_not_worth_rewriting(
+    ofrak_context: OFRAKContext, fake_chatgpt
+):
+    skipped = [
+        "_ZN7example26VeryLongMangledFunctionNameEPKcmRKNSt7__cxx1112basic_stringE",
+        "/usr/lib/x86_64-linux-gnu/libstdc++.so.6.0.30/with/a/long/path",
+        "%s: %s (%d) %s: %s (%d) %s: %s (%d) %s: %s (%d) %s: %s (%d)",
+    ]
+    data = b"\x00".join([LONG_SENTENCE.encode("ascii")] + [s.encode() for s in skipped])
+    resource = await create_strings_resource(ofrak_context, data + b"\x00")
+    await resource.run(ChatGPTBatchStringModifier, ChatGPTBatchStringModifierConfig())
+
+    assert [request.texts for request in fake_chatgpt.requests] == [[LONG_SENTENCE]]
+    patched = await resource.get_data()
+    for text in skipped:
+        assert text.encode() in patched
+
+
+async def test_identical_strings_share_one_request(
+    ofrak_context: OFRAKContext, fake_chatgpt, recorder
+):
+    async def on_request(request):
+        await asyncio.sleep(0.01)
+
+    fake_chatgpt.rewrite = lambda entry: "SXS: %s() flopped, obviously. Status = 0x%x."
+    fake_chatgpt.on_request = on_request
+    data = b"\x00".join([LONG_SENTENCE.encode("ascii")] * 3 + [b""])
+    resources = [await create_strings_resource(ofrak_context, data) for _ in range(2)]
+    strings = [
+        string
+        for resource in resources
+        for string in await resource.get_descendants(
+            r_filter=ResourceFilter(tags=(AsciiString,))
+        )
+    ]
+    await asyncio.gather(
+        *(
+            string.run(ChatGPTStringModifier, ChatGPTStringModifierConfig())
+            for string in strings
+        )
+    )
+
+    assert len(fake_chatgpt.requests) == 1
+    assert recorder.strings == 6
+    assert recorder.coalesced == 5
+    for resource in resources:
+        assert (await resource.get_data()).count(
+            b"SXS: %s() flopped, obviously. Status = 0x%x.\x00"
+        ) == 3
+
+
+async def test_identical_strings_with_different_configs_are_not_shared(
+    ofrak_context: OFRAKContext, fake_chatgpt
+):
+    async def on_request(request):
+        await asyncio.sleep(0.01)
+
+    fake_chatgpt.on_request = on_request
+    data = b"\x00".join([LONG_SENTENCE.encode("ascii")] * 2 + [b""])
+    resource = await create_strings_resource(ofrak_context, data)
+    strings = await resource.get_descendants(
+        r_filter=ResourceFilter(tags=(AsciiString,))
+    )
+    await asyncio.gather(
+        *(
+            string.run(
+                ChatGPTStringModifier, ChatGPTStringModifierConfig(num_choices=i + 1)
+            )
+            for i, string in enumerate(strings)
+        )
+    )
+
+    assert sorted(request.config.num_choices for request in fake_chatgpt.requests) == [
+        1,
+        2,
+    ]
+
+
+async def test_batch_requests_duplicate_strings_once(
+    ofrak_context: OFRAKContext, fake_chatgpt
+):
+    data = b"\x00".join([LONG_IDENTIFIER.encode("ascii")] * 4 + [b""])
+    resource = await create_strings_resource(ofrak_context, data)
+    await resource.run(ChatGPTBatchStringModifier, ChatGPTBatchStringModifierConfig())
+
+    assert [request.texts for request in fake_chatgpt.requests] == [[LONG_IDENTIFIER]]
+    patched = LONG_IDENTIFIER.swapcase().encode("ascii") + b"\x00"
+    assert (await resource.get_data()).count(patched) == 4
+
+
+async def test_interrupted_batch_run_resumes_from_journal(
+    ofrak_context: OFRAKContext, string_resource_data, tmp_path, fake_chatgpt
+):
+    async def interrupt(request):
+        if request.entries[0]["type"] == "sentence":
+            # Give the other batch time to complete before the run crashes
+            await asyncio.sleep(0.01)
+            raise RuntimeError("Interrupted")
+
+    fake_chatgpt.on_request = interrupt
+    journal_path = str(tmp_path / "journal.jsonl")
+    config = ChatGPTBatchStringModifierConfig(batch_size=1, journal_path=journal_path)
+    resource = await create_strings_resource(ofrak_context, string_resource_data)
+    with pytest.raises(RuntimeError):
+        await resource.run(ChatGPTBatchStringModifier, config)
+    get_rewrite_journal(journal_path).close()
+
+    fake_chatgpt.on_request = None
+    fake_chatgpt.requests.clear()
+    resource = await create_strings_resource(ofrak_context, string_resource_data)
+    await resource.run(ChatGPTBatchStringModifier, config)
+    get_rewrite_journal(journal_path).close()
+
+    assert [request.texts for request in fake_chatgpt.requests] == [[LONG_SENTENCE]]
+    data = await resource.get_data()
+    assert LONG_IDENTIFIER.swapcase().encode("ascii") + b"\x00" in data
+    assert b"nTcREATEsECTION() FAILED" in data
+
+
+async def test_string_modifier_replays_journal(
+    ofrak_context: OFRAKContext, string_resource_data, tmp_path, fake_chatgpt
+):
+    fake_chatgpt.rewrite = lambda entry: "SXS: %s() flopped, obviously. Status = 0x%x."
+    config = ChatGPTStringModifierConfig(journal_path=str(tmp_path / "journal.jsonl"))
+    for _ in range(2):
+        resource = await create_strings_resource(ofrak_context, string_resource_data)
+        sentence = await resource.get_only_descendant(
+            r_filter=ResourceFilter(
+                tags=(AsciiString,),
+                attribute_filters=(
+                    ResourceAttributeValueFilter(AsciiString.Text, LONG_SENTENCE),
+                ),
+            )
+        )
+        await sentence.run(ChatGPTStringModifier, config)
+        assert b"SXS: %s() flopped, obviously. Status = 0x%x.\x00" in (
+            await resource.get_data()
+        )
+    get_rewrite_journal(config.journal_path).close()
+
+    assert len(fake_chatgpt.requests) == 1
+
+
+async def test_batches_are_routed_per_model(strings_resource: Resource, fake_chatgpt):
+    fake_chatgpt.rewrite = lambda entry: entry["text"].lower()
+    router = ModelRouter()
+    await strings_resource.run(
+        ChatGPTBatchStringModifier,
+        ChatGPTBatchStringModifierConfig(model_router=router, max_tokens_overshoot=0),
+    )
+
+    # The budget is the tokens of the escaped original in the encoding of the model it is routed
+    # to, plus the tokens of its id
+    identifier_tokens = len(
+        get_encoding(ModelType.THREE_FIVE_TURBO).encode(LONG_IDENTIFIER)
+    )
+    sentence_tokens = len(
+        get_encoding(ModelType.FOUR).encode(json.dumps(LONG_SENTENCE)[1:-1])
+    )
+    assert sorted(
+        (request.config.model, request.texts, request.max_tokens)
+        for request in fake_chatgpt.requests
+    ) == [
+        (ModelType.THREE_FIVE_TURBO, [LONG_IDENTIFIER], identifier_tokens + 5),
+        (ModelType.FOUR, [LONG_SENTENCE], sentence_tokens + 5),
+    ]
+    # Far fewer tokens than characters are reserved
+    assert identifier_tokens < len(LONG_IDENTIFIER) / 2
+    assert sum(router.strings.values()) == 2
+
+
+async def test_budget_skips_lowest_priority_strings(
+    strings_resource: Resource, fake_chatgpt
+):
+    async def use_estimate(request):
+        # Use exactly as many tokens as were estimated
+        record_call(
+            CallMetrics(
+                request.config.model,
+                prompt_tokens=count_prompt_tokens(
+                    request.history, request.config.model
+                ),
+                completion_tokens=request.max_tokens,
+            )
+        )
+
+    fake_chatgpt.rewrite = lambda entry: entry["text"].lower()
+    fake_chatgpt.on_request = use_estimate
+    config = ChatGPTBatchStringModifierConfig(batch_size=1)
+    sentence_tokens, _ = _estimate_batch_usage([LONG_SENTENCE], config)
+    identifier_tokens, _ = _estimate_batch_usage([LONG_IDENTIFIER], config)
+    config.budget = RewriteBudget(max_tokens=sentence_tokens + identifier_tokens - 1)
+    await strings_resource.run(ChatGPTBatchStringModifier, config)
+
+    # The sentence is sent first, after which the identifier no longer fits
+    assert [request.texts for request in fake_chatgpt.requests] == [[LONG_SENTENCE]]
+    assert config.budget.tokens == sentence_tokens
+    assert config.budget.skipped == [LONG_IDENTIFIER]
+    data = await strings_resource.get_data()
+    assert LONG_SENTENCE.lower().strip().encode("ascii") in data
+    assert LONG_IDENTIFIER.encode("ascii") in data
+
+
+def test_routed_strings_use_the_encoding_of_their_model():
+    import tiktoken
+
+    encoding = tiktoken.get_encoding("p50k_base")
+    config = ChatGPTStringModifierConfig(encoding=encoding)
+    assert _get_encoding(config) is encoding
+
+    config.model_router = ModelRouter()
+    routed_config = _route(LONG_SENTENCE, config)
+    assert _get_encoding(routed_config) is get_encoding(ModelType.FOUR)
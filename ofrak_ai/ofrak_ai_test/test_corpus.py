@@ -0,0 +1,89 @@
+import json
+import os
+
+from ofrak import OFRAKContext, Resource
+from ofrak_ai.chatgpt import OpenAICompatibleBackend
+from ofrak_ai.chatgpt_string_modifier import ChatGPTBatchStringModifierConfig
+from ofrak_ai.corpus import RewriteQueue, main, process_corpus
+from ofrak_ai_test.benchmark import load_strings
+from ofrak_ai_test.mock_openai import MockOpenAIServer
+
+SHARED = "The firmware update could not be verified, so it was not installed."
+STRINGS = [
+    [SHARED, "Could not open the configuration file, falling back to defaults."],
+    [SHARED, "__libc_start_main"],
+]
+
+
+async def load_null_terminated_strings(
+    ofrak_context: OFRAKContext, path: str
+) -> Resource:
+    with open(path, "rb") as f:
+        strings = f.read().decode("ascii").split("\x00")[:-1]
+    return await load_strings(strings, ofrak_context)
+
+
+def write_images(directory: str):
+    for index, strings in enumerate(STRINGS):
+        with open(os.path.join(directory, f"image{index}.bin"), "wb") as f:
+            f.write(b"".join(text.encode("ascii") + b"\x00" for text in strings))
+
+
+async def test_process_corpus(tmp_path, mock_openai: MockOpenAIServer):
+    write_images(str(tmp_path))
+    paths = sorted(str(path) for path in tmp_path.iterdir())
+    backend = OpenAICompatibleBackend(mock_openai.api_base)
+    config = ChatGPTBatchStringModifierConfig(model="local-model", backend=backend)
+    try:
+        results = await process_corpus(
+            paths,
+            str(tmp_path / "out"),
+            config,
+            workers=2,
+            load=load_null_terminated_strings,
+        )
+    finally:
+        await backend.close()
+
+    assert [result.error for result in results] == [None, None]
+    assert [(result.strings, result.rewritten) for result in results] == [
+        (2, 2),
+        (1, 1),
+    ]
+    with open(results[1].output_path, "rb") as f:
+        assert f.read() == (
+            SHARED.swapcase().encode("ascii") + b"\x00__libc_start_main\x00"
+        )
+
+
+async def test_rewrite_queue_batches_across_callers(mock_openai: MockOpenAIServer):
+    backend = OpenAICompatibleBackend(mock_openai.api_base)
+    config = ChatGPTBatchStringModifierConfig(
+        model="local-model", backend=backend, batch_size=3
+    )
+    queue = RewriteQueue(config, concurrency=1)
+    try:
+        first = await queue.rewrite(["A" * 50, "B" * 50])
+        second = await queue.rewrite(["B" * 50, "C" * 50])
+    finally:
+        await queue.close()
+        await backend.close()
+
+    assert first == {"A" * 50: "a" * 50, "B" * 50: "b" * 50}
+    assert second == {"B" * 50: "b" * 50, "C" * 50: "c" * 50}
+    assert mock_openai.statistics.requests == 2
+
+
+def test_main_writes_report(tmp_path, capsys):
+    images = tmp_path / "images"
+    images.mkdir()
+    (images / "empty.bin").write_bytes(b"")
+    report = tmp_path / "report.json"
+    status = main(
+        [str(images), str(tmp_path / "out"), "--workers", "1", "--report", str(report)]
+    )
+
+    assert status == 0
+    assert "Processed 1 images (0 failed)" in capsys.readouterr().out
+    [result] = json.loads(report.read_text())
+    assert result["output_path"] == str(tmp_path / "out" / "empty.bin")
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+DISCOVER_SCRIPT = """
+import sys
+import time
+
+import ofrak_ai
+from ofrak import OFRAK
+
+start = time.perf_counter()
+OFRAK().discover(ofrak_ai)
+print(f"Discovered ofrak_ai in {time.perf_counter() - start:.3f}s", file=sys.stderr)
+
+from ofrak_ai.chatgpt import get_encoding
+
+assert "openai" not in sys.modules, "openai was imported during discovery"
+assert "tiktoken" not in sys.modules, "tiktoken was imported during discovery"
+assert get_encoding.cache_info().currsize == 0, "an encoding was built during discovery"
+"""
+
+
+def test_discovery_does_not_load_openai_or_encodings():
+    # Run in a fresh interpreter, since this test session has already imported openai and tiktoken
+    proc = subprocess.run(
+        [sys.executable, "-c", DISCOVER_SCRIPT], capture_output=True, text=True
+    )
+    assert proc.returncode == 0, proc.stderr
@@ -0,0 +1,92 @@
+from ofrak_ai.chatgpt import ChatGPTConfig, ModelType, get_chatgpt_response
+from ofrak_ai.metrics import (
+    CallMetrics,
+    MetricsHook,
+    StringMetrics,
+    add_metrics_hook,
+    has_metrics_hooks,
+    record_call,
+    record_string,
+    remove_metrics_hook,
+)
+
+
+def test_metrics_recorder_summary_and_prometheus(recorder):
+    assert has_metrics_hooks()
+    recorder.record_call(
+        CallMetrics(
+            "gpt-4",
+            queue_wait=0.5,
+            latency=2.0,
+            backoff=3.0,
+            retries=1,
+            prompt_tokens=100,
+            completion_tokens=20,
+            cost=0.0042,
+        )
+    )
+    recorder.record_call(CallMetrics("gpt-4", latency=1.0, error="Timeout"))
+    recorder.record_string(StringMetrics(60, retries=2, failures=["length", "length"]))
+    recorder.record_string(StringMetrics(55, rewritten=True, repairs=1))
+    recorder.record_string(StringMetrics(55, rewritten=True, coalesced=True))
+    recorder.record_cache_lookup(True)
+    recorder.record_cache_lookup(False)
+    recorder.record_cache_lookup(False)
+
+    summary = recorder.summary()
+    assert "API calls: 2 (1 failed, 1 retries, 0 hedged)" in summary
+    assert "gpt-4: 2 calls, 100 prompt tokens, 20 completion tokens, $0.0042" in summary
+    assert "Strings: 3 (2 rewritten, 1 coalesced), 2 retries, 1 repairs" in summary
+    assert "Rewrite cache: 1 hits, 2 misses" in summary
+    assert "Validation failures: length 2" in summary
+
+    lines = recorder.to_prometheus().splitlines()
+    assert "# TYPE ofrak_ai_requests_total counter" in lines
+    assert 'ofrak_ai_requests_total{model="gpt-4"} 2' in lines
+    assert 'ofrak_ai_request_errors_total{model="gpt-4",error="Timeout"} 1' in lines
+    assert 'ofrak_ai_tokens_total{model="gpt-4",type="prompt"} 100' in lines
+    assert 'ofrak_ai_request_latency_seconds{quantile="0.5"} 2.0' in lines
+    assert "ofrak_ai_request_latency_seconds_count 2" in lines
+    assert "ofrak_ai_backoff_seconds_total 3.0" in lines
+    assert "ofrak_ai_string_repairs_total 1" in lines
+    assert "ofrak_ai_strings_coalesced_total 1" in lines
+    assert 'ofrak_ai_string_cache_lookups_total{result="miss"} 2' in lines
+    assert 'ofrak_ai_validation_failures_total{reason="length"} 2' in lines
+
+
+async def test_metrics_are_written_for_prometheus(recorder, mock_openai, tmp_path):
+    history = [
+        {"role": "system", "content": "Make each message louder."},
+        {"role": "user", "content": "hello"},
+    ]
+    await get_chatgpt_response(history, 10, ChatGPTConfig(api_key="mock"))
+    path = tmp_path / "ofrak_ai.prom"
+    recorder.write_prometheus(str(path), prefix="rewrite")
+
+    lines = path.read_text().splitlines()
+    assert "# TYPE rewrite_requests_total counter" in lines
+    assert (
+        f'rewrite_requests_total{{model="{ModelType.THREE_FIVE_TURBO.value}"}} 1'
+        in lines
+    )
+    assert "rewrite_request_latency_seconds_count 1" in lines
+    assert not any(line.startswith("rewrite_request_errors_total") for line in lines)
+
+
+def test_hooks_only_receive_the_measurements_they_override():
+    strings = []
+
+    class StringHook(MetricsHook):
+        def record_string(self, metrics: StringMetrics):
+            strings.append(metrics)
+
+    hook = StringHook()
+    add_metrics_hook(hook)
+    try:
+        record_call(CallMetrics("gpt-4", latency=1.0))
+        record_string(StringMetrics(60))
+    finally:
+        remove_metrics_hook(hook)
+
+    assert strings == [StringMetrics(60)]
+    assert not has_metrics_hooks()
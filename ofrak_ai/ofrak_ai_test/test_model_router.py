@@ -0,0 +1,29 @@
+from ofrak_ai.chatgpt import ModelType
+from ofrak_ai.model_router import ModelRouter, RoutingPolicy
+from ofrak_ai.string_triage import StringCategory
+
+IDENTIFIER = "ConvertStringSecurityDescriptorToSecurityDescriptorW"
+SENTENCE = "Could not open the configuration file, falling back to defaults."
+FORMAT_SENTENCE = "SXS: %s() NtCreateSection() failed. Status = 0x%x.\n"
+
+
+def test_hard_strings_go_to_strong_model():
+    router = ModelRouter()
+    assert router.route(IDENTIFIER) == ModelType.THREE_FIVE_TURBO
+    assert router.route(SENTENCE) == ModelType.THREE_FIVE_TURBO
+    assert router.route(FORMAT_SENTENCE) == ModelType.FOUR
+    assert router.route(SENTENCE * 2) == ModelType.FOUR
+
+
+def test_categories_which_keep_failing_are_escalated():
+    router = ModelRouter(RoutingPolicy(min_samples=4, max_retry_rate=0.5))
+    for retries in (0, 1, 2):
+        router.record(IDENTIFIER, ModelType.THREE_FIVE_TURBO, retries)
+    # Too few strings were seen to tell
+    assert router.route(IDENTIFIER) == ModelType.THREE_FIVE_TURBO
+
+    router.record(IDENTIFIER, ModelType.THREE_FIVE_TURBO, 1)
+    assert router.get_retry_rate(StringCategory.IDENTIFIER, "gpt-3.5-turbo") == 0.75
+    assert router.route(IDENTIFIER) == ModelType.FOUR
+    # Sentences are routed on their own record
+    assert router.route(SENTENCE) == ModelType.THREE_FIVE_TURBO
@@ -0,0 +1,27 @@
+from ofrak_ai.chatgpt_string_modifier import ChatGPTStringModifierConfig
+from ofrak_ai.prompt_report import get_prompt_token_report, main
+
+STRINGS = [
+    "The firmware update could not be verified, so it was not installed.",
+    "Could not open the configuration file, falling back to defaults.",
+    "HTTP_PROXY_CONFIGURATION_PATH",
+]
+
+
+def test_system_message_reduces_prompt_tokens():
+    report = get_prompt_token_report(STRINGS, ChatGPTStringModifierConfig())
+    assert report.strings == len(STRINGS)
+    assert report.system_messages == 2
+    assert 0 < report.prompt_tokens < report.inline_tokens
+    assert f"Reduction: {report.inline_tokens - report.prompt_tokens} tokens" in str(
+        report
+    )
+
+
+def test_main_reports_binary(tmp_path, capsys):
+    path = tmp_path / "image.bin"
+    path.write_bytes(b"\x7fnot a known format\x00")
+    assert main([str(path)]) == 0
+    out = capsys.readouterr().out
+    assert "Strings: 0 (0 distinct system messages)" in out
+    assert "Reduction: 0 tokens (0.0 per string, 0.0%)" in out
@@ -0,0 +1,185 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+
+from openai.error import (
+    InvalidRequestError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+)
+from ofrak_ai.chatgpt import (
+    ChatGPTConfig,
+    OpenAICompatibleBackend,
+    get_chatgpt_response,
+)
+from ofrak_ai.retry import (
+    LatencyTracker,
+    RetryPolicy,
+    call_hedged,
+    call_with_retries,
+    get_latency_tracker,
+    get_retry_after,
+)
+
+
+def failing(errors, result="done"):
+    attempts = []
+
+    async def attempt():
+        attempts.append(None)
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return result
+
+    return attempt, attempts
+
+
+def test_first_delay_is_not_multiplied():
+    policy = RetryPolicy(initial_delay=1.0)
+    for _ in range(100):
+        assert 1.0 <= policy.get_delay(0) <= 2.0
+    assert policy.get_delay(10) <= 2 * policy.max_delay
+    assert RetryPolicy(jitter=False).get_delay(2) == 4.0
+
+
+def test_get_retry_after():
+    assert get_retry_after(RateLimitError(headers={"Retry-After": "3"})) == 3.0
+    assert get_retry_after(RateLimitError(headers={"retry-after-ms": "250"})) == 0.25
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < get_retry_after(RateLimitError(headers={"Retry-After": date})) <= 60
+    assert get_retry_after(RateLimitError()) is None
+
+
+async def test_transient_errors_are_retried():
+    attempt, attempts = failing(
+        [ServiceUnavailableError("Overloaded"), Timeout("Timed out")]
+    )
+    delays = []
+    policy = RetryPolicy(initial_delay=0.001)
+    assert await call_with_retries(attempt, policy, delays.append) == "done"
+    assert len(attempts) == 3
+    assert len(delays) == 2
+
+
+async def test_invalid_requests_are_not_retried():
+    attempt, attempts = failing([InvalidRequestError("Bad request", None)])
+    with pytest.raises(InvalidRequestError):
+        await call_with_retries(attempt, RetryPolicy(initial_delay=0.001))
+    assert len(attempts) == 1
+
+
+async def test_retry_after_is_honored():
+    attempt, _ = failing([RateLimitError(headers={"retry-after-ms": "50"})])
+    delays = []
+    # Without Retry-After the policy would wait for at least 10 seconds
+    policy = RetryPolicy(initial_delay=10.0)
+    start = time.monotonic()
+    assert await call_with_retries(attempt, policy, delays.append) == "done"
+    assert delays == [0.05]
+    assert time.monotonic() - start < 1.0
+
+
+async def test_request_deadline():
+    async def hang():
+        await asyncio.sleep(10)
+
+    start = time.monotonic()
+    with pytest.raises(Timeout):
+        await call_with_retries(hang, RetryPolicy(request_deadline=0.05))
+    assert time.monotonic() - start < 1.0
+
+
+async def test_backoff_past_deadline_raises_error_right_away():
+    attempt, attempts = failing([RateLimitError(headers={"retry-after": "30"})])
+    with pytest.raises(RateLimitError):
+        await call_with_retries(attempt, RetryPolicy(run_deadline=time.time() + 5))
+    assert len(attempts) == 1
+
+
+async def test_hedged_attempt_wins_and_loser_is_cancelled():
+    cancelled = []
+    delays = iter([10.0, 0.01])
+
+    async def attempt():
+        delay = next(delays)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    hedges = []
+    start = time.monotonic()
+    assert await call_hedged(attempt, 0.01, lambda: hedges.append(None)) == 0.01
+    assert time.monotonic() - start < 1.0
+    await asyncio.sleep(0)
+    assert cancelled == [10.0]
+    assert len(hedges) == 1
+
+
+def test_latency_tracker_quantile():
+    tracker = LatencyTracker(max_samples=100)
+    assert tracker.quantile(0.95) is None
+    for latency in range(200):
+        tracker.add(latency)
+    assert len(tracker) == 100
+    assert tracker.quantile(0.95) == 195
+    assert tracker.quantile(1.0) == 199
+
+
+async def test_rate_limited_requests_follow_retry_after(mock_openai, recorder):
+    mock_openai.config.rate_limit_rate = 0.5
+    mock_openai.config.retry_after = 0.01
+    backend = OpenAICompatibleBackend(mock_openai.api_base)
+    chatgpt_config = ChatGPTConfig(
+        model="local-model", backend=backend, retry_policy=RetryPolicy()
+    )
+    history = [
+        {"role": "system", "content": "Make each message louder."},
+        {"role": "user", "content": "hello"},
+    ]
+    start = time.monotonic()
+    for _ in range(5):
+        response = await get_chatgpt_response(history, 10, chatgpt_config)
+        assert response.choices[0].message.content == "HELLO"
+    await backend.close()
+
+    assert mock_openai.statistics.rate_limited > 0
+    # The policy's own delay is at least 1 second per retry
+    assert time.monotonic() - start < 1.0
+    # Every sleep before a retry is reported
+    assert recorder.call_retries == mock_openai.statistics.rate_limited
+    assert recorder.backoff >= 0.01 * recorder.call_retries
+
+
+async def test_slow_requests_are_hedged(mock_openai, recorder):
+    mock_openai.config.slow_requests = frozenset({6})
+    mock_openai.config.slow_latency = 1.0
+    backend = OpenAICompatibleBackend(mock_openai.api_base)
+    chatgpt_config = ChatGPTConfig(
+        model="hedged-model",
+        backend=backend,
+        retry_policy=RetryPolicy(hedge_quantile=0.9, min_hedge_samples=5),
+    )
+    history = [
+        {"role": "system", "content": "Make each message louder."},
+        {"role": "user", "content": "hello"},
+    ]
+    # Learn how long requests usually take before hedging them
+    for _ in range(5):
+        await get_chatgpt_response(history, 10, chatgpt_config)
+    start = time.monotonic()
+    response = await get_chatgpt_response(history, 10, chatgpt_config)
+    elapsed = time.monotonic() - start
+    await backend.close()
+
+    # The duplicate of the slow request answered long before it would have
+    assert elapsed < 0.5
+    assert response.choices[0].message.content == "HELLO"
+    assert mock_openai.statistics.requests == 7
+    assert recorder.hedges == 1
+    assert len(get_latency_tracker("hedged-model")) == 6
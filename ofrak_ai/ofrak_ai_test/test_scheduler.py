@@ -0,0 +1,99 @@
+import asyncio
+
+from ofrak_ai.metrics import CallMetrics, record_call
+from ofrak_ai.scheduler import RewriteBudget, RewriteJob, get_string_priority
+
+SENTENCE = "Could not open the configuration file, falling back to defaults."
+
+
+def create_job(text: str, tokens: int, runs: list, seconds: float = 0.0) -> RewriteJob:
+    async def run():
+        runs.append(text)
+        await asyncio.sleep(seconds)
+        record_call(CallMetrics("model", prompt_tokens=tokens, cost=tokens / 1000))
+
+    return RewriteJob([text], tokens, tokens / 1000, run)
+
+
+def test_sentences_and_longer_strings_first():
+    texts = ["HTTP_PROXY", SENTENCE, "CONFIGURATION_FILE_PATH", SENTENCE[:40]]
+    assert sorted(texts, key=get_string_priority) == [
+        SENTENCE,
+        SENTENCE[:40],
+        "CONFIGURATION_FILE_PATH",
+        "HTTP_PROXY",
+    ]
+
+
+async def test_jobs_stop_once_the_budget_would_be_exceeded():
+    runs: list = []
+    budget = RewriteBudget(max_cost=0.25, max_in_flight=2)
+    await budget.run([create_job(str(i), 100, runs) for i in range(4)])
+
+    # Only two jobs fit at a time, so the third waits for them before it is found not to fit
+    assert runs == ["0", "1"]
+    assert budget.cost == 0.2
+    assert budget.skipped == ["2", "3"]
+    assert str(budget).endswith("2 strings skipped once the cost budget ran out")
+
+    # The budget is spent for the rest of the run
+    await budget.run([create_job("4", 1, runs)])
+    assert budget.skipped == ["2", "3", "4"]
+
+
+async def test_jobs_are_cancelled_once_time_is_up():
+    runs: list = []
+    budget = RewriteBudget(max_tokens=1000, max_seconds=0.1)
+    await budget.run(
+        [create_job("fast", 100, runs), create_job("slow", 100, runs, seconds=10)]
+    )
+
+    assert runs == ["fast", "slow"]
+    assert budget.tokens == 100
+    assert budget.skipped == ["slow"]
+    assert budget.exhausted == "time"
+    assert "100/1000 tokens" in str(budget)
+
+
+async def test_concurrent_runs_share_the_budget():
+    runs: list = []
+    running = 0
+    max_running = 0
+
+    def create_counted_job(text: str) -> RewriteJob:
+        job = create_job(text, 100, runs, seconds=0.01)
+
+        async def run():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            try:
+                await job.run()
+            finally:
+                running -= 1
+
+        return RewriteJob(job.texts, job.tokens, job.cost, run)
+
+    budget = RewriteBudget(max_tokens=1000, max_in_flight=2)
+    await asyncio.gather(
+        *(
+            budget.run([create_counted_job(f"{i}-{j}") for j in range(3)])
+            for i in range(2)
+        )
+    )
+
+    # Each call is charged once, however many runs are going on
+    assert budget.tokens == 600
+    assert budget.skipped == []
+    assert max_running == 2
+
+    # Only what is left of the budget is spent by later concurrent runs
+    await asyncio.gather(
+        *(
+            budget.run([create_counted_job(f"{i}-{j}") for j in range(3, 6)])
+            for i in range(2)
+        )
+    )
+    assert budget.tokens == 1000
+    assert len(budget.skipped) == 2
+    assert budget.exhausted == "token"
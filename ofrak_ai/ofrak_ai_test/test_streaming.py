@@ -0,0 +1,80 @@
+import asyncio
+
+from ofrak import OFRAKContext
+from ofrak.core.binary import GenericBinary
+from ofrak.core.strings import AsciiString
+from ofrak_type import Range
+from openai.util import convert_to_openai_object
+from ofrak_ai import chatgpt_string_modifier
+from ofrak_ai.chatgpt_string_modifier import ChatGPTStringModifierConfig
+from ofrak_ai.streaming import iter_string_descendants, rewrite_strings_streaming
+
+SENTENCES = [
+    f"Could not open configuration file number {i}, falling back to defaults."
+    for i in range(10)
+]
+
+
+async def create_nested_strings_resource(ofrak_context: OFRAKContext):
+    """
+    A root with two sections, each holding half of the sentences and a short string.
+    """
+    sections = [SENTENCES[:5] + ["short"], SENTENCES[5:] + ["short"]]
+    section_data = [
+        b"".join(text.encode("ascii") + b"\x00" for text in texts) for texts in sections
+    ]
+    resource = await ofrak_context.create_root_resource(
+        "nested", b"".join(section_data), tags=(GenericBinary,)
+    )
+    section_offset = 0
+    for texts, data in zip(sections, section_data):
+        section = await resource.create_child(
+            tags=(GenericBinary,),
+            data_range=Range.from_size(section_offset, len(data)),
+        )
+        offset = 0
+        for text in texts:
+            await section.create_child_from_view(
+                AsciiString(text), data_range=Range.from_size(offset, len(text) + 1)
+            )
+            offset += len(text) + 1
+        section_offset += len(data)
+    return resource
+
+
+async def test_iter_string_descendants(ofrak_context: OFRAKContext):
+    resource = await create_nested_strings_resource(ofrak_context)
+    texts = [string.Text async for string in iter_string_descendants(resource)]
+
+    assert texts == SENTENCES[:5] + ["short"] + SENTENCES[5:] + ["short"]
+
+
+async def test_rewrites_are_bounded_in_flight(ofrak_context: OFRAKContext, monkeypatch):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def get_chatgpt_response(history, max_tokens, config, is_viable=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        text = history[-1]["content"]
+        return convert_to_openai_object(
+            {"choices": [{"index": 0, "message": {"content": text.upper()}}]}
+        )
+
+    monkeypatch.setattr(
+        chatgpt_string_modifier, "get_chatgpt_response", get_chatgpt_response
+    )
+    resource = await create_nested_strings_resource(ofrak_context)
+    num_strings = await rewrite_strings_streaming(
+        resource, ChatGPTStringModifierConfig(), max_in_flight=3
+    )
+
+    assert num_strings == len(SENTENCES)
+    assert max_in_flight == 3
+    data = await resource.get_data()
+    for text in SENTENCES:
+        assert text.upper().encode("ascii") + b"\x00" in data
+    assert data.count(b"short\x00") == 2
@@ -0,0 +1,46 @@
+import time
+
+from ofrak_ai.string_cache import StringRewriteCache, get_string_rewrite_cache
+
+
+def test_string_rewrite_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = StringRewriteCache(path)
+    assert cache.get("key") is None
+    cache.put("key", "rewrite")
+    cache.close()
+
+    cache = StringRewriteCache(path)
+    assert cache.get("key") == "rewrite"
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_string_rewrite_cache_evicts_least_recently_used(tmp_path):
+    cache = StringRewriteCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.upper())
+        time.sleep(0.01)
+    assert cache.get("a") == "A"
+    cache.evict()
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+
+
+def test_string_rewrite_cache_expires_entries(tmp_path):
+    cache = StringRewriteCache(str(tmp_path / "cache.sqlite"), max_age=0.01)
+    cache.put("key", "rewrite")
+    time.sleep(0.02)
+
+    assert cache.get("key") is None
+    cache.evict()
+    assert len(cache) == 0
+
+
+def test_get_string_rewrite_cache_is_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = get_string_rewrite_cache(path)
+    assert get_string_rewrite_cache(path) is cache
+    cache.close()
+    assert get_string_rewrite_cache(path) is not cache
@@ -0,0 +1,39 @@
+from ofrak_ai.string_journal import RewriteJournal, get_rewrite_journal
+
+
+def test_rewrite_journal_persists(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = RewriteJournal(path)
+    assert journal.get(0, "text") is None
+    journal.append(0, "text", "rewrite")
+    journal.append(16, "text", "other rewrite")
+    journal.close()
+
+    journal = RewriteJournal(path)
+    assert journal.get(0, "text") == "rewrite"
+    assert journal.get(16, "text") == "other rewrite"
+    assert journal.get(0, "other text") is None
+    assert len(journal) == 2
+
+
+def test_rewrite_journal_skips_cut_off_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = RewriteJournal(str(path))
+    journal.append(0, "text", "rewrite")
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"offset": 8, "text": "cut')
+
+    journal = RewriteJournal(str(path))
+    assert len(journal) == 1
+    journal.append(8, "text", "rewrite")
+    journal.close()
+    assert len(RewriteJournal(str(path))) == 2
+
+
+def test_get_rewrite_journal_is_shared(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = get_rewrite_journal(path)
+    assert get_rewrite_journal(path) is journal
+    journal.close()
+    assert get_rewrite_journal(path) is not journal
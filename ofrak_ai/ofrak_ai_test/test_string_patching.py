@@ -0,0 +1,79 @@
+import pytest
+
+from ofrak.component.modifier import ModifierError
+from ofrak.core.binary import GenericBinary
+from ofrak.core.strings import AsciiString
+from ofrak.ofrak_context import OFRAKContext
+from ofrak_type import Range
+from ofrak_ai.string_patching import (
+    BulkStringPatchingConfig,
+    BulkStringPatchingModifier,
+    get_string_patches,
+)
+
+
+async def test_bulk_string_patching(ofrak_context: OFRAKContext):
+    resource = await ofrak_context.create_root_resource(
+        "strings", b"\xff\xfffirst string\x00second string\x00", tags=(GenericBinary,)
+    )
+    section = await resource.create_child(
+        tags=(GenericBinary,), data_range=Range(2, 29)
+    )
+    first = await section.create_child_from_view(
+        AsciiString("first string"), data_range=Range(0, 13)
+    )
+    second = await section.create_child_from_view(
+        AsciiString("second string"), data_range=Range(13, 27)
+    )
+
+    patches = await get_string_patches(
+        section,
+        [
+            (await first.view_as(AsciiString), "1st"),
+            (await second.view_as(AsciiString), "2nd"),
+        ],
+    )
+    assert patches == [(0, "1st"), (13, "2nd")]
+
+    await section.run(BulkStringPatchingModifier, BulkStringPatchingConfig(patches))
+    assert (
+        await resource.get_data() == b"\xff\xff1st\x00t string\x002nd\x00nd string\x00"
+    )
+    assert await first.get_data() == b"1st\x00t string\x00"
+
+
+async def test_bulk_string_patching_overflow(ofrak_context: OFRAKContext):
+    resource = await ofrak_context.create_root_resource(
+        "strings", b"short\x00", tags=(GenericBinary,)
+    )
+    with pytest.raises(ModifierError):
+        await resource.run(
+            BulkStringPatchingModifier, BulkStringPatchingConfig([(0, "too long")])
+        )
+
+
+async def test_bulk_string_patching_leaves_data_between_strings(
+    ofrak_context: OFRAKContext,
+):
+    resource = await ofrak_context.create_root_resource(
+        "strings",
+        b"first string\x00\x01\x02\x03\x04second string\x00",
+        tags=(GenericBinary,),
+    )
+    first = await resource.create_child_from_view(
+        AsciiString("first string"), data_range=Range(0, 13)
+    )
+    data = await resource.create_child(tags=(GenericBinary,), data_range=Range(13, 17))
+    second = await resource.create_child_from_view(
+        AsciiString("second string"), data_range=Range(17, 31)
+    )
+
+    result = await resource.run(
+        BulkStringPatchingModifier, BulkStringPatchingConfig([(0, "1st"), (17, "2nd")])
+    )
+    assert (
+        await resource.get_data()
+        == b"1st\x00t string\x00\x01\x02\x03\x042nd\x00nd string\x00"
+    )
+    assert {first.get_id(), second.get_id()} <= result.resources_modified
+    assert data.get_id() not in result.resources_modified
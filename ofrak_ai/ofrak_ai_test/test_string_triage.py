@@ -0,0 +1,118 @@
+import pytest
+
+from ofrak import OFRAKContext
+from ofrak.core.binary import GenericBinary
+from ofrak.core.program_section import NamedProgramSection
+from ofrak.core.strings import AsciiString
+from ofrak_type import Range
+from ofrak_ai.string_triage import (
+    StringCategory,
+    classify_string,
+    get_section_name,
+    triage_string_descendants,
+    triage_strings,
+)
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        (
+            "SXS: %s() NtCreateSection() failed. Status = 0x%x.\n",
+            StringCategory.SENTENCE,
+        ),
+        (
+            "thisIsAReallyLongFunctionNameThatExceedsTheMinimumLength",
+            StringCategory.IDENTIFIER,
+        ),
+        ("__libc_start_main", StringCategory.SYMBOL),
+        ("_ITM_deregisterTMCloneTable", StringCategory.SYMBOL),
+        ("puts@@GLIBC_2.2.5", StringCategory.SYMBOL),
+        ("GLIBC_2.34", StringCategory.SYMBOL),
+        ("_ZNSt6vectorIiSaIiEE9push_backERKi", StringCategory.MANGLED_NAME),
+        (
+            "?push_back@?$vector@HV?$allocator@H@std@@@std@@QEAAXAEBH@Z",
+            StringCategory.MANGLED_NAME,
+        ),
+        ("/lib64/ld-linux-x86-64.so.2", StringCategory.PATH),
+        ("libc.so.6", StringCategory.PATH),
+        ("C:\\Windows\\System32\\ntdll.dll", StringCategory.PATH),
+        (".note.gnu.build-id", StringCategory.SECTION_NAME),
+        ("%s: %s (%d)\n", StringCategory.FORMAT),
+        ("0x%08x 0x%08x 0x%08x 0x%08x", StringCategory.FORMAT),
+        ("============================", StringCategory.FORMAT),
+        ("xK$\x7f&;Bq(]*Cz>{}|Dw~^", StringCategory.BINARY_DATA),
+    ],
+)
+def test_classify_string(text, expected):
+    assert classify_string(text) == expected
+
+
+@pytest.mark.parametrize(
+    "section_name,expected",
+    [
+        (None, StringCategory.IDENTIFIER),
+        (".rodata", StringCategory.IDENTIFIER),
+        # An imported function the dynamic linker looks up by name
+        (".dynstr", StringCategory.SYMBOL),
+        (".strtab", StringCategory.SYMBOL),
+    ],
+)
+def test_classify_string_by_section(section_name, expected):
+    text = "ConvertStringSecurityDescriptorToSecurityDescriptorW"
+    assert classify_string(text, section_name=section_name) == expected
+
+
+def test_triage_strings():
+    strings = [
+        AsciiString("short"),
+        AsciiString("SXS: %s() NtCreateSection() failed. Status = 0x%x.\n"),
+        AsciiString("ConvertStringSecurityDescriptorToSecurityDescriptorW"),
+        AsciiString(
+            "_ZN7example26VeryLongMangledFunctionNameEPKcmRKNSt7__cxx1112basic_stringE"
+        ),
+        AsciiString("/usr/lib/x86_64-linux-gnu/libstdc++.so.6.0.30/with/a/long/path"),
+    ]
+    triage = triage_strings(strings, min_length=50)
+
+    assert triage.rewrite == strings[1:3]
+    assert triage.counts == {
+        StringCategory.SHORT: 1,
+        StringCategory.SENTENCE: 1,
+        StringCategory.IDENTIFIER: 1,
+        StringCategory.MANGLED_NAME: 1,
+        StringCategory.PATH: 1,
+    }
+    assert str(triage) == "short 1, sentence 1, identifier 1, mangled_name 1, path 1"
+
+
+async def test_triage_string_descendants_skips_symbol_sections(
+    ofrak_context: OFRAKContext,
+):
+    text = "ConvertStringSecurityDescriptorToSecurityDescriptorW"
+    data = text.encode("ascii") + b"\x00"
+    resource = await ofrak_context.create_root_resource(
+        "sections", data * 2, tags=(GenericBinary,)
+    )
+    strings = []
+    for i, name in enumerate([".rodata", ".dynstr"]):
+        section = await resource.create_child_from_view(
+            NamedProgramSection(i * len(data), len(data), name),
+            data_range=Range.from_size(i * len(data), len(data)),
+        )
+        strings.append(
+            await section.create_child_from_view(
+                AsciiString(text), data_range=Range(0, len(data))
+            )
+        )
+
+    triage = await triage_string_descendants(resource)
+    assert [string.resource.get_id() for string in triage.rewrite] == [
+        strings[0].get_id()
+    ]
+    assert triage.counts == {StringCategory.IDENTIFIER: 1, StringCategory.SYMBOL: 1}
+    assert await get_section_name(strings[1]) == ".dynstr"
+    assert await get_section_name(resource) is None
+    # Triaging a symbol section itself skips its strings too
+    dynstr = await strings[1].get_parent()
+    assert (await triage_string_descendants(dynstr)).rewrite == []
@@ -59,7 +59,10 @@ setuptools.setup(
     cmdclass={"egg_info": egg_info_ex},
     entry_points={
         "ofrak.packages": ["ofrak_pkg = ofrak"],
-        "console_scripts": ["ofrak = ofrak.__main__:main"],
+        "console_scripts": [
+            "ofrak = ofrak.__main__:main",
+            "ofrak-ai-corpus = ofrak_ai.corpus:main",
+        ],
     },
     include_package_data=True,
 )